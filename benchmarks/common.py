@@ -0,0 +1,63 @@
+"""
+Helpers shared by the benchmarks: timing of small operations and a stand-in
+Loki push server answering after a configurable latency.
+"""
+
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+REPEAT = 5
+
+
+def timeit(fn: Callable[[], None], number: int, repeat: int = REPEAT) -> dict:
+    """
+    Call `fn` `number` times, `repeat` times over, and return the median and
+    best time per call, in microseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return {"median_us": statistics.median(timings), "best_us": min(timings)}
+
+
+class StandInLoki:
+    """Local HTTP server accepting Loki pushes after `latency` seconds"""
+
+    def __init__(self, latency: float = 0.0):
+        stand_in = self
+        self.latency = latency
+        self.pushes = 0
+        self.bytes = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                time.sleep(stand_in.latency)
+                stand_in.pushes += 1
+                stand_in.bytes += len(body)
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self) -> "StandInLoki":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._server.shutdown()
+        self._server.server_close()
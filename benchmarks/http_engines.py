@@ -0,0 +1,67 @@
+"""
+Compare the `http` probe run by Grafana k6 and by the in-process python
+engine against a local HTTP server.
+
+Prints one JSON document with, per engine, the wall-clock time of the probe
+call, including k6 start-up, and the request rate and latency it measured.
+The k6 engine is skipped when k6 is not on the PATH.
+"""
+
+import json
+import shutil
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from chaosgrafana.k6.probes import http
+
+RUNS = 5
+VUS = 10
+DURATION = "2s"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(endpoint: str, engine: str) -> dict:
+    walls, rates, p95s = [], [], []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        result = http(endpoint, vus=VUS, duration=DURATION, engine=engine)
+        walls.append(time.perf_counter() - started)
+        rates.append(result["request_rate"])
+        p95s.append(result["http_req_duration"]["p95"])
+
+    return {
+        "median_wall_s": statistics.median(walls),
+        "median_request_rate": statistics.median(rates),
+        "median_p95_ms": statistics.median(p95s),
+    }
+
+
+def run() -> dict:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/"
+    try:
+        engines = ["python"] + (["k6"] if shutil.which("k6") else [])
+        return {e: measure(endpoint, e) for e in engines}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,62 @@
+"""
+Measure how long importing each module of the extension takes in a fresh
+interpreter, as chaostoolkit does for every experiment.
+
+Prints one JSON document with the median cumulative import time, in
+microseconds, of each module and the heavy dependencies it pulled in, so
+results can be stored and compared across releases.
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    "chaosgrafana",
+    "chaosgrafana.k6.actions",
+    "chaosgrafana.k6.probes",
+    "chaosgrafana.controls.k6",
+    "chaosgrafana.controls.loki",
+    "chaosgrafana.controls.metrics",
+    "chaosgrafana.loki.probes",
+]
+HEAVY_DEPENDENCIES = ["chaoslib", "logging_loki", "requests"]
+RUNS = 10
+
+
+def measure(module: str) -> dict:
+    timings = []
+    for _ in range(RUNS):
+        p = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for line in p.stderr.splitlines():
+            _, cumulative, name = line.split("|")
+            if name.strip() == module:
+                timings.append(int(cumulative))
+
+    code = (
+        f"import json, sys, {module}; "
+        f"print(json.dumps([m for m in {HEAVY_DEPENDENCIES!r} "
+        "if m in sys.modules]))"
+    )
+    loaded = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True
+    ).stdout
+
+    return {
+        "median_us": statistics.median(timings),
+        "loads": json.loads(loaded),
+    }
+
+
+def run() -> dict:
+    return {m: measure(m) for m in MODULES}
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,108 @@
+"""
+Benchmark the k6 side of the extension on recorded k6 output: building the
+k6 command line, parsing an end-of-test summary and aggregating the NDJSON
+metric stream.
+"""
+
+import json
+import logging
+import os
+from unittest.mock import MagicMock, patch
+
+from common import timeit
+from logzero import logger
+
+from chaosgrafana.k6.actions import _script_driver
+from chaosgrafana.k6.stream import MetricsAggregator
+from chaosgrafana.k6.summary import merge_results, parse_summary
+from chaosgrafana.k6.thresholds import parse_thresholds
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+STAGES = [{"duration": "30s", "target": 50}] * 5
+
+
+def _fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+def command_building() -> dict:
+    """From activity arguments to a started, mocked, k6 process"""
+
+    def start():
+        driver = _script_driver(
+            None, "1m", STAGES, None, None, False, {"TARGET": "x"}
+        )
+        driver.archive = False
+        run = driver.start_script("script.js")
+        os.remove(run.summary_path)
+
+    with patch("subprocess.Popen", return_value=MagicMock()):
+        return timeit(start, number=500)
+
+
+def summary_parsing() -> dict:
+    summary = json.loads(_fixture("summary.json"))
+    return timeit(lambda: parse_summary(summary, 0), number=5000)
+
+
+def stream_aggregation() -> dict:
+    lines = _fixture("metrics.ndjson").splitlines()
+
+    def aggregate():
+        aggregator = MetricsAggregator()
+        for line in lines:
+            aggregator.add_line(line)
+
+    timing = timeit(aggregate, number=20)
+    timing["lines_per_s"] = len(lines) / timing["median_us"] * 1e6
+    return timing
+
+
+def results_merging() -> dict:
+    lines = _fixture("metrics.ndjson").splitlines()
+    result = parse_summary(json.loads(_fixture("summary.json")), 0)
+    aggregators = []
+    for _ in range(8):
+        aggregator = MetricsAggregator()
+        for line in lines:
+            aggregator.add_line(line)
+        aggregators.append(aggregator)
+
+    return timeit(
+        lambda: merge_results([result] * len(aggregators), aggregators),
+        number=100,
+    )
+
+
+def threshold_checks() -> dict:
+    aggregator = MetricsAggregator()
+    for line in _fixture("metrics.ndjson").splitlines():
+        aggregator.add_line(line)
+    thresholds = parse_thresholds(
+        [
+            {"metric": "http_req_duration", "threshold": "p(95)<500"},
+            {"metric": "http_req_failed", "threshold": "rate<0.05"},
+        ]
+    )
+
+    def check():
+        for threshold in thresholds:
+            threshold.check([aggregator])
+
+    return timeit(check, number=1000)
+
+
+def run() -> dict:
+    logger.setLevel(logging.WARNING)
+    return {
+        "command_building": command_building(),
+        "summary_parsing": summary_parsing(),
+        "stream_aggregation": stream_aggregation(),
+        "results_merging": results_merging(),
+        "threshold_checks": threshold_checks(),
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
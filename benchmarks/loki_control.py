@@ -0,0 +1,104 @@
+"""
+Benchmark the Loki control: the overhead it adds to every activity, the
+throughput of its emitter against a stand-in push server and the memory held
+per 10k buffered events.
+
+Run with `--latency` to set how long, in milliseconds, the stand-in server
+takes to answer a push.
+"""
+
+import argparse
+import json
+import logging
+import time
+import tracemalloc
+
+from chaoslib.run import EventHandlerRegistry
+from common import StandInLoki, timeit
+
+from chaosgrafana.controls import loki
+
+EVENTS = 10_000
+ACTIVITY = {"name": "kill-pod", "type": "action"}
+STATE = {
+    "status": "succeeded",
+    "start": "2024-01-01T00:00:00",
+    "end": "2024-01-01T00:00:01",
+    "duration": 1.0,
+    "output": {"status": 200, "body": "x" * 512},
+}
+
+
+def _configure(url: str, **kwargs) -> None:
+    loki.configure_control(
+        experiment={"title": "benchmark"},
+        event_registry=EventHandlerRegistry(),
+        secrets={},
+        loki_endpoint=url,
+        **kwargs,
+    )
+
+
+def activity_overhead(url: str) -> dict:
+    """Time spent in the activity controls, per activity"""
+    results = {}
+    for line_format in ("text", "json"):
+        _configure(url, line_format=line_format, max_queue_size=EVENTS * 10)
+
+        def activity():
+            loki.before_activity_control(ACTIVITY)
+            loki.after_activity_control(ACTIVITY, STATE)
+
+        results[line_format] = timeit(activity, number=1000)
+        loki.cleanup_control()
+    return results
+
+
+def emitter_throughput(url: str) -> dict:
+    """Records delivered per second, from logging them to Loki acking them"""
+    results = {}
+    for compression in (None, "gzip", "snappy"):
+        _configure(url, compression=compression, max_queue_size=EVENTS)
+        started = time.perf_counter()
+        for i in range(EVENTS):
+            loki.loki_logger.info("event %d", i, extra={"tags": {"i": i % 10}})
+        loki.cleanup_control()
+        elapsed = time.perf_counter() - started
+        results[compression or "none"] = {"records_per_s": EVENTS / elapsed}
+    return results
+
+
+def memory_per_10k_events(url: str) -> dict:
+    """Peak memory allocated while 10k events wait to be pushed"""
+    _configure(url, max_queue_size=EVENTS, batch_interval=3600)
+    handler = next(
+        h
+        for h in loki.loki_logger.handlers
+        if isinstance(h, loki.LokiBatchHandler)
+    )
+    tracemalloc.start()
+    for _ in range(EVENTS):
+        loki.after_activity_control(ACTIVITY, STATE)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    dropped = handler.dropped
+    loki.cleanup_control()
+    return {"peak_kib": peak / 1024, "dropped": dropped}
+
+
+def run(latency_ms: float = 0.0) -> dict:
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    with StandInLoki(latency_ms / 1000) as server:
+        return {
+            "latency_ms": latency_ms,
+            "activity_overhead": activity_overhead(server.url),
+            "emitter_throughput": emitter_throughput(server.url),
+            "memory_per_10k_events": memory_per_10k_events(server.url),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.latency), indent=2))
@@ -0,0 +1,105 @@
+"""
+Run every benchmark and compare the results with the latest ones stored in
+`benchmarks/results`, flagging the timings that got more than 25% worse.
+
+Run with `--save` to store the results as `results/<version>.json`, which is
+done for every release so regressions are caught before the next one.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+
+import http_engines
+import import_time
+import k6_driver
+import loki_control
+
+from chaosgrafana import __version__
+
+RESULTS = os.path.join(os.path.dirname(__file__), "results")
+TOLERANCE = 0.25
+# leaves whose value grows when performance degrades, any other numeric
+# leaf, such as a throughput, degrades when it drops
+LOWER_IS_BETTER = ("_us", "_s", "_ms", "_kib", "dropped")
+# best times are kept for reference but are too noisy to compare
+IGNORED = ("best_us", "latency_ms")
+
+
+def run(latency_ms: float) -> dict:
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "benchmarks": {
+            "import_time": import_time.run(),
+            "http_engines": http_engines.run(),
+            "k6_driver": k6_driver.run(),
+            "loki_control": loki_control.run(latency_ms),
+        },
+    }
+
+
+def latest() -> dict:
+    paths = sorted(glob.glob(os.path.join(RESULTS, "*.json")), key=_version)
+    if not paths:
+        return None
+    with open(paths[-1]) as f:
+        return json.load(f)
+
+
+def compare(baseline: dict, current: dict, path: str = "") -> list:
+    """The paths of the values worse than their baseline by over TOLERANCE"""
+    regressions = []
+    for key, value in current.items():
+        name = f"{path}.{key}" if path else key
+        previous = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            regressions.extend(compare(previous or {}, value, name))
+        elif key in IGNORED:
+            continue
+        elif _is_number(value) and _is_number(previous) and previous:
+            change = (value - previous) / previous
+            if not key.endswith(LOWER_IS_BETTER):
+                change = -change
+            if change > TOLERANCE:
+                regressions.append(f"{name}: {previous:.6g} -> {value:.6g}")
+    return regressions
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _version(path: str) -> tuple:
+    name = os.path.splitext(os.path.basename(path))[0]
+    return tuple(int(p) if p.isdigit() else 0 for p in name.split("."))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--save", action="store_true")
+    args = parser.parse_args()
+
+    baseline = latest()
+    results = run(args.latency)
+    print(json.dumps(results, indent=2))
+
+    if args.save:
+        os.makedirs(RESULTS, exist_ok=True)
+        path = os.path.join(RESULTS, f"{__version__}.json")
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if baseline is not None:
+        regressions = compare(
+            baseline["benchmarks"], results["benchmarks"]
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -1,41 +1,70 @@
 # -*- coding: utf-8 -*-
-from typing import List
+import json
+import os
+from typing import TYPE_CHECKING, List
 
-from chaoslib.discovery.discover import (
-    discover_actions,
-    discover_activities,
-    initialize_discovery_result,
-)
-from chaoslib.types import DiscoveredActivities, Discovery
-from logzero import logger
+if TYPE_CHECKING:  # pragma: no cover
+    from chaoslib.types import DiscoveredActivities, Discovery
 
-__all__ = ["__version__", "create_k8s_api_client", "discover"]
+__all__ = ["__version__", "discover"]
 __version__ = "0.2.0"
 
+# Activities exported by this extension, with the type they are discovered
+# as. Their metadata is precomputed into the manifest, run `make manifest`
+# whenever they change.
+EXPORTED_MODULES = [
+    ("chaosgrafana.controls.loki", "control"),
+    ("chaosgrafana.controls.k6", "control"),
+    ("chaosgrafana.controls.metrics", "control"),
+    ("chaosgrafana.controls.annotations", "control"),
+    ("chaosgrafana.k6.actions", "action"),
+    ("chaosgrafana.k6.probes", "probe"),
+    ("chaosgrafana.loki.probes", "probe"),
+    ("chaosgrafana.probes", "probe"),
+]
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "manifest.json")
 
-def discover(discover_system: bool = True) -> Discovery:
+
+def discover(discover_system: bool = True) -> "Discovery":
     """
     Discover Grafana capabilities offered by this extension.
     """
+    from chaoslib.discovery.discover import initialize_discovery_result
+    from logzero import logger
+
     logger.info("Discovering capabilities from chaostoolkit-grafana")
 
     discovery = initialize_discovery_result(
         "chaostoolkit-grafana", __version__, "grafana"
     )
     discovery["activities"].extend(load_exported_activities())
-    return
+    return discovery
 
 
 ###############################################################################
 # Private functions
 ###############################################################################
-def load_exported_activities() -> List[DiscoveredActivities]:
+def load_exported_activities() -> List["DiscoveredActivities"]:
     """
     Extract metadata from actions and probes exposed by this extension.
+
+    This reads the precomputed manifest rather than importing every module.
+    """
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def build_manifest(path: str = MANIFEST_PATH) -> None:
+    """
+    Import every module exposed by this extension and write the metadata of
+    their activities to the manifest.
     """
+    from chaoslib.discovery.discover import discover_activities
+
     activities = []
-    activities.extend(
-        discover_activities("chaosgrafana.controls.loki", "control"),
-        discover_actions("chaosgrafana.k6.actions"),
-    )
-    return activities
+    for module, activity_type in EXPORTED_MODULES:
+        activities.extend(discover_activities(module, activity_type))
+
+    with open(path, "w") as f:
+        json.dump(activities, f, indent=2)
+        f.write("\n")
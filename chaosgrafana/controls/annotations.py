@@ -0,0 +1,409 @@
+import threading
+import time
+from secrets import token_hex
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from chaoslib import experiment_hash
+from chaoslib.run import EventHandlerRegistry, RunEventHandler
+from chaoslib.types import Activity, Experiment, Journal, Run, Secrets
+from logzero import logger as ctk_logger
+
+from ..stats import stats
+
+__all__ = ["configure_control"]
+DEFAULT_GRAFANA_URL = "http://localhost:3000"
+DEFAULT_FLUSH_INTERVAL = 2.0
+DEFAULT_FLUSH_TIMEOUT = 30.0
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_POOL_SIZE = 4
+DEFAULT_REQUEST_TIMEOUT = 10.0
+
+annotator: Optional["Annotator"] = None
+
+
+def configure_control(
+    experiment: Experiment,
+    secrets: Secrets = None,
+    event_registry: EventHandlerRegistry = None,
+    grafana_endpoint: str = DEFAULT_GRAFANA_URL,
+    dashboard_uid: str = None,
+    panel_id: int = None,
+    tags: List[str] = None,
+    experiment_ref: str = None,
+    trace_id: str = None,
+    flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+) -> None:
+    """
+    Annotate Grafana with the run, its steady-state, method, rollbacks and
+    cooldown phases and each activity, as regions spanning from their start
+    to their end.
+
+    * `grafana_endpoint` the base url of your Grafana
+    * `dashboard_uid` and `panel_id` restrict the annotations to a dashboard,
+      or one of its panels. Otherwise, they are organization wide and shown
+      by any dashboard querying them by tag
+    * `tags` a list of strings added to the tags of every annotation
+    * `experiment_ref` a unique string identifying this experiment, if none
+      is provided, a hash of the experiment is created
+    * `trace_id` a unique string for a particular run of the experiment, if
+      none is provided, a random string is generated. Pass the one given to
+      the Loki control to cross-reference annotations and logs
+    * `flush_interval` how often, in seconds, annotations are written
+
+    Grafana is authenticated against with a service account token in the
+    `token` secret, or a username and password in the `auth` secret.
+
+    Annotations are written in batches from a background thread, so the
+    experiment never waits on Grafana, and once more when the control is
+    cleaned up. A region which ends before it was written is created at once
+    with its end, others are patched when they end.
+    """
+    if event_registry is None:
+        ctk_logger.debug(
+            "You may be using an older version of chaostoolkit-lib, make sure "
+            "you run at least 1.26.0. The Grafana extension will not "
+            "be enabled"
+        )
+        return
+
+    secrets = secrets or {}
+    trace_id = trace_id or token_hex(16)
+    experiment_ref = experiment_ref or experiment_hash(experiment)
+    common_tags = [
+        "chaostoolkit",
+        f"chaostoolkit_run_trace_id:{trace_id}",
+        f"chaostoolkit_experiment_ref:{experiment_ref}",
+        *(tags or []),
+    ]
+
+    global annotator
+    if annotator is not None:
+        annotator.close()
+    annotator = Annotator(
+        GrafanaAnnotationsClient(
+            grafana_endpoint,
+            token=secrets.get("token"),
+            auth=secrets.get("auth"),
+            dashboard_uid=dashboard_uid,
+            panel_id=panel_id,
+        ),
+        common_tags,
+        flush_interval,
+    )
+    annotator.start()
+    annotator.start_region(
+        "run",
+        f"Experiment: {experiment.get('title') or 'experiment'}",
+        ["experiment"],
+    )
+
+    event_registry.register(AnnotationRunEventHandler(annotator))
+
+
+def cleanup_control() -> None:
+    """
+    Write the pending annotations and stop the background writer.
+    """
+    global annotator
+    if annotator is not None:
+        annotator.close()
+        annotator = None
+
+
+def before_activity_control(context: Activity, *args, **kwargs) -> None:
+    if annotator is not None:
+        annotator.start_region(
+            id(context),
+            f"Activity '{context.get('name')}'",
+            ["activity", context.get("type") or "activity"],
+        )
+
+
+def after_activity_control(
+    context: Activity, state: Run, *args, **kwargs
+) -> None:
+    if annotator is not None:
+        annotator.end_region(id(context), [state.get("status") or "unknown"])
+
+
+class GrafanaAnnotationsClient:
+    """Create and patch annotations with the Grafana HTTP API."""
+
+    def __init__(
+        self,
+        url: str,
+        token: str = None,
+        auth: Tuple[str, str] = None,
+        dashboard_uid: str = None,
+        panel_id: int = None,
+    ):
+        self.url = f"{url.rstrip('/')}/api/annotations"
+        self.dashboard_uid = dashboard_uid
+        self.panel_id = panel_id
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=DEFAULT_POOL_SIZE
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        elif auth:
+            self.session.auth = tuple(auth)
+
+    def create(self, annotation: Dict[str, Any]) -> int:
+        """Create an annotation and return its identifier"""
+        body = dict(annotation)
+        if self.dashboard_uid:
+            body["dashboardUID"] = self.dashboard_uid
+        if self.panel_id is not None:
+            body["panelId"] = self.panel_id
+        with stats.timer("grafana.request"):
+            response = self.session.post(
+                self.url, json=body, timeout=DEFAULT_REQUEST_TIMEOUT
+            )
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def patch(self, annotation_id: int, changes: Dict[str, Any]) -> None:
+        with stats.timer("grafana.request"):
+            response = self.session.patch(
+                f"{self.url}/{annotation_id}",
+                json=changes,
+                timeout=DEFAULT_REQUEST_TIMEOUT,
+            )
+        response.raise_for_status()
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class Annotator:
+    """
+    Collect the regions of a run and write them to Grafana in batches, every
+    `interval` seconds, from a background thread.
+
+    Regions are only ever written once they ended, in a single request, or
+    when a flush finds them still open. Those are then patched with their
+    end, tags and text in a later flush.
+
+    A region which could not be written is retried by the next flushes, up
+    to `max_attempts` times.
+    """
+
+    def __init__(
+        self,
+        client: GrafanaAnnotationsClient,
+        tags: List[str] = None,
+        interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.client = client
+        self.tags = list(tags or [])
+        self.interval = interval
+        self.max_attempts = max(1, max_attempts)
+        self._regions: Dict[Any, Dict[str, Any]] = {}
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="chaosgrafana-annotations", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def start_region(self, key: Any, text: str, tags: List[str]) -> None:
+        region = {
+            "text": text,
+            "tags": [*self.tags, *tags],
+            "time": _now(),
+            "end": None,
+            "id": None,
+            "attempts": 0,
+        }
+        with self._lock:
+            self._regions[key] = region
+            self._pending.append(region)
+
+    def end_region(self, key: Any, tags: List[str] = None) -> None:
+        with self._lock:
+            region = self._regions.pop(key, None)
+            if region is None:
+                return
+            region["end"] = _now()
+            region["tags"].extend(tags or [])
+            if region["id"] is not None:
+                # written while open, it now needs its end
+                self._pending.append(region)
+
+    def wakeup(self) -> None:
+        """Have the background thread write the pending annotations now"""
+        self._wakeup.set()
+
+    def flush(self) -> bool:
+        """Write the pending annotations and tell whether all were written"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                writes = [
+                    (region, {**region, "tags": list(region["tags"])})
+                    for region in pending
+                ]
+
+            written = True
+            for region, snapshot in writes:
+                try:
+                    self._write(region, snapshot)
+                except Exception as x:
+                    ctk_logger.debug(f"Failed to annotate Grafana: {x}")
+                    stats.inc("grafana.annotations_failed")
+                    self._retry(region)
+                    written = False
+            return written
+
+    def close(self, timeout: float = DEFAULT_FLUSH_TIMEOUT) -> None:
+        """End the regions still open, write everything left and stop."""
+        with self._lock:
+            keys = list(self._regions)
+        for key in keys:
+            self.end_region(key)
+
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+        self.client.close()
+
+    def _write(self, region: Dict[str, Any], snapshot: Dict[str, Any]) -> None:
+        annotation = {
+            "time": snapshot["time"],
+            "tags": snapshot["tags"],
+            "text": snapshot["text"],
+        }
+        if snapshot["end"] is not None:
+            annotation["timeEnd"] = snapshot["end"]
+
+        if snapshot["id"] is None:
+            annotation_id = self.client.create(annotation)
+            stats.inc("grafana.annotations_created")
+            with self._lock:
+                region["id"] = annotation_id
+                # the region ended while it was being created
+                if region["end"] is not None and snapshot["end"] is None:
+                    self._pending.append(region)
+        else:
+            self.client.patch(snapshot["id"], annotation)
+            stats.inc("grafana.annotations_patched")
+
+    def _retry(self, region: Dict[str, Any]) -> None:
+        with self._lock:
+            region["attempts"] += 1
+            if region["attempts"] >= self.max_attempts:
+                ctk_logger.debug(
+                    f"Giving up on annotating Grafana with '{region['text']}'"
+                )
+                stats.inc("grafana.annotations_dropped")
+                return
+            if not any(r is region for r in self._pending):
+                self._pending.append(region)
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self._stopped:
+                self.flush()
+
+
+class AnnotationRunEventHandler(RunEventHandler):
+    """Turn the run events into Grafana annotation regions."""
+
+    def __init__(self, annotator: Annotator):
+        self.annotator = annotator
+
+    def finish(self, journal: Journal) -> None:
+        self.annotator.end_region("run", [journal.get("status") or "unknown"])
+        self.annotator.wakeup()
+
+    def interrupted(self, experiment: Experiment, journal: Journal) -> None:
+        self.annotator.end_region("run", ["interrupted"])
+        self.annotator.wakeup()
+
+    def signal_exit(self) -> None:
+        self.annotator.end_region("run", ["exit-signal"])
+        self.annotator.wakeup()
+
+    def start_continuous_hypothesis(self, frequency: int) -> None:
+        self._start_phase("continuous-steady-state")
+
+    def continuous_hypothesis_completed(
+        self,
+        experiment: Experiment,
+        journal: Journal,
+        exception: Exception = None,
+    ) -> None:
+        self._end_phase(
+            "continuous-steady-state", ["deviated"] if exception else []
+        )
+
+    def start_hypothesis_before(self, experiment: Experiment) -> None:
+        self._start_phase("steady-state-before")
+
+    def hypothesis_before_completed(
+        self, experiment: Experiment, state: Dict[str, Any], journal: Journal
+    ) -> None:
+        self._end_phase("steady-state-before", _deviation(state))
+
+    def start_hypothesis_after(self, experiment: Experiment) -> None:
+        self._start_phase("steady-state-after")
+
+    def hypothesis_after_completed(
+        self, experiment: Experiment, state: Dict[str, Any], journal: Journal
+    ) -> None:
+        self._end_phase("steady-state-after", _deviation(state))
+
+    def start_method(self, experiment: Experiment) -> None:
+        self._start_phase("method")
+
+    def method_completed(self, experiment: Experiment, state: Any) -> None:
+        self._end_phase("method")
+
+    def start_rollbacks(self, experiment: Experiment) -> None:
+        self._start_phase("rollbacks")
+
+    def rollbacks_completed(
+        self, experiment: Experiment, journal: Journal
+    ) -> None:
+        self._end_phase("rollbacks")
+
+    def start_cooldown(self, duration: int) -> None:
+        self._start_phase("cooldown")
+
+    def cooldown_completed(self) -> None:
+        self._end_phase("cooldown")
+
+    def _start_phase(self, phase: str) -> None:
+        self.annotator.start_region(
+            f"phase:{phase}", f"Phase: {phase}", ["phase", phase]
+        )
+
+    def _end_phase(self, phase: str, tags: List[str] = None) -> None:
+        self.annotator.end_region(f"phase:{phase}", tags)
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _now() -> int:
+    return int(time.time() * 1000)
+
+
+def _deviation(state: Optional[Dict[str, Any]]) -> List[str]:
+    if state and state.get("steady_state_met") is False:
+        return ["deviated"]
+    return []
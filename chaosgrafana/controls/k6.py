@@ -0,0 +1,46 @@
+from chaoslib.run import EventHandlerRegistry, RunEventHandler
+from chaoslib.types import Experiment, Journal, Secrets
+from logzero import logger as ctk_logger
+
+from chaosgrafana.k6.driver import stop_all_runs
+
+__all__ = ["configure_control"]
+
+
+def configure_control(
+    experiment: Experiment,
+    secrets: Secrets = None,
+    event_registry: EventHandlerRegistry = None,
+) -> None:
+    """
+    Stop the k6 runs started in the background by the `start_script` and
+    `start_stress` actions, that are still going when the experiment
+    finishes, is interrupted or receives an exit signal.
+    """
+    if event_registry is None:
+        ctk_logger.debug(
+            "You may be using an older version of chaostoolkit-lib, make sure "
+            "you run at least 1.26.0. Background k6 runs will only be "
+            "stopped when the process exits"
+        )
+        return
+
+    event_registry.register(K6RunEventHandler())
+
+
+def cleanup_control() -> None:
+    stop_all_runs()
+
+
+###############################################################################
+# Private functions
+###############################################################################
+class K6RunEventHandler(RunEventHandler):
+    def finish(self, journal: Journal) -> None:
+        stop_all_runs()
+
+    def interrupted(self, experiment: Experiment, journal: Journal) -> None:
+        stop_all_runs()
+
+    def signal_exit(self) -> None:
+        stop_all_runs()
@@ -1,17 +1,50 @@
+import email.utils
+import gzip
+import json
 import logging
+import os
+import queue
+import random
+import threading
 import time
 from secrets import token_hex
-from typing import Any, Dict
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 import logging_loki
+import requests
 from chaoslib import __version__, experiment_hash
 from chaoslib.run import EventHandlerRegistry, RunEventHandler
 from chaoslib.types import Activity, Experiment, Journal, Run, Secrets
 from logzero import logger as ctk_logger
 
+from ..k6.logs import set_activity
+from ..k6.trace import set_traceparent_source
+from ..stats import stats
+from .protobuf import has_snappy, pb_bytes, pb_varint, snappy_compress
+from .tracing import OTLPTraceExporter, Tracer, TracingRunEventHandler
+
 __all__ = ["configure_control"]
 DEFAULT_LOKI_URL = "http://localhost:3100"
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_INTERVAL = 1.0
+DEFAULT_MAX_QUEUE_SIZE = 10000
+# Share of the buffer k6 output may fill, the rest is kept for run events
+DEFAULT_K6_LOGS_SHARE = 0.5
+DEFAULT_FLUSH_TIMEOUT = 30.0
+DEFAULT_MAX_OUTPUT_SIZE = 4096
+DEFAULT_POOL_SIZE = 4
+DEFAULT_PUSH_TIMEOUT = 10.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+DEFAULT_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+DEFAULT_SPOOL_BACKUPS = 2
+DEFAULT_ROLLUP_INTERVAL = 60.0
+DEFAULT_LABELS_CACHE_SIZE = 1024
+STRUCTURED_LABEL_KEYS = frozenset(("type", "name", "status"))
 loki_logger = logging.getLogger("chaostoolkit-loki")
+tracer: Optional[Tracer] = None
 
 
 def configure_control(
@@ -22,20 +55,97 @@ def configure_control(
     tags: Dict[str, str] = None,
     experiment_ref: str = None,
     trace_id: str = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    batch_interval: float = DEFAULT_BATCH_INTERVAL,
+    max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+    when_full: str = "drop",
+    line_format: str = "text",
+    max_output_size: int = DEFAULT_MAX_OUTPUT_SIZE,
+    compression: str = None,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+    spool_path: str = None,
+    spool_max_size: int = DEFAULT_SPOOL_MAX_SIZE,
+    traces_endpoint: str = None,
+    traces_headers: Dict[str, str] = None,
+    sinks: List[Dict[str, Any]] = None,
+    iterations: str = "each",
+    rollup_interval: float = DEFAULT_ROLLUP_INTERVAL,
+    rollup_size: int = 0,
 ) -> None:
     """
     Configure a Python logger that sends its messages to a Loki endpoint.
 
     * `loki_endpoint` is teh base url of your Loki service
+    * `sinks` a list of Loki services to send the logs to, in place of
+      `loki_endpoint`. Each is a mapping with the base `url` of the service
+      and, optionally, a unique `name` used in its delivery stats, which
+      defaults to the url host followed by the tenant, if any, such as
+      `loki.eu-team-a`, the `tenant` sent in the `X-Scope-OrgID` header, the
+      key of the `secrets` holding its `auth`, which defaults to `"auth"`,
+      `tags` overriding the labels of its logs and its own `spool_path`.
+      Every sink has its own buffer and background shipper so a slow or
+      unreachable one never holds the others back
     * `tags` a mapping of strings injected in all logs
     * `experiment_ref` a unique string identifying this experiment, if none
       is provided, a has of the experiment is created
     * `trace_id` a unique string for a particular run of the experiment, if
       none is provided, a random string is generated
+    * `batch_size` the maximum number of records sent to Loki in a single push
+    * `batch_interval` how long, in seconds, a record may wait in the buffer
+      before its batch is pushed even if it is not full
+    * `max_queue_size` the maximum number of records held in memory while
+      waiting to be pushed. The output of k6 may fill only half of it and is
+      always dropped, never waited for, when it cannot be buffered
+    * `when_full` what to do with a new record when the buffer is full:
+      `"drop"` discards it, `"block"` waits until there is room for it
+    * `line_format` either `"text"`, where every event field is sent as a
+      Loki label, or `"json"`/`"logfmt"` where only the event `type`, `name`
+      and `status` remain labels and all other fields are written to the log
+      line in that format
+    * `max_output_size` with a `"json"` or `"logfmt"` line format, the
+      maximum size, in bytes, of a single field in the log line. Larger
+      values, such as big activity outputs, are truncated
+    * `compression` either `"gzip"` to send gzip-compressed JSON pushes or
+      `"snappy"` to send snappy-compressed protobuf pushes. Without the
+      `python-snappy` package, the latter are framed as snappy, as Loki
+      expects, but not compressed. Pushes are not compressed when this is
+      not set
+    * `max_retries` how many times a failed push is retried, with an
+      exponential backoff starting at `retry_backoff` seconds, before giving
+      up on it. A `Retry-After` header sent by Loki is honoured
+    * `spool_path` a local file where pushes are appended when they could not
+      be delivered. They are replayed, in order, as soon as Loki is
+      reachable again, either during this run or the next one using the same
+      file. With many sinks, each spools to this path suffixed with its name
+      unless it sets its own. Its directory is created when missing. Pushes
+      which cannot be spooled are dropped and counted as such
+    * `spool_max_size` the size, in bytes, at which the spool file is rotated.
+      Only the last two rotated files are kept
+    * `traces_endpoint` the OTLP/HTTP traces URL of Tempo, or of a collector,
+      such as `http://tempo:4318/v1/traces`. When set, the run, its phases
+      and activities are also exported as spans of the `trace_id` trace,
+      derived from it when it is not a valid OpenTelemetry trace id. The
+      current span is passed to k6, whose bundled scripts send it in a
+      `traceparent` header
+    * `traces_headers` sent along with every export of spans
+    * `iterations` either `"each"`, logging every iteration of a continuous
+      steady-state hypothesis, or `"rollup"`, logging a single record for
+      all the iterations of the last `rollup_interval` seconds or, when
+      `rollup_size` is set, for every `rollup_size` iterations. With
+      `"rollup"`, iterations which deviated are still logged on their own
 
     This sends logs about the run events (started, finished, failed, etc.)
+    and, when the run finishes, an `extension-stats` event with what the
+    extension itself cost the run, as returned by the `get_extension_stats`
+    probe.
+
+    Records are pushed from a background thread so the experiment never waits
+    on Loki. The buffer is flushed when the experiment finishes, is
+    interrupted or receives an exit signal.
     """
     ctk_logger.debug("Add Loki handler to logger")
+    stats.reset()
 
     if event_registry is None:
         ctk_logger.debug(
@@ -45,8 +155,24 @@ def configure_control(
         )
         return
 
-    url = f"{loki_endpoint}/loki/api/v1/push"
-    auth = secrets.get("auth")
+    if line_format not in ("text", "json", "logfmt"):
+        raise ValueError(
+            "`line_format` must be one of 'text', 'json' or 'logfmt'"
+        )
+
+    if iterations not in ("each", "rollup"):
+        raise ValueError("`iterations` must be either 'each' or 'rollup'")
+
+    if compression not in (None, "gzip", "snappy"):
+        raise ValueError("`compression` must be either 'gzip' or 'snappy'")
+
+    if compression == "snappy" and not has_snappy():
+        ctk_logger.debug(
+            "Without the python-snappy package, protobuf Loki pushes are "
+            "framed as snappy but not compressed"
+        )
+
+    secrets = secrets or {}
     experiment_ref = experiment_ref or experiment_hash(experiment)
     trace_id = trace_id or token_hex(16)
     tags = tags or {}
@@ -63,16 +189,72 @@ def configure_control(
     if experiment_tags:
         tags.update(experiment_tags)
 
+    label_keys = None
+    if line_format != "text":
+        label_keys = STRUCTURED_LABEL_KEYS
+
     logging_loki.emitter.LokiEmitter.level_tag = "level"
-    handler = logging_loki.LokiHandler(
-        url=url, tags=tags, auth=auth, version="1"
-    )
-    handler.emitter = FixedLokiEmitterV1(url, tags, auth)
-    handler.setLevel(logging.INFO)
-    loki_logger.addHandler(handler)
+    handlers = []
+    for sink in _sinks(sinks, loki_endpoint, spool_path):
+        headers = {}
+        if sink.get("tenant"):
+            headers["X-Scope-OrgID"] = sink["tenant"]
+
+        spool = None
+        if sink.get("spool_path") and _spool_directory(sink["spool_path"]):
+            spool = LokiSpool(sink["spool_path"], max_size=spool_max_size)
+
+        handler = LokiBatchHandler(
+            FixedLokiEmitterV1(
+                f"{sink['url']}/loki/api/v1/push",
+                {**tags, **(sink.get("tags") or {})},
+                secrets.get(sink.get("auth") or "auth"),
+                label_keys=label_keys,
+                compression=compression,
+                headers=headers,
+            ),
+            batch_size=batch_size,
+            batch_interval=batch_interval,
+            max_queue_size=max_queue_size,
+            when_full=when_full,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
+            spool=spool,
+            name=sink["name"] if sinks else None,
+        )
+        if label_keys is not None:
+            handler.setFormatter(
+                StructuredFormatter(line_format, label_keys, max_output_size)
+            )
+        handler.setLevel(logging.INFO)
+        loki_logger.addHandler(handler)
+        handlers.append(handler)
     loki_logger.setLevel(logging.INFO)
 
-    event_registry.register(LokiRunEventHandler())
+    rollup = None
+    if iterations == "rollup":
+        rollup = IterationRollup(rollup_interval, rollup_size)
+    event_registry.register(LokiRunEventHandler(handlers, rollup))
+
+    if traces_endpoint:
+        global tracer
+        tracer = Tracer(
+            trace_id,
+            OTLPTraceExporter(
+                traces_endpoint,
+                traces_headers,
+                resource={
+                    "chaostoolkit_run_trace_id": trace_id,
+                    "chaostoolkit_experiment_ref": experiment_ref,
+                },
+            ),
+        )
+        tracer.start(
+            experiment.get("title") or "experiment",
+            attributes={"chaostoolkit.experiment.ref": experiment_ref},
+        )
+        event_registry.register(TracingRunEventHandler(tracer))
+        set_traceparent_source(tracer.traceparent)
 
     loki_logger.info(
         "Experiment started",
@@ -85,8 +267,29 @@ def configure_control(
     )
 
 
+def cleanup_control() -> None:
+    """
+    Push any pending record and span, and stop the background shippers.
+    """
+    handlers = [
+        h for h in loki_logger.handlers if isinstance(h, LokiBatchHandler)
+    ]
+    for handler in handlers:
+        loki_logger.removeHandler(handler)
+    _in_parallel([handler.close for handler in handlers])
+
+    global tracer
+    if tracer is not None:
+        set_traceparent_source(None)
+        tracer.close()
+        tracer = None
+
+
 def before_activity_control(context: Activity, *args, **kwargs) -> None:
     a = context
+    if tracer is not None:
+        tracer.start_activity(a)
+    set_activity(a["name"])
     loki_logger.info(
         f"Activity '{a['name']}' started",
         extra={
@@ -99,6 +302,9 @@ def after_activity_control(
     context: Activity, state: Run, *args, **kwargs
 ) -> None:
     a = context
+    if tracer is not None:
+        tracer.end_activity(a, state)
+    set_activity(None)
     loki_logger.info(
         f"Activity '{a['name']}' finished",
         extra={
@@ -119,10 +325,46 @@ def after_activity_control(
 ###############################################################################
 # Private functions
 ###############################################################################
+Entry = Tuple[int, logging.LogRecord, str]
+Labels = Tuple[Tuple[str, str], ...]
+
+
 class FixedLokiEmitterV1(logging_loki.emitter.LokiEmitter):
+    def __init__(
+        self,
+        url: str,
+        tags: Optional[dict] = None,
+        auth: logging_loki.emitter.BasicAuth = None,
+        label_keys: Optional[FrozenSet[str]] = None,
+        compression: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__(url, tags, auth)
+        #: When set, only these extra tags of a record become labels
+        self.label_keys = label_keys
+        #: Either `None`, `"gzip"` or `"snappy"`
+        self.compression = compression
+        #: Sent with every push, such as the `X-Scope-OrgID` tenant
+        self.headers = headers or {}
+        self._labels_cache: Dict[Tuple, Labels] = {}
+
+    @property
+    def session(self) -> requests.Session:
+        """Create a keep-alive HTTP session reused across all pushes."""
+        if self._session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=DEFAULT_POOL_SIZE
+            )
+            self._session = self.session_class()
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+            self._session.auth = self.auth or None
+            self._session.headers.update(self.headers)
+        return self._session
+
     def build_payload(self, record: logging.LogRecord, line) -> dict:
         """Build JSON payload with a log entry."""
-        labels = self.build_tags(record)
+        labels = dict(self.build_labels(record))
         ts = str(time.time_ns())
         stream = {
             "stream": labels,
@@ -130,8 +372,729 @@ class FixedLokiEmitterV1(logging_loki.emitter.LokiEmitter):
         }
         return {"streams": [stream]}
 
+    def build_batch_payload(self, entries: List[Entry]) -> dict:
+        """
+        Build JSON payload with many log entries, grouped into one stream per
+        distinct label set.
+        """
+        return {
+            "streams": [
+                {
+                    "stream": dict(labels),
+                    "values": [[str(ts), line] for ts, line in values],
+                }
+                for labels, values in self.group_entries(entries).items()
+            ]
+        }
+
+    def build_protobuf_payload(self, entries: List[Entry]) -> bytes:
+        """
+        Build a protobuf encoded Loki `PushRequest` with many log entries,
+        grouped into one stream per distinct label set.
+        """
+        streams = bytearray()
+        for labels, values in self.group_entries(entries).items():
+            stream = bytearray(pb_bytes(1, _format_labels(labels)))
+            for ts, line in values:
+                seconds, nanos = divmod(ts, 1_000_000_000)
+                timestamp = pb_varint(1, seconds) + pb_varint(2, nanos)
+                entry = pb_bytes(1, timestamp) + pb_bytes(2, line)
+                stream += pb_bytes(2, entry)
+            streams += pb_bytes(1, bytes(stream))
+        return bytes(streams)
+
+    def group_entries(
+        self, entries: List[Entry]
+    ) -> Dict[Labels, List[Tuple[int, str]]]:
+        """Group entries, in order, by their label set."""
+        streams: Dict[Labels, List[Tuple[int, str]]] = {}
+        for ts, record, line in entries:
+            labels = self.build_labels(record)
+            streams.setdefault(labels, []).append((ts, line))
+        return streams
+
+    def encode_batch(self, entries: List[Entry]) -> Tuple[bytes, dict]:
+        """
+        Return the body and headers of a push of these entries, compressed
+        according to the emitter's configuration.
+        """
+        if self.compression == "snappy":
+            body = snappy_compress(self.build_protobuf_payload(entries))
+            return body, {"Content-Type": "application/x-protobuf"}
+
+        return self.encode_payload(self.build_batch_payload(entries))
+
+    def encode_payload(self, payload: dict) -> Tuple[bytes, dict]:
+        """
+        Return the body and headers of a push of a JSON payload, gzipped when
+        the emitter is configured with any compression.
+        """
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.compression:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def build_labels(self, record: logging.LogRecord) -> Labels:
+        """
+        Return the canonical, sorted, label set of a record.
+
+        Label values are stringified as Loki expects and `None` values are
+        left out. Records sharing the same level, logger and extra tags share
+        the same, cached, label set.
+        """
+        extra_tags = getattr(record, "tags", None)
+        if not isinstance(extra_tags, dict):
+            extra_tags = {}
+
+        key = tuple(
+            (str(name), _label_value(value))
+            for name, value in extra_tags.items()
+            if self.label_keys is None or name in self.label_keys
+        )
+        cache_key = (record.levelname, record.name, key)
+        labels = self._labels_cache.get(cache_key)
+        if labels is None:
+            if len(self._labels_cache) >= DEFAULT_LABELS_CACHE_SIZE:
+                self._labels_cache.clear()
+            labels = self._labels_cache[cache_key] = self._canonical_labels(
+                *cache_key
+            )
+        return labels
+
+    def format_label(self, label: str) -> str:
+        # the parent caches it per instance, keeping every emitter alive,
+        # label sets are cached by `build_labels` already
+        return logging_loki.emitter.LokiEmitter.format_label.__wrapped__(
+            self, label
+        )
+
+    def _canonical_labels(
+        self, level: str, logger_name: str, extra_tags: Labels
+    ) -> Labels:
+        labels = {
+            str(name): _label_value(value) for name, value in self.tags.items()
+        }
+        labels[self.level_tag] = level.lower()
+        labels[self.logger_tag] = logger_name
+
+        for name, value in extra_tags:
+            cleared_name = self.format_label(name)
+            if cleared_name:
+                labels[cleared_name] = value
+
+        return tuple(sorted((n, v) for n, v in labels.items() if v is not None))
+
+    def emit_batch(self, entries: List[Entry]) -> int:
+        """Send many log records to Loki in a single push."""
+        return self.send(*self.encode_batch(entries))
+
+    def emit_payload(self, payload: dict) -> int:
+        """Send an already built JSON payload to Loki."""
+        return self.send(*self.encode_payload(payload))
+
+    def send(self, body: bytes, headers: dict) -> int:
+        """Push a body to Loki and return how many bytes were sent."""
+        with stats.timer("loki.push"):
+            resp = self.session.post(
+                self.url,
+                data=body,
+                headers=headers,
+                timeout=DEFAULT_PUSH_TIMEOUT,
+            )
+        if resp.status_code != self.success_response_code:
+            raise LokiPushError(
+                resp.status_code, _retry_after(resp.headers.get("Retry-After"))
+            )
+        return len(body)
+
+
+class LokiPushError(ValueError):
+    def __init__(self, status_code: int, retry_after: float = None):
+        super().__init__(
+            f"Unexpected Loki API response status code: {status_code}"
+        )
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status_code == 429 or self.status_code >= 500
+
+
+class LokiSpool:
+    """
+    Append-only local file of Loki JSON payloads that could not be delivered.
+
+    One payload is stored per line. When the file reaches `max_size` bytes it
+    is rotated, keeping at most `backups` older files. Payloads are replayed
+    oldest first.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = DEFAULT_SPOOL_MAX_SIZE,
+        backups: int = DEFAULT_SPOOL_BACKUPS,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+
+    def append(self, payload: dict) -> None:
+        line = json.dumps(payload).encode("utf-8") + b"\n"
+        if self._size(self.path) + len(line) > self.max_size:
+            self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(line)
+
+    def pending(self) -> bool:
+        return any(self._size(path) for path in self.files())
+
+    def files(self) -> List[str]:
+        """Spool files, oldest first."""
+        paths = [f"{self.path}.{i}" for i in range(self.backups, 0, -1)]
+        paths.append(self.path)
+        return [path for path in paths if os.path.exists(path)]
+
+    def replay(self, send: Callable[[dict], None]) -> bool:
+        """
+        Send every spooled payload, in order, and remove them as they are
+        delivered. Stops at the first failure and returns `False`.
+        """
+        for path in self.files():
+            with open(path, "rb") as f:
+                lines = f.readlines()
+
+            for index, line in enumerate(lines):
+                try:
+                    payload = json.loads(line)
+                except ValueError:
+                    ctk_logger.debug(f"Skipping corrupted line in {path}")
+                    continue
+
+                try:
+                    send(payload)
+                except Exception:
+                    with open(path, "wb") as f:
+                        f.writelines(lines[index:])
+                    return False
+
+            os.remove(path)
+        return True
+
+    def _rotate(self) -> None:
+        if self.backups < 1:
+            os.remove(self.path)
+            return
+
+        oldest = f"{self.path}.{self.backups}"
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if os.path.exists(self.path):
+            os.replace(self.path, f"{self.path}.1")
+
+    @staticmethod
+    def _size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+
+class LokiBatchHandler(logging.Handler):
+    """
+    Logging handler that buffers records and pushes them to Loki in batches
+    from a background thread.
+
+    A batch is pushed as soon as it holds `batch_size` records or its oldest
+    record has waited `batch_interval` seconds. When the buffer already holds
+    `max_queue_size` records, new records are either dropped or the caller
+    blocks until there is room, depending on `when_full`. The output of k6,
+    which can be far more verbose than the run itself, is dropped as soon as
+    the buffer is `k6_logs_share` full, so it never crowds out run events,
+    nor holds k6 back.
+
+    A failed push is retried up to `max_retries` times with an exponential,
+    jittered, backoff. When it still fails, it is appended to the `spool`, if
+    any, which is replayed before the next push. Pushes Loki rejects with a
+    4xx status, other than 429, are neither retried nor spooled but dropped,
+    as are the spooled ones on replay.
+
+    When the handler has a `name`, its delivery is also counted in the
+    extension stats under `loki.sinks.<name>`.
+    """
+
+    def __init__(
+        self,
+        emitter: FixedLokiEmitterV1,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        batch_interval: float = DEFAULT_BATCH_INTERVAL,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        when_full: str = "drop",
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+        spool: LokiSpool = None,
+        name: str = None,
+        k6_logs_share: float = DEFAULT_K6_LOGS_SHARE,
+    ):
+        super().__init__()
+        if when_full not in ("drop", "block"):
+            raise ValueError("`when_full` must be either 'drop' or 'block'")
+
+        self.emitter = emitter
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.when_full = when_full
+        self.max_retries = max(0, max_retries)
+        self.retry_backoff = retry_backoff
+        self.spool = spool
+        self.name = name
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.max_k6_logs = int(max_queue_size * k6_logs_share)
+        thread_name = "chaostoolkit-loki-shipper"
+        if name:
+            thread_name += f"-{name}"
+        self._worker = threading.Thread(
+            target=self._ship, name=thread_name, daemon=True
+        )
+        self._worker.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        started = time.perf_counter()
+        try:
+            # records may carry when they were produced, as k6 output does
+            ts = getattr(record, "time_ns", None) or time.time_ns()
+            block = self.when_full == "block"
+            tags = getattr(record, "tags", None) or {}
+            if tags.get("type") == "k6-log":
+                if self.queue.qsize() >= self.max_k6_logs:
+                    raise queue.Full()
+                block = False
+            entry = (ts, record, self.format(record))
+            self.queue.put(entry, block=block)
+            self._count("records_enqueued")
+        except queue.Full:
+            self.dropped += 1
+            self._count("records_dropped")
+        except Exception:
+            self.handleError(record)
+        stats.observe("loki.enqueue", time.perf_counter() - started)
+
+    def flush(self, timeout: float = DEFAULT_FLUSH_TIMEOUT) -> bool:
+        """
+        Push everything buffered so far and wait for it to be sent.
+
+        Returns `False` when the buffer could not be drained in time.
+        """
+        if not self._worker.is_alive():
+            return False
+
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        if self._worker.is_alive():
+            self.flush()
+            self.queue.put(None)
+            self._worker.join(DEFAULT_FLUSH_TIMEOUT)
+        self.emitter.close()
+        super().close()
+
+    def _ship(self) -> None:
+        batch = []
+        deadline = None
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0, deadline - time.monotonic())
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                batch = self._push(batch)
+                continue
+
+            if item is None:
+                if batch:
+                    self._push(batch)
+                return
+
+            if isinstance(item, threading.Event):
+                batch = self._push(batch)
+                item.set()
+                continue
+
+            if not batch:
+                deadline = time.monotonic() + self.batch_interval
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                batch = self._push(batch)
+
+    def _push(self, batch: List[Entry]) -> List[Entry]:
+        if self.spool is not None:
+            try:
+                replayed = not self.spool.pending() or self.spool.replay(
+                    self._replay
+                )
+            except OSError as x:
+                # an unreadable spool must not stop the live records
+                ctk_logger.error(f"Failed to replay the Loki spool: {x}")
+                self._count("spool_failures")
+                replayed = True
+            if not replayed:
+                self._spool(batch)
+                return []
+
+        if not batch:
+            return batch
+
+        try:
+            sent = self._send_with_retries(batch)
+            self._count("records_sent", len(batch))
+            self._count("bytes_sent", sent or 0)
+        except LokiPushError as x:
+            self._count("push_failures")
+            if x.retryable:
+                self._failed(batch)
+            else:
+                # sending it again, or spooling it, would only be rejected
+                self._reject(len(batch), x)
+        except Exception:
+            self._count("push_failures")
+            self._failed(batch)
+        return []
+
+    def _failed(self, batch: List[Entry]) -> None:
+        ctk_logger.debug(
+            f"Failed to push {len(batch)} records to Loki", exc_info=True
+        )
+        self.emitter.close()
+        if self.spool is not None:
+            self._spool(batch)
+
+    def _reject(self, records: int, error: LokiPushError) -> None:
+        ctk_logger.error(f"Loki rejected {records} records, dropping: {error}")
+        self.dropped += records
+        self._count("records_rejected", records)
+        self._count("records_dropped", records)
+
+    def _spool(self, batch: List[Entry]) -> None:
+        if not batch:
+            return
+
+        try:
+            self.spool.append(self.emitter.build_batch_payload(batch))
+        except OSError as x:
+            ctk_logger.error(
+                f"Failed to spool {len(batch)} Loki records, they are lost: {x}"
+            )
+            self.dropped += len(batch)
+            self._count("spool_failures")
+            self._count("records_dropped", len(batch))
+            return
+        self._count("records_spooled", len(batch))
+
+    def _count(self, counter: str, value: int = 1) -> None:
+        stats.inc(f"loki.{counter}", value)
+        if self.name:
+            stats.inc(f"loki.sinks.{self.name}.{counter}", value)
+
+    def _replay(self, payload: dict) -> None:
+        try:
+            self._count("bytes_sent", self.emitter.emit_payload(payload) or 0)
+        except LokiPushError as x:
+            if x.retryable:
+                raise
+            # a payload Loki rejects must not hold back the rest of the spool
+            records = sum(
+                len(s.get("values", [])) for s in payload.get("streams", [])
+            )
+            self._reject(records, x)
+
+    def _send_with_retries(self, batch: List[Entry]) -> int:
+        attempt = 0
+        while True:
+            try:
+                return self.emitter.emit_batch(batch)
+            except LokiPushError as x:
+                if not x.retryable or attempt >= self.max_retries:
+                    raise
+                delay = x.retry_after
+            except requests.RequestException:
+                if attempt >= self.max_retries:
+                    raise
+                delay = None
+
+            if delay is None:
+                backoff = self.retry_backoff * (2**attempt)
+                delay = random.uniform(0, min(backoff, DEFAULT_MAX_BACKOFF))
+            time.sleep(min(delay, DEFAULT_MAX_BACKOFF))
+            attempt += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Render a record and the extra tags that are not used as Loki labels as a
+    single JSON or logfmt log line.
+
+    Every field whose serialized value is larger than `max_output_size` bytes
+    is truncated and flagged with a `<field>_truncated` entry holding its
+    original size.
+
+    Records carrying a `fields` mapping, such as k6 results, are rendered as
+    those fields rather than their message, so LogQL can `unwrap` them.
+    """
+
+    def __init__(
+        self,
+        line_format: str = "json",
+        label_keys: FrozenSet[str] = STRUCTURED_LABEL_KEYS,
+        max_output_size: int = DEFAULT_MAX_OUTPUT_SIZE,
+    ):
+        super().__init__()
+        self.line_format = line_format
+        self.label_keys = label_keys
+        self.max_output_size = max_output_size
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None)
+        if isinstance(fields, dict):
+            fields = dict(fields)
+        else:
+            fields = {"message": record.getMessage()}
+
+        extra_tags = getattr(record, "tags", None)
+        if isinstance(extra_tags, dict):
+            for name, value in extra_tags.items():
+                if name in self.label_keys or value is None:
+                    continue
+                fields.update(self._field(name, value))
+
+        if self.line_format == "logfmt":
+            return " ".join(
+                f"{name}={_logfmt_value(value)}"
+                for name, value in fields.items()
+            )
+        return json.dumps(fields, default=str)
+
+    def _field(self, name: str, value: Any) -> Dict[str, Any]:
+        serialized = value
+        if not isinstance(value, str):
+            serialized = json.dumps(value, default=str)
+
+        encoded = serialized.encode("utf-8")
+        if len(encoded) <= self.max_output_size:
+            return {name: value}
+
+        truncated = encoded[: self.max_output_size]
+        return {
+            name: truncated.decode("utf-8", errors="ignore"),
+            f"{name}_truncated": len(encoded),
+        }
+
+
+def _logfmt_value(value: Any) -> str:
+    if not isinstance(value, str):
+        value = json.dumps(value, default=str)
+    if value and not any(c in value for c in ' ="\\\n'):
+        return value
+    return json.dumps(value)
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def _sinks(
+    sinks: Optional[List[Dict[str, Any]]],
+    loki_endpoint: str,
+    spool_path: Optional[str],
+) -> List[Dict[str, Any]]:
+    if not sinks:
+        return [{"url": loki_endpoint, "spool_path": spool_path}]
+
+    resolved = []
+    names = set()
+    spool_paths = set()
+    for sink in sinks:
+        if not sink.get("url"):
+            raise ValueError("Every Loki sink must have a `url`")
+        name = sink.get("name")
+        if not name:
+            name = urlsplit(sink["url"]).hostname
+            if sink.get("tenant"):
+                name = f"{name}-{sink['tenant']}"
+        if name in names:
+            raise ValueError(
+                f"Many Loki sinks are named '{name}', give each a unique `name`"
+            )
+        names.add(name)
+
+        sink = {**sink, "url": sink["url"].rstrip("/"), "name": name}
+        if not sink.get("spool_path") and spool_path:
+            sink["spool_path"] = f"{spool_path}.{name}"
+        if sink.get("spool_path"):
+            if sink["spool_path"] in spool_paths:
+                raise ValueError(
+                    f"Many Loki sinks spool to '{sink['spool_path']}'"
+                )
+            spool_paths.add(sink["spool_path"])
+        resolved.append(sink)
+    return resolved
+
+
+def _spool_directory(spool_path: str) -> bool:
+    directory = os.path.dirname(os.path.abspath(spool_path))
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as x:
+        ctk_logger.error(
+            f"Cannot create the Loki spool directory {directory}, undelivered "
+            f"pushes will not be spooled: {x}"
+        )
+        return False
+    if not os.access(directory, os.W_OK):
+        ctk_logger.error(
+            f"The Loki spool directory {directory} is not writable, "
+            "undelivered pushes will not be spooled"
+        )
+        return False
+    return True
+
+
+def _in_parallel(calls: List[Callable[[], Any]]) -> None:
+    if len(calls) == 1:
+        calls[0]()
+        return
+
+    threads = [threading.Thread(target=call, daemon=True) for call in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _failed_probes(state: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        p for p in state.get("probes", []) if p.get("tolerance_met") is False
+    ]
+
+
+def _probe_name(probe: Dict[str, Any]) -> str:
+    return (probe.get("activity") or {}).get("name") or "unknown"
+
+
+def _format_labels(labels: Labels) -> str:
+    pairs = []
+    for name, value in labels:
+        value = (
+            value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{value}"')
+    return "{" + ", ".join(pairs) + "}"
+
+
+def _label_value(value: Any) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return str(value)
+
+
+class IterationRollup:
+    """
+    Tally of the iterations of a continuous steady-state hypothesis, due
+    to be logged as a single record every `interval` seconds or, when `size`
+    is set, every `size` iterations.
+    """
+
+    def __init__(
+        self, interval: float = DEFAULT_ROLLUP_INTERVAL, size: int = 0
+    ):
+        self.interval = interval
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def add(
+        self,
+        iteration_index: int,
+        deviated: bool = False,
+        failed_probes: List[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Count an iteration and return the rollup when it is due"""
+        with self._lock:
+            if self.count == 0:
+                self.first = iteration_index
+                self.started = time.monotonic()
+            self.count += 1
+            self.last = iteration_index
+            if deviated:
+                self.failed += 1
+                self.failed_probes.update(failed_probes or [])
+
+            due = time.monotonic() - self.started >= self.interval
+            if self.size:
+                due = self.count >= self.size
+            if due:
+                return self._take()
+            return None
+
+    def take(self) -> Optional[Dict[str, Any]]:
+        """The rollup of the iterations counted so far, if any"""
+        with self._lock:
+            return self._take() if self.count else None
+
+    def _take(self) -> Dict[str, Any]:
+        rollup = {
+            "iterations": self.count,
+            "first_iteration": self.first,
+            "last_iteration": self.last,
+            "failed_iterations": self.failed,
+            "failed_probes": sorted(self.failed_probes) or None,
+        }
+        self._reset()
+        return rollup
+
+    def _reset(self) -> None:
+        self.count = 0
+        self.failed = 0
+        self.first = None
+        self.last = None
+        self.started = None
+        self.failed_probes = set()
+
 
 class LokiRunEventHandler(RunEventHandler):
+    def __init__(
+        self,
+        handlers: List[LokiBatchHandler] = None,
+        rollup: IterationRollup = None,
+    ):
+        self.handlers = handlers or []
+        self.rollup = rollup
+
     def finish(self, journal: Journal) -> None:
         loki_logger.info(
             "Experiment finished",
@@ -146,18 +1109,36 @@ class LokiRunEventHandler(RunEventHandler):
                 },
             },
         )
+        self.log_stats()
+        self.flush()
 
     def interrupted(self, experiment: Experiment, journal: Journal) -> None:
         loki_logger.info(
             "Experiment interrupted",
             extra={"tags": {"type": "experiment-interrupted"}},
         )
+        self.flush()
 
     def signal_exit(self) -> None:
         loki_logger.info(
             "Experiment exit signal received",
             extra={"tags": {"type": "experiment-exit-signal"}},
         )
+        self.flush()
+
+    def flush(self) -> None:
+        if self.rollup is not None:
+            self.log_rollup(self.rollup.take())
+        # sinks are flushed together, so the slowest one sets the pace
+        _in_parallel([handler.flush for handler in self.handlers])
+
+    def log_stats(self) -> None:
+        fields = stats.fields()
+        loki_logger.info(
+            "Extension stats: "
+            + " ".join(f"{k}={_logfmt_value(v)}" for k, v in fields.items()),
+            extra={"tags": {"type": "extension-stats"}, "fields": fields},
+        )
 
     def start_continuous_hypothesis(self, frequency: int) -> None:
         loki_logger.info(
@@ -168,13 +1149,50 @@ class LokiRunEventHandler(RunEventHandler):
     def continuous_hypothesis_iteration(
         self, iteration_index: int, state: Any
     ) -> None:
+        if self.rollup is None:
+            loki_logger.info(
+                f"Experiment steady state iteration {iteration_index}",
+                extra={
+                    "tags": {
+                        "type": "experiment-continuous-ssh-iteration",
+                        "iteration": iteration_index,
+                    }
+                },
+            )
+            return
+
+        deviated = (
+            isinstance(state, dict) and state.get("steady_state_met") is False
+        )
+        failed = _failed_probes(state) if deviated else []
+        if deviated:
+            loki_logger.info(
+                f"Experiment steady state iteration {iteration_index} "
+                "deviated",
+                extra={
+                    "tags": {
+                        "type": "experiment-continuous-ssh-iteration",
+                        "iteration": iteration_index,
+                        "state_met": False,
+                        "failed_probe": failed[0] if failed else None,
+                    }
+                },
+            )
+        self.log_rollup(
+            self.rollup.add(
+                iteration_index, deviated, [_probe_name(p) for p in failed]
+            )
+        )
+
+    def log_rollup(self, rollup: Optional[Dict[str, Any]]) -> None:
+        if rollup is None:
+            return
         loki_logger.info(
-            f"Experiment steady state iteration {iteration_index}",
+            f"Experiment steady state iterations {rollup['first_iteration']} "
+            f"to {rollup['last_iteration']}, {rollup['failed_iterations']} "
+            "deviated",
             extra={
-                "tags": {
-                    "type": "experiment-continuous-ssh-iteration",
-                    "iteration": iteration_index,
-                }
+                "tags": {"type": "experiment-continuous-ssh-rollup", **rollup}
             },
         )
 
@@ -184,6 +1202,8 @@ class LokiRunEventHandler(RunEventHandler):
         journal: Journal,
         exception: Exception = None,
     ) -> None:
+        if self.rollup is not None:
+            self.log_rollup(self.rollup.take())
         loki_logger.info(
             "Experiment continuous steady state completed",
             extra={"tags": {"type": "experiment-continuous-ssh-completed"}},
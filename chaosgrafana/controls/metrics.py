@@ -0,0 +1,572 @@
+import bisect
+import threading
+import time
+from secrets import token_hex
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import requests
+from chaoslib import experiment_hash
+from chaoslib.run import EventHandlerRegistry, RunEventHandler
+from chaoslib.types import Activity, Experiment, Journal, Run, Secrets
+from logzero import logger as ctk_logger
+
+from .. import __version__
+from .protobuf import pb_bytes, pb_double, pb_varint, snappy_compress
+
+__all__ = ["configure_control"]
+DEFAULT_PROTOCOL = "remote_write"
+DEFAULT_ENDPOINTS = {
+    "remote_write": "http://localhost:9090/api/v1/write",
+    "otlp": "http://localhost:4318/v1/metrics",
+}
+DEFAULT_PUSH_INTERVAL = 15.0
+DEFAULT_PUSH_TIMEOUT = 10.0
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def configure_control(
+    experiment: Experiment,
+    secrets: Secrets = None,
+    event_registry: EventHandlerRegistry = None,
+    endpoint: str = None,
+    protocol: str = DEFAULT_PROTOCOL,
+    headers: Dict[str, str] = None,
+    labels: Dict[str, str] = None,
+    experiment_ref: str = None,
+    trace_id: str = None,
+    push_interval: float = DEFAULT_PUSH_INTERVAL,
+    buckets: List[float] = None,
+) -> None:
+    """
+    Record the run events as metrics and push them to a Prometheus
+    remote-write or an OTLP/HTTP endpoint, such as Mimir or an OpenTelemetry
+    collector.
+
+    * `endpoint` the URL metrics are pushed to, by default the remote-write
+      receiver of a local Prometheus or a local OTLP/HTTP collector
+    * `protocol` either `"remote_write"`, pushing snappy-compressed protobuf,
+      or `"otlp"`, pushing OTLP/HTTP JSON
+    * `headers` sent with every push, for instance `X-Scope-OrgID`
+    * `labels` a mapping of strings added to every series
+    * `experiment_ref` a unique string identifying this experiment, if none
+      is provided, a hash of the experiment is created
+    * `trace_id` a unique string for a particular run of the experiment, if
+      none is provided, a random string is generated. Pass the one given to
+      the Loki control to cross-reference metrics and logs
+    * `push_interval` how often, in seconds, metrics are pushed while the
+      experiment runs
+    * `buckets` the upper bounds, in seconds, of the duration histograms
+
+    This records histograms of the activity and phase durations, counters of
+    the failed activities and steady-state deviations, and gauges of the
+    phases in flight.
+
+    Series are cumulative, so a failed push loses nothing: the next one
+    carries it. Metrics are pushed from a background thread and once more
+    when the experiment finishes, is interrupted or receives an exit signal.
+    """
+    if event_registry is None:
+        ctk_logger.debug(
+            "You may be using an older version of chaostoolkit-lib, make sure "
+            "you run at least 1.26.0. The Grafana extension will not "
+            "be enabled"
+        )
+        return
+
+    if protocol not in DEFAULT_ENDPOINTS:
+        raise ValueError("`protocol` must be either 'remote_write' or 'otlp'")
+
+    static_labels = dict(labels or {})
+    static_labels.update(
+        {
+            "job": "chaostoolkit",
+            "chaostoolkit_run_trace_id": trace_id or token_hex(16),
+            "chaostoolkit_experiment_ref": experiment_ref
+            or experiment_hash(experiment),
+        }
+    )
+
+    exporter_class = (
+        RemoteWriteExporter if protocol == "remote_write" else OTLPExporter
+    )
+    exporter = exporter_class(
+        endpoint or DEFAULT_ENDPOINTS[protocol], static_labels, headers
+    )
+
+    registry.reset(buckets or DEFAULT_BUCKETS)
+    global pusher
+    if pusher is not None:
+        pusher.close()
+    pusher = MetricsPusher(registry, exporter, push_interval)
+    pusher.start()
+
+    event_registry.register(MetricsRunEventHandler(registry, pusher))
+
+
+def cleanup_control() -> None:
+    """
+    Push the metrics a last time and stop the background pusher.
+    """
+    global pusher
+    if pusher is not None:
+        pusher.close()
+        pusher = None
+
+
+def before_activity_control(context: Activity, *args, **kwargs) -> None:
+    registry.adjust(
+        "chaostoolkit_activities_in_flight", 1, {"type": context.get("type")}
+    )
+
+
+def after_activity_control(
+    context: Activity, state: Run, *args, **kwargs
+) -> None:
+    labels = {
+        "name": context.get("name"),
+        "type": context.get("type"),
+        "status": state.get("status"),
+    }
+    registry.adjust(
+        "chaostoolkit_activities_in_flight", -1, {"type": context.get("type")}
+    )
+    registry.observe(
+        "chaostoolkit_activity_duration_seconds", state["duration"], labels
+    )
+    if state.get("status") == "failed":
+        registry.inc(
+            "chaostoolkit_activity_failures_total",
+            labels={"name": labels["name"], "type": labels["type"]},
+        )
+
+
+###############################################################################
+# Private functions
+###############################################################################
+Labels = Tuple[Tuple[str, str], ...]
+Key = Tuple[str, Labels]
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket upper bounds."""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        """Counts of observations at or below each bound, then in total."""
+        counts, total = [], 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class MetricsRegistry:
+    """
+    In-memory, thread-safe, store of the histograms, counters and gauges of
+    the run, keyed by name and label set.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.reset(buckets)
+
+    def reset(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.histograms: Dict[Key, Histogram] = {}
+        self.counters: Dict[Key, float] = {}
+        self.gauges: Dict[Key, float] = {}
+        self.started = time.time_ns()
+        self._lock = threading.Lock()
+
+    def observe(
+        self, name: str, value: float, labels: Dict[str, Any] = None
+    ) -> None:
+        key = (name, _labels(labels or {}))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(
+        self, name: str, value: float = 1, labels: Dict[str, Any] = None
+    ) -> None:
+        key = (name, _labels(labels or {}))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def adjust(
+        self, name: str, delta: float, labels: Dict[str, Any] = None
+    ) -> None:
+        key = (name, _labels(labels or {}))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def snapshot(self) -> Dict[str, Any]:
+        """A copy of every series, safe to encode while the run goes on."""
+        with self._lock:
+            histograms = {}
+            for key, h in self.histograms.items():
+                copy = Histogram(h.bounds)
+                copy.counts, copy.sum, copy.count = (
+                    list(h.counts),
+                    h.sum,
+                    h.count,
+                )
+                histograms[key] = copy
+            return {
+                "started": self.started,
+                "histograms": histograms,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+
+class RemoteWriteExporter:
+    """
+    Push series as a snappy-compressed protobuf Prometheus remote-write
+    `WriteRequest`. Histograms are sent as classic `_bucket`, `_sum` and
+    `_count` series.
+    """
+
+    def __init__(
+        self, url: str, labels: Dict[str, str], headers: Dict[str, str] = None
+    ):
+        self.url = url
+        self.labels = labels
+        self.headers = {
+            **(headers or {}),
+            "Content-Type": "application/x-protobuf",
+            "Content-Encoding": "snappy",
+            "X-Prometheus-Remote-Write-Version": "0.1.0",
+        }
+        self.session = requests.Session()
+
+    def export(self, snapshot: Dict[str, Any]) -> None:
+        response = self.session.post(
+            self.url,
+            data=snappy_compress(self.encode(snapshot)),
+            headers=self.headers,
+            timeout=DEFAULT_PUSH_TIMEOUT,
+        )
+        response.raise_for_status()
+
+    def encode(self, snapshot: Dict[str, Any]) -> bytes:
+        now = int(time.time() * 1000)
+        request = bytearray()
+        for name, labels, value in self.samples(snapshot):
+            series = bytearray()
+            for label, label_value in sorted(
+                {**self.labels, **dict(labels), "__name__": name}.items()
+            ):
+                series += pb_bytes(
+                    1, pb_bytes(1, label) + pb_bytes(2, label_value)
+                )
+            series += pb_bytes(2, pb_double(1, value) + pb_varint(2, now))
+            request += pb_bytes(1, bytes(series))
+        return bytes(request)
+
+    @staticmethod
+    def samples(snapshot: Dict[str, Any]):
+        for (name, labels), value in snapshot["counters"].items():
+            yield name, labels, value
+        for (name, labels), value in snapshot["gauges"].items():
+            yield name, labels, value
+        for (name, labels), histogram in snapshot["histograms"].items():
+            bounds = [_format_bound(b) for b in histogram.bounds] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.cumulative()):
+                yield f"{name}_bucket", labels + (("le", bound),), count
+            yield f"{name}_sum", labels, histogram.sum
+            yield f"{name}_count", labels, histogram.count
+
+
+class OTLPExporter:
+    """
+    Push series as an OTLP/HTTP JSON `ExportMetricsServiceRequest`, with
+    cumulative temporality.
+    """
+
+    def __init__(
+        self, url: str, labels: Dict[str, str], headers: Dict[str, str] = None
+    ):
+        self.url = url
+        self.labels = labels
+        self.headers = {**(headers or {}), "Content-Type": "application/json"}
+        self.session = requests.Session()
+
+    def export(self, snapshot: Dict[str, Any]) -> None:
+        response = self.session.post(
+            self.url,
+            json=self.encode(snapshot),
+            headers=self.headers,
+            timeout=DEFAULT_PUSH_TIMEOUT,
+        )
+        response.raise_for_status()
+
+    def encode(self, snapshot: Dict[str, Any]) -> Dict[str, Any]:
+        now = str(time.time_ns())
+        start = str(snapshot["started"])
+        metrics: Dict[str, Dict[str, Any]] = {}
+
+        def point(labels: Labels) -> Dict[str, Any]:
+            return {
+                "attributes": _attributes(dict(labels)),
+                "startTimeUnixNano": start,
+                "timeUnixNano": now,
+            }
+
+        for (name, labels), value in snapshot["counters"].items():
+            metric = metrics.setdefault(
+                name,
+                {
+                    "name": name,
+                    "sum": {
+                        "dataPoints": [],
+                        "aggregationTemporality": 2,
+                        "isMonotonic": True,
+                    },
+                },
+            )
+            metric["sum"]["dataPoints"].append(
+                {**point(labels), "asDouble": value}
+            )
+
+        for (name, labels), value in snapshot["gauges"].items():
+            metric = metrics.setdefault(
+                name, {"name": name, "gauge": {"dataPoints": []}}
+            )
+            metric["gauge"]["dataPoints"].append(
+                {**point(labels), "asDouble": value}
+            )
+
+        for (name, labels), histogram in snapshot["histograms"].items():
+            metric = metrics.setdefault(
+                name,
+                {
+                    "name": name,
+                    "unit": "s",
+                    "histogram": {
+                        "dataPoints": [],
+                        "aggregationTemporality": 2,
+                    },
+                },
+            )
+            metric["histogram"]["dataPoints"].append(
+                {
+                    **point(labels),
+                    "count": str(histogram.count),
+                    "sum": histogram.sum,
+                    "bucketCounts": [str(c) for c in histogram.counts],
+                    "explicitBounds": list(histogram.bounds),
+                }
+            )
+
+        return {
+            "resourceMetrics": [
+                {
+                    "resource": {
+                        "attributes": _attributes(
+                            {"service.name": "chaostoolkit", **self.labels}
+                        )
+                    },
+                    "scopeMetrics": [
+                        {
+                            "scope": {
+                                "name": "chaosgrafana",
+                                "version": __version__,
+                            },
+                            "metrics": list(metrics.values()),
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+class MetricsPusher:
+    """
+    Background thread pushing the whole registry every `interval` seconds.
+    Failed pushes are logged and not retried since the next one carries the
+    same, cumulative, series.
+    """
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        exporter: Any,
+        interval: float = DEFAULT_PUSH_INTERVAL,
+    ):
+        self.registry = registry
+        self.exporter = exporter
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._push_lock = threading.Lock()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="chaosgrafana-metrics", daemon=True
+        )
+        self._thread.start()
+
+    def flush(self) -> bool:
+        """Push the registry now and tell whether it was delivered."""
+        with self._push_lock:
+            try:
+                self.exporter.export(self.registry.snapshot())
+            except Exception as x:
+                ctk_logger.debug(f"Failed to push metrics: {x}")
+                return False
+            return True
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+
+class MetricsRunEventHandler(RunEventHandler):
+    def __init__(self, registry: MetricsRegistry, pusher: MetricsPusher = None):
+        self.registry = registry
+        self.pusher = pusher
+        self._phases: Dict[str, float] = {}
+
+    def finish(self, journal: Journal) -> None:
+        self.registry.inc(
+            "chaostoolkit_experiments_total",
+            labels={"status": journal.get("status")},
+        )
+        if journal.get("duration") is not None:
+            self.registry.observe(
+                "chaostoolkit_experiment_duration_seconds",
+                journal["duration"],
+                {"status": journal.get("status")},
+            )
+        self.flush()
+
+    def interrupted(self, experiment: Experiment, journal: Journal) -> None:
+        self.flush()
+
+    def signal_exit(self) -> None:
+        self.flush()
+
+    def flush(self) -> None:
+        if self.pusher is not None:
+            self.pusher.flush()
+
+    def start_continuous_hypothesis(self, frequency: int) -> None:
+        self._start("continuous_hypothesis")
+
+    def continuous_hypothesis_iteration(
+        self, iteration_index: int, state: Any
+    ) -> None:
+        self.registry.inc("chaostoolkit_continuous_hypothesis_iterations_total")
+        if isinstance(state, dict):
+            self._deviated("continuous_hypothesis", state)
+
+    def continuous_hypothesis_completed(
+        self,
+        experiment: Experiment,
+        journal: Journal,
+        exception: Exception = None,
+    ) -> None:
+        self._complete("continuous_hypothesis")
+
+    def start_hypothesis_before(self, experiment: Experiment) -> None:
+        self._start("hypothesis_before")
+
+    def hypothesis_before_completed(
+        self, experiment: Experiment, state: Dict[str, Any], journal: Journal
+    ) -> None:
+        self._complete("hypothesis_before")
+        self._deviated("hypothesis_before", state)
+
+    def start_hypothesis_after(self, experiment: Experiment) -> None:
+        self._start("hypothesis_after")
+
+    def hypothesis_after_completed(
+        self, experiment: Experiment, state: Dict[str, Any], journal: Journal
+    ) -> None:
+        self._complete("hypothesis_after")
+        self._deviated("hypothesis_after", state)
+
+    def start_method(self, experiment: Experiment) -> None:
+        self._start("method")
+
+    def method_completed(self, experiment: Experiment, state: Any) -> None:
+        self._complete("method")
+
+    def start_rollbacks(self, experiment: Experiment) -> None:
+        self._start("rollbacks")
+
+    def rollbacks_completed(
+        self, experiment: Experiment, journal: Journal
+    ) -> None:
+        self._complete("rollbacks")
+
+    def start_cooldown(self, duration: int) -> None:
+        self._start("cooldown")
+
+    def cooldown_completed(self) -> None:
+        self._complete("cooldown")
+
+    def _start(self, phase: str) -> None:
+        self._phases[phase] = time.monotonic()
+        self.registry.adjust(
+            "chaostoolkit_phases_in_flight", 1, {"phase": phase}
+        )
+
+    def _complete(self, phase: str) -> None:
+        started = self._phases.pop(phase, None)
+        if started is None:
+            return
+        self.registry.adjust(
+            "chaostoolkit_phases_in_flight", -1, {"phase": phase}
+        )
+        self.registry.observe(
+            "chaostoolkit_phase_duration_seconds",
+            time.monotonic() - started,
+            {"phase": phase},
+        )
+
+    def _deviated(self, phase: str, state: Optional[Dict[str, Any]]) -> None:
+        if state and state.get("steady_state_met") is False:
+            self.registry.inc(
+                "chaostoolkit_deviations_total", labels={"phase": phase}
+            )
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(
+        sorted((n, str(v)) for n, v in labels.items() if v is not None)
+    )
+
+
+def _attributes(labels: Dict[str, str]) -> List[Dict[str, Any]]:
+    return [
+        {"key": name, "value": {"stringValue": str(value)}}
+        for name, value in labels.items()
+    ]
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound)) if bound != int(bound) else f"{int(bound)}.0"
+
+
+registry = MetricsRegistry()
+pusher: Optional[MetricsPusher] = None
@@ -0,0 +1,76 @@
+""" Hand-rolled protobuf and snappy encoding of the push payloads """
+import struct
+from typing import Any
+
+__all__ = [
+    "has_snappy",
+    "pb_bytes",
+    "pb_double",
+    "pb_varint",
+    "snappy_compress",
+    "varint",
+]
+
+
+def has_snappy() -> bool:
+    """Tell whether the optional python-snappy package is available."""
+    try:
+        import snappy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def snappy_compress(data: bytes) -> bytes:
+    """
+    Snappy-compress `data` with python-snappy when it is installed.
+
+    Otherwise `data` is framed as a valid, but uncompressed, snappy block
+    made of literals only, which any snappy decoder reads.
+    """
+    if has_snappy():
+        import snappy
+
+        return snappy.compress(data)
+
+    block = bytearray(varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start : start + 65536]  # noqa: E203
+        size = len(chunk) - 1
+        if size < 60:
+            block.append(size << 2)
+        elif size < 256:
+            block += bytes((60 << 2, size))
+        else:
+            block += bytes((61 << 2,)) + size.to_bytes(2, "little")
+        block += chunk
+    return bytes(block)
+
+
+def pb_varint(field: int, value: int) -> bytes:
+    return varint(field << 3) + varint(value)
+
+
+def pb_bytes(field: int, value: Any) -> bytes:
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return varint(field << 3 | 2) + varint(len(value)) + value
+
+
+def pb_double(field: int, value: float) -> bytes:
+    return varint(field << 3 | 1) + struct.pack("<d", value)
+
+
+def varint(value: int) -> bytes:
+    if value < 0:
+        # negative int64 are encoded on ten bytes, as two's complement
+        value += 1 << 64
+    encoded = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(bits | 0x80)
+        else:
+            encoded.append(bits)
+            return bytes(encoded)
@@ -0,0 +1,373 @@
+import hashlib
+import re
+import threading
+import time
+from secrets import token_hex
+from typing import Any, Dict, List, Optional
+
+import requests
+from chaoslib.run import RunEventHandler
+from chaoslib.types import Activity, Experiment, Journal, Run
+from logzero import logger as ctk_logger
+
+from .. import __version__
+
+__all__ = ["Span", "Tracer", "OTLPTraceExporter", "TracingRunEventHandler"]
+DEFAULT_BATCH_SIZE = 512
+DEFAULT_EXPORT_INTERVAL = 5.0
+DEFAULT_EXPORT_TIMEOUT = 10.0
+SPAN_KIND_INTERNAL = 1
+STATUS_OK = 1
+STATUS_ERROR = 2
+# Phases chaoslib runs from a thread of their own, alongside the others
+THREADED_PHASES = frozenset(["continuous-steady-state"])
+
+
+class Span:
+    """A single timed operation of the run, in OpenTelemetry terms."""
+
+    def __init__(
+        self,
+        trace_id: str,
+        name: str,
+        parent: "Span" = None,
+        attributes: Dict[str, Any] = None,
+    ):
+        self.trace_id = trace_id
+        self.span_id = token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    @property
+    def traceparent(self) -> str:
+        """The W3C `traceparent` header of this span."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": _attributes(self.attributes),
+            "status": {"code": STATUS_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return span
+
+
+class OTLPTraceExporter:
+    """Send spans to an OTLP/HTTP endpoint, such as Tempo, as JSON."""
+
+    def __init__(
+        self,
+        url: str,
+        headers: Dict[str, str] = None,
+        resource: Dict[str, Any] = None,
+    ):
+        self.url = url
+        self.headers = {**(headers or {}), "Content-Type": "application/json"}
+        self.resource = {"service.name": "chaostoolkit", **(resource or {})}
+        self.session = requests.Session()
+
+    def export(self, spans: List[Span]) -> None:
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": _attributes(self.resource)},
+                    "scopeSpans": [
+                        {
+                            "scope": {
+                                "name": "chaosgrafana",
+                                "version": __version__,
+                            },
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        response = self.session.post(
+            self.url,
+            json=payload,
+            headers=self.headers,
+            timeout=DEFAULT_EXPORT_TIMEOUT,
+        )
+        response.raise_for_status()
+
+
+class Tracer:
+    """
+    Record the spans of a run, all in the same trace, and export the ended
+    ones in batches from a background thread, every `interval` seconds or as
+    soon as `batch_size` of them are pending.
+
+    `traceparent()` tells the span the calling thread runs in, so k6, started
+    from an activity, sends it along with its requests.
+
+    Phases are open by name, as the continuous steady-state hypothesis runs,
+    from a thread of its own, alongside the other phases. Activities are
+    children of the phase started from their thread or, for background
+    activities, of the latest phase which does not run in a thread of its
+    own.
+    """
+
+    def __init__(
+        self,
+        trace_id: str,
+        exporter: OTLPTraceExporter,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        interval: float = DEFAULT_EXPORT_INTERVAL,
+    ):
+        self.trace_id = to_trace_id(trace_id)
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.interval = interval
+        self.root: Optional[Span] = None
+        self._phases: Dict[str, Span] = {}
+        self._phase_threads: Dict[int, str] = {}
+        self._activities: Dict[int, Span] = {}
+        self._thread_activities: Dict[int, Span] = {}
+        self._pending: List[Span] = []
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="chaosgrafana-traces", daemon=True
+        )
+
+    def start(self, name: str, attributes: Dict[str, Any] = None) -> Span:
+        """Start the root span of the run and the export thread."""
+        self.root = Span(self.trace_id, name, attributes=attributes)
+        self._thread.start()
+        return self.root
+
+    def start_phase(self, name: str) -> Span:
+        phase = Span(self.trace_id, name, parent=self.root)
+        with self._lock:
+            self._phases[name] = phase
+            self._phase_threads[threading.get_ident()] = name
+        return phase
+
+    def end_phase(self, name: str, error: str = None) -> None:
+        with self._lock:
+            phase = self._phases.pop(name, None)
+            for ident in [
+                i for i, n in self._phase_threads.items() if n == name
+            ]:
+                del self._phase_threads[ident]
+        if phase is not None:
+            self.end_span(phase, error)
+
+    def current_phase(self) -> Optional[Span]:
+        """The phase the activities of the calling thread belong to"""
+        with self._lock:
+            name = self._phase_threads.get(threading.get_ident())
+            if name in self._phases:
+                return self._phases[name]
+            for name in reversed(list(self._phases)):
+                if name not in THREADED_PHASES:
+                    return self._phases[name]
+        return None
+
+    def traceparent(self) -> Optional[str]:
+        """
+        The `traceparent` of the activity the calling thread runs or, outside
+        of any, of its phase
+        """
+        with self._lock:
+            span = self._thread_activities.get(threading.get_ident())
+        span = span or self.current_phase() or self.root
+        return span.traceparent if span is not None else None
+
+    def start_activity(self, activity: Activity) -> Span:
+        span = Span(
+            self.trace_id,
+            activity.get("name", "activity"),
+            parent=self.current_phase() or self.root,
+            attributes={
+                "chaostoolkit.activity.name": activity.get("name"),
+                "chaostoolkit.activity.type": activity.get("type"),
+            },
+        )
+        with self._lock:
+            self._activities[id(activity)] = span
+            self._thread_activities[threading.get_ident()] = span
+        return span
+
+    def end_activity(self, activity: Activity, state: Run) -> None:
+        with self._lock:
+            span = self._activities.pop(id(activity), None)
+            for ident in [
+                i for i, s in self._thread_activities.items() if s is span
+            ]:
+                del self._thread_activities[ident]
+        if span is None:
+            return
+
+        span.attributes["chaostoolkit.activity.status"] = state.get("status")
+        error = None
+        if state.get("status") == "failed":
+            error = str(state.get("exception") or "failed")
+        self.end_span(span, error)
+
+    def end_span(self, span: Span, error: str = None) -> None:
+        span.end = time.time_ns()
+        span.error = error
+        with self._lock:
+            self._pending.append(span)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self) -> bool:
+        """Export the ended spans now and tell whether they were sent."""
+        with self._export_lock:
+            with self._lock:
+                spans, self._pending = self._pending, []
+            if not spans:
+                return True
+            try:
+                self.exporter.export(spans)
+            except Exception as x:
+                ctk_logger.debug(f"Failed to export {len(spans)} spans: {x}")
+                return False
+            return True
+
+    def close(self, error: str = None) -> None:
+        """End the root span, export everything left and stop."""
+        if self.root is not None and self.root.end is None:
+            with self._lock:
+                names = list(self._phases)
+            for name in names:
+                self.end_phase(name, error)
+            self.end_span(self.root, error)
+
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class TracingRunEventHandler(RunEventHandler):
+    """Turn the run events into spans of the tracer's trace."""
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+
+    def finish(self, journal: Journal) -> None:
+        root = self.tracer.root
+        if root is not None:
+            root.attributes["chaostoolkit.status"] = journal.get("status")
+            root.attributes["chaostoolkit.deviated"] = journal.get("deviated")
+        error = None
+        if journal.get("status") == "failed":
+            error = "Experiment failed"
+        self.tracer.close(error)
+
+    def interrupted(self, experiment: Experiment, journal: Journal) -> None:
+        self.tracer.close("Experiment interrupted")
+
+    def signal_exit(self) -> None:
+        self.tracer.close("Exit signal received")
+
+    def start_continuous_hypothesis(self, frequency: int) -> None:
+        self.tracer.start_phase("continuous-steady-state")
+
+    def continuous_hypothesis_completed(
+        self,
+        experiment: Experiment,
+        journal: Journal,
+        exception: Exception = None,
+    ) -> None:
+        self.tracer.end_phase(
+            "continuous-steady-state", str(exception) if exception else None
+        )
+
+    def start_hypothesis_before(self, experiment: Experiment) -> None:
+        self.tracer.start_phase("steady-state-before")
+
+    def hypothesis_before_completed(
+        self, experiment: Experiment, state: Dict[str, Any], journal: Journal
+    ) -> None:
+        self.tracer.end_phase("steady-state-before", _deviation(state))
+
+    def start_hypothesis_after(self, experiment: Experiment) -> None:
+        self.tracer.start_phase("steady-state-after")
+
+    def hypothesis_after_completed(
+        self, experiment: Experiment, state: Dict[str, Any], journal: Journal
+    ) -> None:
+        self.tracer.end_phase("steady-state-after", _deviation(state))
+
+    def start_method(self, experiment: Experiment) -> None:
+        self.tracer.start_phase("method")
+
+    def method_completed(self, experiment: Experiment, state: Any) -> None:
+        self.tracer.end_phase("method")
+
+    def start_rollbacks(self, experiment: Experiment) -> None:
+        self.tracer.start_phase("rollbacks")
+
+    def rollbacks_completed(
+        self, experiment: Experiment, journal: Journal
+    ) -> None:
+        self.tracer.end_phase("rollbacks")
+
+    def start_cooldown(self, duration: int) -> None:
+        self.tracer.start_phase("cooldown")
+
+    def cooldown_completed(self) -> None:
+        self.tracer.end_phase("cooldown")
+
+
+def to_trace_id(value: str) -> str:
+    """
+    Return `value` when it is a valid OpenTelemetry trace id, 32 lowercase
+    hexadecimal characters, or a trace id derived from it otherwise.
+    """
+    if re.fullmatch(r"[0-9a-f]{32}", value) and value != "0" * 32:
+        return value
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    encoded = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        encoded.append({"key": key, "value": typed})
+    return encoded
+
+
+def _deviation(state: Optional[Dict[str, Any]]) -> Optional[str]:
+    if state and state.get("steady_state_met") is False:
+        return "Steady state deviated"
+    return None
@@ -1,12 +1,20 @@
-import os
+import subprocess
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, List
 
 from logzero import logger
 
-from .driver import K6, GenericOpt, Stage
+from .driver import K6, GenericOpt, Stage, get_run, register_run
+from .thresholds import parse_thresholds
 
-__all__ = ["run_script", "stress_endpoint"]
+__all__ = [
+    "run_script",
+    "stress_endpoint",
+    "start_script",
+    "start_stress",
+    "wait_for_run",
+    "stop_run",
+]
 
 
 def run_script(
@@ -18,12 +26,19 @@ def run_script(
     log_file: str = None,
     debug: bool = False,
     environ: Dict = None,
-):
+    stream_metrics: bool = False,
+    distributed: bool = False,
+    processes: int = None,
+    thresholds: List[Dict[str, str]] = None,
+    stream_logs: bool = False,
+    archive: bool = False,
+) -> Dict[str, Any]:
     """
     Run an arbitrary k6 script with a configurable amount of VUs and duration.
     Depending on the specs of the attacking machine, possible VU amount may
     vary.
-    For a non-customized 2019 Macbook Pro, it will cap around 250 +/- 50.
+    For a non-customized 2019 Macbook Pro, it will cap around 250 +/- 50 with
+    a single k6 process. Use `distributed` to go beyond.
 
     Parameters
     ----------
@@ -41,24 +56,50 @@ def run_script(
       (Optional) Relative path to the file where output should be logged.
     environ: dict
       (Optional) Environment override used when running the script
+    stream_metrics: bool
+      (Optional) Aggregate k6 samples while it runs, logging the last 10s of
+      latency and throughput periodically. Memory use does not grow with the
+      duration of the run.
+    distributed: bool
+      (Optional) Split the VUs, stages or iterations across many local k6
+      processes, each running its own execution segment of the test
+    processes: int
+      (Optional) How many k6 processes to use when `distributed`, defaults
+      to the number of CPUs
+    thresholds: list
+      (Optional) Conditions checked every second against the live metrics,
+      k6 being stopped as soon as one is not met. Each has a `metric`, a
+      k6-like `threshold` such as `p(95)<500` or `rate<0.05`, and a sliding
+      `window`, `10s` by default.
+    stream_logs: bool
+      (Optional) Log the output of k6 to Loki, in batches, through the
+      `chaosgrafana.controls.loki` control, tagged with the activity running
+      it. It is still written to `log_file` when set.
+    archive: bool
+      (Optional) Run the script from a `k6 archive` cached on disk, so it is
+      not compiled on every run. The archive is keyed by the script, the
+      local modules it imports and `environ`, which it stores, do not enable
+      it when `environ` holds secrets.
+
+    Returns the result of the run: whether k6 succeeded, the
+    `http_req_duration` percentiles, request and failure rates, iterations
+    and the outcome of each threshold. With `stream_metrics`, its `metrics`
+    key also holds percentiles per metric and tag set and over the last 10s
+    and 1m of the run. When `distributed`, these are merged across processes,
+    percentiles being computed from all their samples, and each process'
+    own result is listed under `segments`. With `thresholds`, its
+    `threshold_breach` key tells which one stopped k6, the value observed and
+    when, and `success` is then false.
     """
     logger.info("Running " + script_path)
-    driver = K6(debug=debug, log_file=log_file, environ=environ)
-
-    if iterations:
-        duration = None
-        driver.add_options(GenericOpt("--iterations", iterations))
-    if stages:
-        duration = None
-        vus = None
-        for stage in stages:
-            driver.add_options(
-                Stage(stage.get("duration"), stage.get("target"))
-            )
-    if vus:
-        driver.add_options(GenericOpt("--vus", vus))
-    if duration:
-        driver.add_options(GenericOpt("--duration", duration))
+    driver = _script_driver(
+        vus, duration, stages, iterations, log_file, debug, environ, archive
+    )
+    driver.thresholds = parse_thresholds(thresholds)
+    driver.stream_logs = stream_logs
+    driver.stream_metrics = stream_metrics or bool(driver.thresholds)
+    if distributed:
+        return driver.run_distributed(script_path, processes)
 
     return driver.run_script(script_path)
 
@@ -69,12 +110,18 @@ def stress_endpoint(
     duration: str = "1s",
     log_file: str = None,
     debug: bool = False,
-):
+    distributed: bool = False,
+    processes: int = None,
+    thresholds: List[Dict[str, str]] = None,
+    stream_logs: bool = False,
+    archive: bool = True,
+) -> Dict[str, Any]:
     """
     Stress a single endpoint with a configurable amount of VUs and duration.
     Depending on the specs of the attacking machine, possible VU amount may
     vary.
-    For a non-customized 2019 Macbook Pro, it will cap around 250 +/- 50.
+    For a non-customized 2019 Macbook Pro, it will cap around 250 +/- 50 with
+    a single k6 process. Use `distributed` to go beyond.
 
     Parameters
     ----------
@@ -86,25 +133,195 @@ def stress_endpoint(
       Duration, written as a string, ie: `1h2m3s` etc
     log_file: str
       (Optional) Relative path to the file where output should be logged.
-    """
-    base_path = Path(__file__).parent
-    js_path = str(base_path.parent) + "/k6/scripts"
+    distributed: bool
+      (Optional) Split the VUs across many local k6 processes
+    processes: int
+      (Optional) How many k6 processes to use when `distributed`, defaults
+      to the number of CPUs
+    thresholds: list
+      (Optional) Conditions stopping k6 as soon as one is not met, as with
+      `run_script`
+    stream_logs: bool
+      (Optional) Log the output of k6 to Loki, as with `run_script`
+    archive: bool
+      (Optional) Run the bundled stress script from a cached `k6 archive`,
+      enabled by default
 
+    Returns the result of the run, as `run_script` does.
+    """
     logger.info(
         'Stressing the endpoint "{}" with {} VUs for {}.'.format(
             endpoint, vus, duration
         )
     )
 
-    env = dict(**os.environ, CHAOS_K6_URL=endpoint)
-    driver = K6(debug=debug, log_file=log_file, environ=env)
-    driver.add_options(
-        GenericOpt("--vus", vus),
-        GenericOpt("--duration", duration),
-    )
-    result = driver.run_script(js_path + "/single-endpoint.js")
+    driver = _stress_driver(endpoint, vus, duration, log_file, debug, archive)
+    driver.thresholds = parse_thresholds(thresholds)
+    driver.stream_metrics = bool(driver.thresholds)
+    driver.stream_logs = stream_logs
+    if distributed:
+        result = driver.run_distributed(_stress_script(), processes)
+    else:
+        result = driver.run_script(_stress_script())
 
     logger.info("Stressing completed.")
     if log_file is not None:
         logger.info("Logged K6 output to {}.".format(log_file))
     return result
+
+
+def start_script(
+    script_path: str = None,
+    vus: int = 1,
+    duration: str = "1s",
+    stages: List[Dict] = None,
+    iterations: int = None,
+    log_file: str = None,
+    debug: bool = False,
+    environ: Dict = None,
+    stream_logs: bool = False,
+    archive: bool = False,
+) -> str:
+    """
+    Start an arbitrary k6 script in the background, so it can overlap with
+    the next activities of the experiment, and return the identifier of the
+    run. Use it with `wait_for_run`, `stop_run` or the `get_run_metrics`
+    probe. Metrics are aggregated while k6 runs.
+
+    Runs still going when the experiment ends are stopped by the
+    `chaosgrafana.controls.k6` control, or when the process exits.
+
+    Parameters are the same as `run_script`.
+    """
+    logger.info("Starting " + script_path)
+    driver = _script_driver(
+        vus, duration, stages, iterations, log_file, debug, environ, archive
+    )
+    driver.stream_metrics = True
+    driver.stream_logs = stream_logs
+    return register_run(driver.start_script(script_path))
+
+
+def start_stress(
+    endpoint: str = None,
+    vus: int = 1,
+    duration: str = "1s",
+    log_file: str = None,
+    debug: bool = False,
+    stream_logs: bool = False,
+    archive: bool = True,
+) -> str:
+    """
+    Start stressing a single endpoint in the background and return the
+    identifier of the run, as `start_script` does.
+
+    Parameters are the same as `stress_endpoint`.
+    """
+    logger.info(
+        'Starting to stress the endpoint "{}" with {} VUs for {}.'.format(
+            endpoint, vus, duration
+        )
+    )
+
+    driver = _stress_driver(endpoint, vus, duration, log_file, debug, archive)
+    driver.stream_metrics = True
+    driver.stream_logs = stream_logs
+    return register_run(driver.start_script(_stress_script()))
+
+
+def wait_for_run(run_id: str, timeout: float = None) -> Dict[str, Any]:
+    """
+    Wait for a background k6 run to complete and return its result, as
+    `run_script` does.
+
+    Parameters
+    ----------
+    run_id : str
+      The identifier returned when the run was started
+    timeout : float
+      (Optional) How long to wait, in seconds, before failing the activity.
+      The run keeps going when this happens.
+    """
+    run = get_run(run_id)
+    try:
+        return run.wait(timeout)
+    except subprocess.TimeoutExpired:
+        from chaoslib.exceptions import ActivityFailed
+
+        raise ActivityFailed(
+            f"k6 run {run_id} still going after {timeout} seconds"
+        )
+
+
+def stop_run(run_id: str, timeout: float = 30) -> Dict[str, Any]:
+    """
+    Stop a background k6 run gracefully, so it still reports what it
+    measured so far, and return its result, as `run_script` does.
+
+    Parameters
+    ----------
+    run_id : str
+      The identifier returned when the run was started
+    timeout : float
+      How long to wait, in seconds, for k6 to exit before killing it
+    """
+    logger.info(f"Stopping k6 run {run_id}")
+    return get_run(run_id).stop(timeout)
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _script_driver(
+    vus: int,
+    duration: str,
+    stages: List[Dict],
+    iterations: int,
+    log_file: str,
+    debug: bool,
+    environ: Dict,
+    archive: bool,
+) -> K6:
+    driver = K6(
+        debug=debug, log_file=log_file, environ=environ, archive=archive
+    )
+
+    if iterations:
+        duration = None
+        driver.add_options(GenericOpt("--iterations", iterations))
+    if stages:
+        duration = None
+        vus = None
+        for stage in stages:
+            driver.add_options(
+                Stage(stage.get("duration"), stage.get("target"))
+            )
+    if vus:
+        driver.add_options(GenericOpt("--vus", vus))
+    if duration:
+        driver.add_options(GenericOpt("--duration", duration))
+
+    return driver
+
+
+def _stress_driver(
+    endpoint: str,
+    vus: int,
+    duration: str,
+    log_file: str,
+    debug: bool,
+    archive: bool,
+) -> K6:
+    env = dict(CHAOS_K6_URL=endpoint)
+    driver = K6(debug=debug, log_file=log_file, environ=env, archive=archive)
+    driver.add_options(
+        GenericOpt("--vus", vus),
+        GenericOpt("--duration", duration),
+    )
+    return driver
+
+
+def _stress_script() -> str:
+    base_path = Path(__file__).parent
+    js_path = str(base_path.parent) + "/k6/scripts"
+    return js_path + "/single-endpoint.js"
@@ -0,0 +1,167 @@
+""" Content-addressed cache of Grafana k6 script archives """
+import functools
+import hashlib
+import json
+import os
+import re
+import subprocess
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from logzero import logger
+
+__all__ = ["archive_script", "cache_dir", "k6_version"]
+
+# Archives beyond this size in all are evicted, least recently used first
+DEFAULT_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# Static imports, side-effect imports and requires of local modules
+LOCAL_IMPORT = re.compile(
+    rb"""(?:\bfrom|\bimport|\brequire\s*\()\s*["'](\.{1,2}/[^"']+)["']"""
+)
+
+
+@functools.lru_cache(maxsize=1)
+def k6_version() -> Optional[str]:
+    """The version reported by the k6 binary, `None` when it cannot run"""
+    try:
+        p = subprocess.run(
+            ["k6", "version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+    except OSError:
+        return None
+    if p.returncode != 0:
+        return None
+    return p.stdout.strip()
+
+
+def cache_dir() -> str:
+    """
+    Directory holding the archives, `$CHAOSGRAFANA_K6_CACHE_DIR` or a
+    `chaosgrafana/k6` directory in the user's cache directory
+    """
+    path = os.getenv("CHAOSGRAFANA_K6_CACHE_DIR")
+    if not path:
+        base = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        path = os.path.join(base, "chaosgrafana", "k6")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def archive_script(
+    script: str,
+    environ: Dict[str, str] = None,
+    max_cache_size: int = DEFAULT_CACHE_MAX_SIZE,
+) -> str:
+    """
+    Return the path to a k6 archive of the script, so k6 does not have to
+    parse and compile it on every run, building it on first use.
+
+    Archives are keyed by the content of the script and of the local modules
+    it imports, with relative paths, the environment its options are
+    evaluated with and the k6 version. Modules imported otherwise, such as
+    from remote urls, are bundled in the archive but not part of the key,
+    clear the cache when you change them. The script itself is returned when
+    it cannot be archived.
+
+    The environment is stored in the archive, which is only readable by its
+    owner, so do not archive scripts run with secrets in their environment.
+
+    Once the archives of the cache take more than `max_cache_size` bytes, the
+    least recently used ones are removed.
+    """
+    version = k6_version()
+    if version is None:
+        return script
+
+    environ = environ or {}
+    key = hashlib.sha256()
+    key.update(version.encode("utf-8"))
+    try:
+        for path, content in _modules(os.path.abspath(script), set()):
+            key.update(path.encode("utf-8"))
+            key.update(content)
+    except OSError:
+        return script
+    key.update(json.dumps(environ, sort_keys=True).encode("utf-8"))
+
+    directory = cache_dir()
+    path = os.path.join(directory, f"{key.hexdigest()}.tar")
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    cmd = ["k6", "archive", "--quiet", "-O", tmp_path]
+    for name, value in sorted(environ.items()):
+        cmd.extend(["-e", f"{name}={value}"])
+    cmd.append(script)
+
+    logger.debug(f"Archiving k6 script {script} to {path}")
+    p = subprocess.run(
+        cmd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if p.returncode != 0:
+        logger.debug(f"Failed to archive k6 script {script}: {p.stderr}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return script
+
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+    _evict(directory, max_cache_size, keep=path)
+    return path
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _modules(path: str, seen: Set[str]) -> Iterator[Tuple[str, bytes]]:
+    # the script and the local modules it imports, recursively, depth first
+    with open(path, "rb") as f:
+        content = f.read()
+    seen.add(path)
+    yield path, content
+
+    directory = os.path.dirname(path)
+    for match in LOCAL_IMPORT.finditer(content):
+        module = os.path.normpath(
+            os.path.join(directory, match.group(1).decode("utf-8"))
+        )
+        if module in seen or not os.path.isfile(module):
+            continue
+        yield from _modules(module, seen)
+
+
+def _evict(directory: str, max_size: int, keep: str) -> None:
+    # least recently used archives first, the one just built is kept
+    archives = []
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(".tar"):
+            continue
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        archives.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in archives)
+    for _, size, path in sorted(archives):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        logger.debug(f"Evicted k6 archive {path}")
+        total -= size
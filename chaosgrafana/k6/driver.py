@@ -1,39 +1,245 @@
 """ A Chaos Toolkit driver to run Grafana K6 commands """
+import atexit
 import os
+import re
+import signal
 import subprocess
+import tempfile
+import threading
+import time
+import uuid
 from itertools import chain
-from typing import Dict, List
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 from logzero import logger
 
+from ..stats import stats
+from .archive import archive_script
+from .logs import K6LogStreamer
+from .stream import MetricsAggregator, MetricsReader
+from .summary import (
+    SUMMARY_TREND_STATS,
+    load_summary,
+    log_result,
+    merge_results,
+    parse_summary,
+)
+from .trace import TRACEPARENT_ENV, current_traceparent
 
-def _run(
+if TYPE_CHECKING:  # pragma: no cover
+    from .thresholds import Threshold, ThresholdMonitor
+
+DEFAULT_STOP_TIMEOUT = 30.0
+
+_runs: Dict[str, "K6Run"] = {}
+_runs_lock = threading.Lock()
+
+
+def _start(
     *cmd: List[List[str]],
     log_file: str = None,
     debug: bool = False,
     environ: Dict = None,
-):
+    capture: bool = False,
+) -> Tuple[subprocess.Popen, Optional[IO]]:
     _cmd = list(chain(*cmd))
 
-    context = dict(os.environ)
-    if environ:
-        context.update(environ)
+    # Without overrides, the child inherits the environment as is
+    context = {**os.environ, **environ} if environ else None
 
     # Default output to the void
     pipeoutput = subprocess.DEVNULL
-    # Use log file location if provided
-    if log_file is not None:
-        pipeoutput = open(log_file, "w")
+    output = None
+    if capture:
+        # read, and teed to the log file, by the caller
+        pipeoutput = subprocess.PIPE
+    elif log_file is not None:
+        pipeoutput = output = open(log_file, "w")
 
     logger.info("Running Grafana k6 command: %s", " ".join(_cmd))
 
-    with subprocess.Popen(
-        _cmd,
-        stderr=subprocess.STDOUT,
-        stdout=None if debug is True else pipeoutput,
-        env=context,
-    ) as p:
-        return p.returncode is None
+    try:
+        with stats.timer("k6.spawn"):
+            p = subprocess.Popen(
+                _cmd,
+                stderr=subprocess.STDOUT,
+                stdout=None if debug is True else pipeoutput,
+                env=context,
+            )
+    except Exception:
+        if output is not None:
+            output.close()
+        raise
+    stats.inc("k6.runs")
+    return p, output
+
+
+def register_run(run: "K6Run") -> str:
+    """Keep track of a background k6 run and return its identifier"""
+    with _runs_lock:
+        _runs[run.id] = run
+    return run.id
+
+
+def get_run(run_id: str) -> "K6Run":
+    """Lookup a background k6 run by its identifier"""
+    with _runs_lock:
+        run = _runs.get(run_id)
+    if run is None:
+        raise ValueError(f"Unknown k6 run '{run_id}'")
+    return run
+
+
+def stop_all_runs() -> None:
+    """Stop every background k6 run still going and forget about them all"""
+    with _runs_lock:
+        runs = list(_runs.values())
+        _runs.clear()
+
+    for run in runs:
+        if run.running:
+            logger.info(f"Stopping orphaned k6 run {run.id}")
+        run.stop()
+
+
+atexit.register(stop_all_runs)
+
+
+def parse_duration(duration: str, default: float = 1.0) -> float:
+    """Convert a k6 duration string, such as `1m30s`, to seconds"""
+    if not duration:
+        return default
+
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", duration)
+    if not parts or "".join(n + u for n, u in parts) != duration:
+        raise ValueError(f"Invalid duration '{duration}'")
+    return sum(float(n) * units[u] for n, u in parts)
+
+
+def _fraction(numerator: int, denominator: int) -> str:
+    if numerator == 0:
+        return "0"
+    if numerator == denominator:
+        return "1"
+    return f"{numerator}/{denominator}"
+
+
+class K6Run:
+    """A k6 process started by the driver, running in the background"""
+
+    def __init__(
+        self,
+        process: subprocess.Popen,
+        summary_path: str,
+        reader: MetricsReader = None,
+        output: IO = None,
+        script: str = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.process = process
+        self.summary_path = summary_path
+        self.reader = reader
+        self.output = output
+        self.script = script
+        self.monitor = None
+        self.logs: Optional[K6LogStreamer] = None
+        #: Whether the result is logged to Loki once collected
+        self.report = True
+        #: When k6 was spawned, from `time.monotonic`
+        self.started = time.monotonic()
+        self._result = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.process.poll() is None
+
+    def wait(self, timeout: float = None) -> Dict[str, Any]:
+        """
+        Wait for k6 to exit and return the result parsed from its summary.
+        Raises `subprocess.TimeoutExpired` when k6 is still running after
+        `timeout` seconds.
+        """
+        self.process.wait(timeout)
+        return self._collect()
+
+    def stop(self, timeout: float = DEFAULT_STOP_TIMEOUT) -> Dict[str, Any]:
+        """
+        Interrupt k6 gracefully, so that it still writes its summary, and
+        return its result. k6 is killed if it has not exited after `timeout`
+        seconds.
+        """
+        if self.running:
+            self.interrupt()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        return self._collect()
+
+    def interrupt(self, *args) -> None:
+        """Ask k6 to stop, without waiting for it"""
+        if self.running:
+            if os.name == "nt":
+                self.process.terminate()
+            else:
+                self.process.send_signal(signal.SIGINT)
+
+    def metrics(self) -> Optional[Dict[str, Any]]:
+        """Metrics aggregated so far, when they are streamed"""
+        if self.reader is None:
+            return None
+        return self.reader.aggregator.snapshot()
+
+    def _collect(self) -> Dict[str, Any]:
+        with self._lock:
+            if self._result is not None:
+                return self._result
+
+            parsing = time.perf_counter()
+            try:
+                summary = load_summary(self.summary_path)
+            finally:
+                os.remove(self.summary_path)
+                breach = self.monitor.stop() if self.monitor else None
+                metrics = self.reader.stop() if self.reader else None
+                if self.logs is not None:
+                    self.logs.stop()
+                if self.output is not None:
+                    self.output.close()
+
+            self._result = parse_summary(summary, self.process.returncode)
+            stats.observe("k6.summary_parse", time.perf_counter() - parsing)
+            self._record_stats()
+            if metrics is not None:
+                self._result["metrics"] = metrics
+            if self.monitor is not None:
+                _report_breach(self._result, breach)
+            if self.report:
+                log_result(self._result, self.script)
+            return self._result
+
+    def _record_stats(self) -> None:
+        if self.reader is None:
+            return
+        stats.inc("k6.samples", self.reader.aggregator.samples)
+        first_sample_at = self.reader.first_sample_at
+        if first_sample_at is not None:
+            stats.observe(
+                "k6.time_to_first_sample",
+                max(0.0, first_sample_at - self.started),
+            )
 
 
 class Stage:
@@ -69,14 +275,38 @@ class FlagOpt:
 
 
 class K6:
-    """Grafana k6 driver class"""
+    """
+    Grafana k6 driver class
+
+    With `archive`, scripts are run from a cached k6 archive rather than
+    compiled by k6 on every run. The environment is then stored in the
+    archive, enable it for scripts whose environment holds no secret. With
+    `thresholds`, metrics are streamed and k6 is stopped as soon as one of
+    them is breached. With `stream_logs`, the output of k6 is logged to Loki,
+    and still written to `log_file` when set. Unless `trace` is disabled, k6
+    is given the `traceparent` of the span it was started from, when the run
+    is traced.
+    """
 
     def __init__(
-        self, debug: bool = False, log_file: str = None, environ: Dict = None
+        self,
+        debug: bool = False,
+        log_file: str = None,
+        environ: Dict = None,
+        stream_metrics: bool = False,
+        archive: bool = False,
+        thresholds: List["Threshold"] = None,
+        stream_logs: bool = False,
+        trace: bool = True,
     ):
         self.debug = debug
         self.log_file = log_file
         self.environ = environ
+        self.stream_metrics = stream_metrics or bool(thresholds)
+        self.archive = archive
+        self.thresholds = thresholds or []
+        self.stream_logs = stream_logs
+        self.trace = trace
         self.options = []
 
     def add_options(self, *options):
@@ -84,30 +314,184 @@ class K6:
         if options:
             self.options.extend(options)
 
-    def run_script(self, script) -> int:
+    def run_script(self, script) -> Dict[str, Any]:
+        """
+        Run the Grafana k6 script and return the result parsed from its
+        end-of-test summary
+
+        Parameters
+        ----------
+        script: str
+            The load test script path
+        """
+        return self.start_script(script).wait()
+
+    def run_distributed(self, script, processes: int = None) -> Dict[str, Any]:
+        """
+        Run the Grafana k6 script split across many k6 processes, each
+        running its own execution segment of the test, and return their
+        merged result
+
+        Parameters
+        ----------
+        script: str
+            The load test script path
+        processes: int
+            How many k6 processes to split the test across, defaults to the
+            number of CPUs
+        """
+        processes = processes or os.cpu_count() or 1
+        sequence = ",".join(
+            _fraction(i, processes) for i in range(processes + 1)
+        )
+
+        runs = []
+        try:
+            for i in range(processes):
+                segment = (
+                    f"{_fraction(i, processes)}:{_fraction(i + 1, processes)}"
+                )
+                driver = K6(
+                    debug=self.debug,
+                    log_file=f"{self.log_file}.{i}" if self.log_file else None,
+                    environ=self.environ,
+                    stream_metrics=True,
+                    archive=self.archive,
+                    thresholds=self.thresholds,
+                    stream_logs=self.stream_logs,
+                    trace=self.trace,
+                )
+                driver.add_options(
+                    *self.options,
+                    GenericOpt("--execution-segment", segment),
+                    GenericOpt("--execution-segment-sequence", sequence),
+                )
+                run = driver._launch(script, monitor=False)
+                run.report = False
+                runs.append(run)
+        except Exception:
+            for run in runs:
+                run.stop()
+            raise
+
+        # thresholds apply to the whole test, not to each segment
+        aggregators = [run.reader.aggregator for run in runs]
+        monitor = None
+        if self.thresholds:
+            monitor = _monitor(
+                aggregators,
+                self.thresholds,
+                lambda breach: [run.interrupt() for run in runs],
+            )
+
+        results = [run.wait() for run in runs]
+        for result in results:
+            result.pop("metrics", None)
+        merged = merge_results(results, aggregators)
+        if self.stream_metrics:
+            combined = MetricsAggregator()
+            for aggregator in aggregators:
+                combined.merge(aggregator)
+            merged["metrics"] = combined.snapshot()
+        if monitor is not None:
+            _report_breach(merged, monitor.stop())
+        log_result(merged, script)
+        return merged
+
+    def start_script(self, script) -> K6Run:
         """
-        Run the Grafana k6 script
+        Start the Grafana k6 script in the background and return its run
 
         Parameters
         ----------
         script: str
             The load test script path
         """
+        return self._launch(script)
+
+    def _launch(self, script, monitor: bool = True) -> K6Run:
+        source = script
+        if self.archive:
+            script = archive_script(script, self.environ)
+
+        fd, summary_path = tempfile.mkstemp(
+            prefix="chaosgrafana-k6-", suffix=".json"
+        )
+        os.close(fd)
 
         command = [
             "k6",
             "run",
             "--quiet",
+            "--summary-export",
+            summary_path,
+            "--summary-trend-stats",
+            SUMMARY_TREND_STATS,
         ]
 
+        reader = None
+        if self.stream_metrics:
+            retention = max((t.seconds for t in self.thresholds), default=0)
+            reader = MetricsReader(MetricsAggregator(retention=retention))
+            reader.start()
+            command.extend(reader.output_option())
+
         opts = []
         for opt in self.options:
             opts.extend(opt.render())
 
-        return _run(
-            command,
-            opts,
-            [script],
-            log_file=self.log_file,
-            environ=self.environ,
-        )
+        # set on the process only, so archives do not change with the span
+        environ = self.environ
+        traceparent = current_traceparent() if self.trace else None
+        if traceparent:
+            environ = {**(environ or {}), TRACEPARENT_ENV: traceparent}
+
+        capture = self.stream_logs and not self.debug
+        started = time.monotonic()
+        try:
+            process, output = _start(
+                command,
+                opts,
+                [script],
+                log_file=self.log_file,
+                debug=self.debug,
+                environ=environ,
+                capture=capture,
+            )
+        except Exception:
+            os.remove(summary_path)
+            if reader:
+                reader.stop()
+            raise
+
+        run = K6Run(process, summary_path, reader, output, source)
+        run.started = started
+        if capture:
+            run.logs = K6LogStreamer(process.stdout, source, self.log_file)
+            run.logs.start()
+        if monitor and self.thresholds:
+            run.monitor = _monitor(
+                [reader.aggregator], self.thresholds, run.interrupt
+            )
+        return run
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _monitor(
+    aggregators: List[MetricsAggregator],
+    thresholds: List["Threshold"],
+    on_breach: Callable,
+) -> "ThresholdMonitor":
+    from .thresholds import ThresholdMonitor
+
+    monitor = ThresholdMonitor(aggregators, thresholds, on_breach)
+    monitor.start()
+    return monitor
+
+
+def _report_breach(result: Dict[str, Any], breach: Optional[Dict]) -> None:
+    result["threshold_breach"] = breach
+    if breach is not None:
+        result["success"] = False
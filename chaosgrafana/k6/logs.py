@@ -0,0 +1,185 @@
+""" Streaming of the Grafana k6 console output to Loki """
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import IO, Any, Deque, Dict, List, Optional, Tuple
+
+from ..stats import stats
+
+__all__ = ["K6LogStreamer", "parse_line", "set_activity"]
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_INTERVAL = 1.0
+DEFAULT_MAX_BUFFERED_LINES = 10000
+DEFAULT_STOP_TIMEOUT = 10.0
+LOGFMT_PAIR = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*"|\S*)')
+LEVELS = {
+    "trace": logging.DEBUG,
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "warn": logging.WARNING,
+    "error": logging.ERROR,
+    "fatal": logging.CRITICAL,
+    "panic": logging.CRITICAL,
+}
+
+# The logger the Loki control ships, lines go nowhere when it is disabled
+logs_logger = logging.getLogger("chaostoolkit-loki")
+
+# The activity running when k6 starts, set by the Loki control
+_activity: Optional[str] = None
+
+
+def set_activity(name: Optional[str]) -> None:
+    """Tag the output of the k6 runs started from now on with an activity"""
+    global _activity
+    _activity = name
+
+
+def parse_line(line: str) -> Dict[str, Any]:
+    """
+    Parse a line of k6 output, written either in its default logfmt format
+    or as JSON with `--log-format json`. Any other line, such as the output
+    of a script printing directly, becomes the `msg` of an `info` entry.
+    """
+    line = line.rstrip("\r\n")
+    if line.startswith("{"):
+        try:
+            entry = json.loads(line)
+            if isinstance(entry, dict):
+                return entry
+        except ValueError:
+            pass
+
+    entry = {}
+    for name, value in LOGFMT_PAIR.findall(line):
+        if value.startswith('"'):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                value = value[1:-1]
+        entry[name] = value
+
+    if "msg" not in entry or "level" not in entry:
+        return {"level": "info", "msg": line}
+    return entry
+
+
+class K6LogStreamer:
+    """
+    Read the output of a k6 process from a pipe and log its lines, in
+    batches, to the logger shipped by the Loki control, optionally teeing
+    them to `log_file` as they come.
+
+    Lines are read as fast as k6 writes them, from a thread of their own, and
+    buffered until the next batch. When `max_buffered` lines are already
+    waiting, new lines are dropped rather than slowing k6 down, the tee
+    still receives them.
+    """
+
+    def __init__(
+        self,
+        pipe: IO[bytes],
+        script: str = None,
+        log_file: str = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        batch_interval: float = DEFAULT_BATCH_INTERVAL,
+        max_buffered: int = DEFAULT_MAX_BUFFERED_LINES,
+    ):
+        self.pipe = pipe
+        self.tags = {
+            "type": "k6-log",
+            "name": os.path.basename(script) if script else None,
+            "activity": _activity,
+        }
+        self.log_file = log_file
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.max_buffered = max_buffered
+        self.lines = 0
+        self.dropped = 0
+        self._buffer: Deque[Tuple[int, bytes]] = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._eof = threading.Event()
+        self._reader = threading.Thread(
+            target=self._read, name="chaosgrafana-k6-logs-reader", daemon=True
+        )
+        self._shipper = threading.Thread(
+            target=self._ship, name="chaosgrafana-k6-logs-shipper", daemon=True
+        )
+
+    def start(self) -> None:
+        self._reader.start()
+        self._shipper.start()
+
+    def stop(self, timeout: float = DEFAULT_STOP_TIMEOUT) -> None:
+        """
+        Wait for the end of the output, once k6 has exited, and for its last
+        lines to be logged.
+        """
+        if self._reader.is_alive():
+            self._reader.join(timeout)
+        self._eof.set()
+        self._ready.set()
+        if self._shipper.is_alive():
+            self._shipper.join(timeout)
+        stats.inc("k6.log_lines", self.lines)
+        stats.inc("k6.log_lines_dropped", self.dropped)
+
+    def _read(self) -> None:
+        tee = open(self.log_file, "wb") if self.log_file else None
+        try:
+            for raw in iter(self.pipe.readline, b""):
+                if tee is not None:
+                    tee.write(raw)
+                with self._lock:
+                    self.lines += 1
+                    if len(self._buffer) >= self.max_buffered:
+                        self.dropped += 1
+                        continue
+                    self._buffer.append((time.time_ns(), raw))
+                    if len(self._buffer) >= self.batch_size:
+                        self._ready.set()
+        finally:
+            if tee is not None:
+                tee.close()
+            self.pipe.close()
+            self._eof.set()
+            self._ready.set()
+
+    def _ship(self) -> None:
+        while True:
+            self._ready.wait(self.batch_interval)
+            self._ready.clear()
+            eof = self._eof.is_set()
+            while True:
+                with self._lock:
+                    count = min(len(self._buffer), self.batch_size)
+                    batch = [self._buffer.popleft() for _ in range(count)]
+                if not batch:
+                    break
+                self._log(batch)
+                if len(batch) < self.batch_size:
+                    break
+            if eof and not self._buffer:
+                return
+
+    def _log(self, batch: List[Tuple[int, bytes]]) -> None:
+        if not logs_logger.isEnabledFor(logging.INFO):
+            return
+
+        for ts, raw in batch:
+            entry = parse_line(raw.decode("utf-8", errors="replace"))
+            fields = {k: v for k, v in entry.items() if k != "time"}
+            level = LEVELS.get(str(entry.get("level")).lower(), logging.INFO)
+            logs_logger.log(
+                level,
+                entry.get("msg", ""),
+                extra={"tags": self.tags, "fields": fields, "time_ns": ts},
+            )
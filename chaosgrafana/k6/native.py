@@ -0,0 +1,221 @@
+""" In-process asyncio HTTP probe, an alternative to spawning Grafana k6 """
+import asyncio
+import ssl
+import time
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .stream import QuantileSketch
+from .trace import current_traceparent
+
+__all__ = ["HTTPConnection", "probe_http"]
+
+USER_AGENT = "chaosgrafana"
+MAX_LINE_SIZE = 65536
+
+
+class HTTPConnection:
+    """
+    Minimal HTTP/1.1 client over a single keep-alive connection, reconnecting
+    when the server closes it. Each probe worker owns one, so the connections
+    are pooled across iterations like k6 does per virtual user.
+    """
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme '{parts.scheme}'")
+
+        self.tls = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.tls else 80)
+        self.target = parts.path or "/"
+        if parts.query:
+            self.target += f"?{parts.query}"
+        default_port = self.port == (443 if self.tls else 80)
+        self.host_header = (
+            parts.hostname if default_port else f"{parts.hostname}:{self.port}"
+        )
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(
+        self, method: str, headers: Dict[str, str] = None, body: bytes = b""
+    ) -> int:
+        """Send a request and return the response status code"""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=ssl.create_default_context() if self.tls else None,
+                limit=MAX_LINE_SIZE,
+            )
+
+        lines = [
+            f"{method} {self.target} HTTP/1.1",
+            f"Host: {self.host_header}",
+            f"User-Agent: {USER_AGENT}",
+        ]
+        lines.extend(f"{k}: {v}" for k, v in (headers or {}).items())
+        if body or method not in ("GET", "HEAD", "DELETE", "OPTIONS"):
+            lines.append(f"Content-Length: {len(body)}")
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        self._writer.write(head + body)
+        await self._writer.drain()
+
+        status, keep_alive = await self._read_response(method)
+        if not keep_alive:
+            await self.close()
+        return status
+
+    async def close(self) -> None:
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+    async def _read_response(self, method: str) -> Tuple[int, bool]:
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by the server")
+        version, status = status_line.split(None, 2)[:2]
+        status = int(status)
+
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = headers.get("connection") != "close" and (
+            version == b"HTTP/1.1" or headers.get("connection") == "keep-alive"
+        )
+
+        if method == "HEAD" or status < 200 or status in (204, 304):
+            pass
+        elif headers.get("transfer-encoding", "").endswith("chunked"):
+            await self._read_chunked()
+        elif "content-length" in headers:
+            await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            await self._reader.read()
+            keep_alive = False
+        return status, keep_alive
+
+    async def _read_chunked(self) -> None:
+        while True:
+            size = int((await self._reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # trailers, if any, end with an empty line
+                while (await self._reader.readline()) not in (b"\r\n", b""):
+                    pass
+                return
+            await self._reader.readexactly(size + 2)
+
+
+def probe_http(
+    endpoint: str,
+    method: str = "GET",
+    status: int = 200,
+    body: str = "",
+    headers: Dict[str, str] = None,
+    vus: int = 1,
+    duration: float = 1.0,
+    timeout: float = 1.0,
+) -> Dict[str, Any]:
+    """
+    Request the endpoint from `vus` concurrent workers for `duration` seconds
+    and return a result shaped like the one of the k6 `http` probe.
+
+    As with the k6 probe, the run is aborted on the first response without
+    the expected status. Requests failing or timing out count as responses
+    with a status of 0. Latencies are in milliseconds. Like the k6 scripts,
+    requests carry the experiment's trace context when it is set.
+    """
+    headers = dict(headers or {})
+    traceparent = current_traceparent()
+    if traceparent:
+        headers.setdefault("traceparent", traceparent)
+
+    return asyncio.run(
+        _probe(
+            endpoint,
+            method.upper(),
+            status,
+            body.encode("utf-8"),
+            headers,
+            vus,
+            duration,
+            timeout,
+        )
+    )
+
+
+###############################################################################
+# Private functions
+###############################################################################
+async def _probe(
+    endpoint: str,
+    method: str,
+    expected: int,
+    body: bytes,
+    headers: Dict[str, str],
+    vus: int,
+    duration: float,
+    timeout: float,
+) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    aborted = asyncio.Event()
+    latencies = QuantileSketch()
+    counts = {"completed": 0, "failed": 0}
+
+    async def worker() -> None:
+        connection = HTTPConnection(endpoint)
+        try:
+            while loop.time() < deadline and not aborted.is_set():
+                started = time.perf_counter()
+                try:
+                    status = await asyncio.wait_for(
+                        connection.request(method, headers, body), timeout
+                    )
+                except (
+                    OSError,
+                    ValueError,
+                    asyncio.TimeoutError,
+                    asyncio.IncompleteReadError,
+                ):
+                    await connection.close()
+                    status = 0
+                latencies.add((time.perf_counter() - started) * 1000)
+                counts["completed"] += 1
+                if status != expected:
+                    counts["failed"] += 1
+                    aborted.set()
+        finally:
+            await connection.close()
+
+    started = loop.time()
+    await asyncio.gather(*(worker() for _ in range(vus)))
+    elapsed = loop.time() - started
+
+    stats = latencies.stats()
+    completed = counts["completed"]
+    return {
+        "success": completed > 0 and counts["failed"] == 0,
+        "engine": "python",
+        "http_req_duration": {
+            k: stats.get(k)
+            for k in ("avg", "min", "max", "p50", "p90", "p95", "p99")
+        },
+        "http_reqs": completed,
+        "request_rate": completed / elapsed if elapsed else 0.0,
+        "failure_rate": counts["failed"] / completed if completed else 0.0,
+        "iterations": completed,
+    }
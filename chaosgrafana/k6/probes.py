@@ -1,9 +1,10 @@
 import json
 import os
+from typing import Any, Dict, List
 
-from .driver import K6
+from .driver import K6, get_run, parse_duration
 
-__all__ = ["http"]
+__all__ = ["http", "http_many", "get_run_metrics"]
 
 
 def http(
@@ -16,7 +17,9 @@ def http(
     duration: str = "",
     debug: bool = False,
     timeout: int = 1,
-) -> bool:
+    persistent: bool = False,
+    engine: str = "k6",
+) -> Dict[str, Any]:
     """
     Probe an endpoint to make sure it responds to an http request
     with the expected HTTP status code. Depending on the endpoint and your
@@ -37,20 +40,41 @@ def http(
         i.e "20s", "1m", "1h" etc.
     timeout : int
         Timeout duration for http requests. Defaults to 1 second
+    persistent : bool
+        Keep a paused k6 process up across calls with the same arguments and
+        resume it for `duration` on each call, rather than starting k6 every
+        time. Its result only covers the requests of the call, their latency
+        percentiles computed from the samples k6 streamed meanwhile.
+    engine : str
+        `"k6"` to run the probe with Grafana k6 or `"python"` to send the
+        requests from asyncio workers within chaostoolkit itself, which does
+        not need k6 to be installed. Both report success, latency percentiles
+        and request rates alike.
+
+    Returns the result of the k6 run. Its `success` key tells whether every
+    response had the expected status, the other keys carry the latency
+    percentiles and request rates so tolerances can assert on them.
     """  # noqa: E501
-    if status < 100 or status > 999:
-        raise ValueError("Invalid HTTP Response status code expection")
-    if method.lower() not in [
-        "get",
-        "post",
-        "put",
-        "patch",
-        "delete",
-        "options",
-    ]:
-        raise ValueError("Invalid HTTP Request method")
-    if endpoint is None:
-        raise ValueError("Endpoint is a required argument")
+    _validate_request(endpoint, method, status)
+    if engine not in ("k6", "python"):
+        raise ValueError(f"Unknown engine '{engine}', use 'k6' or 'python'")
+
+    if engine == "python":
+        if persistent:
+            raise ValueError("Persistent probes are only run by k6")
+
+        from .native import probe_http
+
+        return probe_http(
+            endpoint,
+            method=method,
+            status=status,
+            body=body,
+            headers=headers,
+            vus=vus,
+            duration=parse_duration(duration),
+            timeout=timeout,
+        )
 
     env = dict(
         CHAOS_K6_URL=endpoint,
@@ -65,7 +89,132 @@ def http(
 
     scripts_path = os.path.dirname(os.path.realpath(__file__))
 
+    if persistent:
+        from .runner import get_runner
+
+        # the duration is per call, leave it out of the runner identity
+        del env["CHAOS_K6_DURATION"]
+        runner = get_runner(f"{scripts_path}/scripts/probe-runner.js", env)
+        return runner.probe(parse_duration(duration))
+
     js_path = f"{scripts_path}/scripts/probe.js"
 
-    driver = K6(debug=debug, environ=env)
+    # headers and bodies, which may hold credentials, must not be stored in
+    # archives
+    driver = K6(debug=debug, environ=env, archive=not (headers or body))
     return driver.run_script(js_path)
+
+
+def http_many(
+    endpoints: List[Dict[str, Any]],
+    vus: int = 1,
+    duration: str = "",
+    debug: bool = False,
+) -> Dict[str, Any]:
+    """
+    Probe many endpoints concurrently, within a single k6 run, to make sure
+    they all respond with their expected HTTP status code. Each iteration
+    sends the requests to all endpoints in parallel. Depending on the
+    endpoints and your payloads, this action might be destructive. Use with
+    caution.
+
+    Parameters
+    ----------
+    endpoints : list
+        The endpoints to probe. Each is a mapping with a `url` and optionally
+        a `method` (defaults to GET), the expected `status` (defaults to 200),
+        `headers`, `body` and a `timeout` in seconds (defaults to 1)
+    vus : int
+        The amount of concurrent virtual users accessing the endpoints
+    duration : str
+        How long to probe the endpoints. Expressed as a duration string,
+        i.e "20s", "1m", "1h" etc.
+
+    Returns the result of the k6 run, as `http` does, with an `endpoints`
+    list telling, in the same order, whether each endpoint always responded
+    as expected, its failure rate and its `http_req_duration` percentiles.
+    """
+    if not endpoints:
+        raise ValueError("At least one endpoint is required")
+
+    specs = []
+    for endpoint in endpoints:
+        spec = {
+            "url": endpoint.get("url"),
+            "method": endpoint.get("method", "GET"),
+            "status": endpoint.get("status", 200),
+            "headers": endpoint.get("headers", {}),
+            "body": endpoint.get("body", ""),
+            "timeout": endpoint.get("timeout", 1),
+        }
+        _validate_request(spec["url"], spec["method"], spec["status"])
+        specs.append(spec)
+
+    env = dict(
+        CHAOS_K6_ENDPOINTS=json.dumps(specs),
+        CHAOS_K6_VUS=str(vus),
+        CHAOS_K6_DURATION=duration,
+    )
+
+    scripts_path = os.path.dirname(os.path.realpath(__file__))
+
+    js_path = f"{scripts_path}/scripts/probe-many.js"
+
+    archive = not any(spec["headers"] or spec["body"] for spec in specs)
+    driver = K6(debug=debug, environ=env, archive=archive)
+    result = driver.run_script(js_path)
+
+    submetrics = result.get("submetrics", {})
+    result["endpoints"] = []
+    for index, spec in enumerate(specs):
+        failures = submetrics.get(f"failures{{endpoint:{index}}}", {})
+        failure_rate = failures.get("rate")
+        result["endpoints"].append(
+            {
+                "url": spec["url"],
+                "method": spec["method"],
+                "status": spec["status"],
+                "success": failure_rate == 0,
+                "failure_rate": failure_rate,
+                "http_req_duration": submetrics.get(
+                    f"http_req_duration{{endpoint:{index}}}", {}
+                ),
+            }
+        )
+    return result
+
+
+def get_run_metrics(run_id: str) -> Dict[str, Any]:
+    """
+    Read the metrics aggregated so far by a k6 run started in the background
+    with the `start_script` or `start_stress` actions.
+
+    Parameters
+    ----------
+    run_id : str
+        The identifier returned when the run was started
+
+    Returns whether the run is still going and its metrics, per metric and
+    tag set and over the last 10s and 1m.
+    """
+    run = get_run(run_id)
+    return {"running": run.running, "metrics": run.metrics()}
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _validate_request(endpoint: str, method: str, status: int) -> None:
+    if status < 100 or status > 999:
+        raise ValueError("Invalid HTTP Response status code expection")
+    if method.lower() not in [
+        "get",
+        "post",
+        "put",
+        "patch",
+        "delete",
+        "options",
+    ]:
+        raise ValueError("Invalid HTTP Request method")
+    if endpoint is None:
+        raise ValueError("Endpoint is a required argument")
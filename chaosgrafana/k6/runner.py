@@ -0,0 +1,177 @@
+""" Long-lived Grafana k6 process driven through its REST API """
+import json
+import socket
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, Tuple
+
+from logzero import logger
+
+from .driver import K6, FlagOpt, GenericOpt, K6Run, register_run
+from .stream import QuantileSketch
+
+__all__ = ["K6Runner", "get_runner"]
+
+DEFAULT_API_TIMEOUT = 5.0
+DEFAULT_STARTUP_TIMEOUT = 30.0
+DEFAULT_SETTLE_TIMEOUT = 5.0
+DEFAULT_SAMPLES_TIMEOUT = 2.0
+
+_runners: Dict[Tuple, "K6Runner"] = {}
+_runners_lock = threading.Lock()
+
+
+def get_runner(script: str, environ: Dict[str, str]) -> "K6Runner":
+    """
+    Return the runner of this script and environment, starting it on first
+    use or when its k6 process has exited
+    """
+    key = (script, tuple(sorted(environ.items())))
+    with _runners_lock:
+        runner = _runners.get(key)
+        if runner is None or not runner.run.running:
+            runner = K6Runner(script, environ)
+            runner.start()
+            _runners[key] = runner
+        return runner
+
+
+class K6Runner:
+    """
+    A k6 process started paused with an externally-controlled scenario,
+    which stays up across probes. A probe resumes it for its duration, pauses
+    it again and reads how many iterations completed and failed meanwhile.
+
+    The process is registered like any background run, so it is stopped with
+    them when the experiment ends.
+    """
+
+    def __init__(self, script: str, environ: Dict[str, str]):
+        self.script = script
+        self.environ = environ
+        self.address = None
+        self.run: K6Run = None
+        self._lock = threading.Lock()
+
+    def start(self, timeout: float = DEFAULT_STARTUP_TIMEOUT) -> None:
+        self.address = f"127.0.0.1:{_free_port()}"
+        # k6 outlives the activity starting it, its span would soon be stale
+        driver = K6(environ=self.environ, stream_metrics=True, trace=False)
+        driver.add_options(GenericOpt("--address", self.address))
+        driver.add_options(FlagOpt("--paused"))
+        self.run = driver.start_script(self.script)
+        register_run(self.run)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.run.running:
+                break
+            try:
+                self._api("GET", "/v1/status")
+                logger.debug(f"k6 runner listening on {self.address}")
+                return
+            except OSError:
+                time.sleep(0.1)
+
+        self.run.stop()
+        raise RuntimeError(f"k6 runner did not start on {self.address}")
+
+    def probe(self, duration: float) -> Dict[str, Any]:
+        """
+        Let the runner iterate for `duration` seconds and return how many
+        iterations completed and failed, along with the latency percentiles
+        of their requests, streamed by k6 meanwhile
+        """
+        aggregator = self.run.reader.aggregator
+        with self._lock:
+            before = self._counters()
+            durations = aggregator.tap("http_req_duration")
+            try:
+                started = time.monotonic()
+                self._api("PATCH", "/v1/status", _status(paused=False))
+                time.sleep(duration)
+                self._api("PATCH", "/v1/status", _status(paused=True))
+                elapsed = time.monotonic() - started
+                after = self._settle()
+                completed = after["completed"] - before["completed"]
+                _await_samples(durations, completed)
+            finally:
+                aggregator.untap("http_req_duration", durations)
+
+        failed = after["failed"] - before["failed"]
+        latency = durations.stats()
+        return {
+            "success": completed > 0 and failed == 0,
+            "http_req_duration": {
+                k: latency.get(k)
+                for k in ("avg", "min", "max", "p50", "p90", "p95", "p99")
+            },
+            "http_reqs": completed,
+            "request_rate": completed / elapsed if elapsed else 0.0,
+            "failure_rate": failed / completed if completed else 0.0,
+            "iterations": completed,
+            "failures": failed,
+        }
+
+    def _settle(self, timeout: float = DEFAULT_SETTLE_TIMEOUT) -> Dict:
+        # iterations in flight when paused still complete, wait for the
+        # counters to stop moving
+        deadline = time.monotonic() + timeout
+        counters = self._counters()
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            latest = self._counters()
+            if latest == counters:
+                break
+            counters = latest
+        return counters
+
+    def _counters(self) -> Dict[str, int]:
+        counters = {"completed": 0, "failed": 0}
+        for metric in self._api("GET", "/v1/metrics").get("data", []):
+            if metric.get("id") in counters:
+                sample = metric["attributes"]["sample"]
+                counters[metric["id"]] = int(sample.get("count", 0))
+        return counters
+
+    def _api(self, method: str, path: str, body: Dict = None) -> Dict:
+        data = json.dumps(body).encode("utf-8") if body else None
+        request = urllib.request.Request(
+            f"http://{self.address}{path}",
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(
+            request, timeout=DEFAULT_API_TIMEOUT
+        ) as response:
+            return json.load(response)
+
+
+def _await_samples(
+    sketch: QuantileSketch,
+    count: int,
+    timeout: float = DEFAULT_SAMPLES_TIMEOUT,
+) -> None:
+    # k6 writes its samples periodically, the last ones may still be on the
+    # way once the counters settled
+    deadline = time.monotonic() + timeout
+    while sketch.count < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def _status(paused: bool) -> Dict:
+    return {
+        "data": {
+            "type": "status",
+            "id": "default",
+            "attributes": {"paused": paused},
+        }
+    }
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
@@ -0,0 +1,58 @@
+import { Rate } from 'k6/metrics';
+import http from 'k6/http';
+
+import { withTraceparent } from './trace.js';
+
+const defaults = {
+  vus: 1,
+  duration: '1s',
+  timeout: 1,
+};
+
+const env = getEnvs();
+const failures = new Rate('failures');
+
+export const options = {
+  discardResponseBodies: true,
+  vus: env.vus,
+  duration: env.duration,
+  thresholds: getThresholds(env.endpoints),
+};
+
+export default function () {
+  const responses = http.batch(env.endpoints.map(toRequest));
+  responses.forEach((r, i) => {
+    failures.add(r.status !== env.endpoints[i].status, { endpoint: `${i}` });
+  });
+}
+
+function getEnvs() {
+  return {
+    endpoints: JSON.parse(__ENV.CHAOS_K6_ENDPOINTS),
+    vus: __ENV.CHAOS_K6_VUS || defaults.vus,
+    duration: __ENV.CHAOS_K6_DURATION || defaults.duration,
+  };
+}
+
+// thresholds make k6 report each endpoint's sub-metrics in its summary
+function getThresholds(endpoints) {
+  const thresholds = {};
+  endpoints.forEach((_, i) => {
+    thresholds[`http_req_duration{endpoint:${i}}`] = ['max>=0'];
+    thresholds[`failures{endpoint:${i}}`] = ['rate<=0'];
+  });
+  return thresholds;
+}
+
+function toRequest(endpoint, i) {
+  return {
+    method: endpoint.method.toUpperCase(),
+    url: endpoint.url,
+    body: endpoint.body || null,
+    params: {
+      headers: withTraceparent(endpoint.headers || {}),
+      timeout: (endpoint.timeout || defaults.timeout) * 1000,
+      tags: { endpoint: `${i}` },
+    },
+  };
+}
@@ -0,0 +1,65 @@
+import { Counter } from 'k6/metrics';
+import http from 'k6/http';
+
+import { withTraceparent } from './trace.js';
+
+// Long-lived probe paused and resumed by chaosgrafana through the k6 REST
+// API, probes read the deltas of these counters between two resumes.
+
+const defaults = {
+  vus: 1,
+  lifetime: '24h',
+  headers: '{}',
+};
+
+const env = getEnvs();
+const completed = new Counter('completed');
+const failed = new Counter('failed');
+
+export const options = {
+  discardResponseBodies: true,
+  scenarios: {
+    probe: {
+      executor: 'externally-controlled',
+      vus: env.vus,
+      maxVUs: env.vus,
+      duration: env.lifetime,
+    },
+  },
+};
+
+export default function () {
+  const r = doRequest(env);
+  completed.add(1);
+  failed.add(r.status !== env.status ? 1 : 0);
+}
+
+function getEnvs() {
+  return {
+    method: __ENV.CHAOS_K6_METHOD.toLowerCase(),
+    url: __ENV.CHAOS_K6_URL,
+    status: parseInt(__ENV.CHAOS_K6_STATUS, 10),
+    body: __ENV.CHAOS_K6_BODY,
+    vus: parseInt(__ENV.CHAOS_K6_VUS || defaults.vus, 10),
+    lifetime: __ENV.CHAOS_K6_LIFETIME || defaults.lifetime,
+    headers: withTraceparent(
+      JSON.parse(__ENV.CHAOS_K6_HEADERS || defaults.headers)
+    ),
+    timeout: parseInt(__ENV.CHAOS_K6_HTTP_TIMEOUT, 10),
+  };
+}
+
+function doRequest(env) {
+  if (env.method === 'get') {
+    return http.get(env.url, {
+      headers: env.headers,
+      timeout: env.timeout * 1000,
+    });
+  }
+
+  return (env.method === 'delete' ? http.delete : http[env.method])(
+    env.url,
+    env.body,
+    { headers: env.headers, timeout: env.timeout * 1000 }
+  );
+}
@@ -1,6 +1,8 @@
 import { Counter, Rate } from 'k6/metrics';
 import http from 'k6/http';
 
+import { withTraceparent } from './trace.js';
+
 const defaults = {
   vus: 1,
   duration: '1s',
@@ -45,7 +47,9 @@ function getEnvs() {
     body: __ENV.CHAOS_K6_BODY,
     vus: __ENV.CHAOS_K6_VUS || defaults.vus,
     duration: __ENV.CHAOS_K6_DURATION || defaults.duration,
-    headers: JSON.parse(__ENV.CHAOS_K6_HEADERS || defaults.headers),
+    headers: withTraceparent(
+      JSON.parse(__ENV.CHAOS_K6_HEADERS || defaults.headers)
+    ),
     timeout: parseInt(__ENV.CHAOS_K6_HTTP_TIMEOUT, 10),
   };
 }
@@ -1,6 +1,8 @@
 import { Rate } from 'k6/metrics';
 import http from 'k6/http';
 
+import { withTraceparent } from './trace.js';
+
 const failures = new Rate('failures');
 
 export const options = {
@@ -10,7 +12,7 @@ export const options = {
 };
 
 export default function () {
-  const r = http.get(__ENV.CHAOS_K6_URL);
+  const r = http.get(__ENV.CHAOS_K6_URL, { headers: withTraceparent({}) });
   console.log(`Status: ${r.status_text}`)
   failures.add(r.status !== 200);
 }
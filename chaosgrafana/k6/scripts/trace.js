@@ -0,0 +1,8 @@
+// The span of the experiment's trace k6 runs in, set by chaosgrafana, is
+// sent in a traceparent header unless the request already carries one.
+export function withTraceparent(headers) {
+  if (!__ENV.TRACEPARENT || headers.traceparent) {
+    return headers;
+  }
+  return Object.assign({ traceparent: __ENV.TRACEPARENT }, headers);
+}
@@ -0,0 +1,389 @@
+""" Online aggregation of the Grafana k6 NDJSON metric stream """
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from logzero import logger
+
+__all__ = ["QuantileSketch", "MetricsAggregator", "MetricsReader"]
+
+# Tags a sample is grouped by, any other tag is ignored so that the number of
+# series stays bounded
+DEFAULT_GROUP_BY = ("name", "method", "status", "scenario")
+DEFAULT_MAX_SERIES = 500
+DEFAULT_WINDOWS = {"10s": 10, "1m": 60}
+DEFAULT_PROGRESS_INTERVAL = 10.0
+
+
+class QuantileSketch:
+    """
+    Log-bucketed histogram answering quantile queries with a bounded relative
+    error, in the spirit of DDSketch/HDR histograms.
+
+    Memory does not grow with the number of samples, only with the range of
+    their values, and is capped to `max_buckets` by collapsing the lowest
+    buckets. Sketches can be merged without losing accuracy.
+    """
+
+    def __init__(
+        self, relative_accuracy: float = 0.01, max_buckets: int = 2048
+    ):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.max_buckets = max_buckets
+        self._log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if value <= 0:
+            self.zeros += 1
+            return
+
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """Add the samples of `other` to this sketch and return it."""
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches of different accuracy")
+
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.zeros += other.zeros
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return max(self.min, 0.0)
+
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                value = 2 * self.gamma**key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def stats(self) -> Dict[str, Any]:
+        if self.count == 0:
+            return {"count": 0}
+
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "avg": self.sum / self.count,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+    def _collapse(self) -> None:
+        keys = sorted(self.buckets)
+        excess = len(keys) - self.max_buckets
+        lowest = keys[excess]
+        for key in keys[:excess]:
+            self.buckets[lowest] += self.buckets.pop(key)
+
+
+class MetricsAggregator:
+    """
+    Aggregate k6 samples, on the fly, into one sketch per metric and tag set
+    as well as into rolling windows per metric.
+
+    Series beyond `max_series` are folded into a single overflow series of
+    their metric, so memory stays flat however long the run is. Samples are
+    kept per second for the longest of `windows` or `retention` seconds.
+    """
+
+    def __init__(
+        self,
+        group_by: Iterable[str] = DEFAULT_GROUP_BY,
+        max_series: int = DEFAULT_MAX_SERIES,
+        windows: Dict[str, int] = None,
+        retention: int = 0,
+    ):
+        self.group_by = tuple(group_by)
+        self.max_series = max_series
+        self.windows = windows or DEFAULT_WINDOWS
+        self.series: Dict[Tuple, QuantileSketch] = {}
+        self.types: Dict[str, str] = {}
+        self.samples = 0
+        self.started = time.time()
+        self.first_samples: Dict[str, float] = {}
+        self._taps: Dict[str, List[QuantileSketch]] = {}
+        self._recent: Dict[str, Deque[Tuple[int, QuantileSketch]]] = {}
+        self._recent_size = max(retention, *self.windows.values())
+        self._lock = threading.Lock()
+
+    def add_line(self, line: str) -> None:
+        """Aggregate one line of the k6 NDJSON output."""
+        try:
+            sample = json.loads(line)
+        except ValueError:
+            return
+
+        data = sample.get("data") or {}
+        if sample.get("type") == "Metric":
+            self.types[sample.get("metric")] = data.get("type")
+            return
+        if sample.get("type") != "Point":
+            return
+
+        value = data.get("value")
+        if isinstance(value, (int, float)):
+            self.add(sample.get("metric"), value, data.get("tags"))
+
+    def add(
+        self, metric: str, value: float, tags: Dict[str, str] = None
+    ) -> None:
+        tags = tags or {}
+        key = (metric,) + tuple(tags.get(t, "") for t in self.group_by)
+        now = time.time()
+        second = int(now)
+
+        with self._lock:
+            self.samples += 1
+            self.first_samples.setdefault(metric, now)
+            sketch = self.series.get(key)
+            if sketch is None:
+                if len(self.series) >= self.max_series:
+                    key = (metric,) + ("",) * len(self.group_by)
+                sketch = self.series.setdefault(key, QuantileSketch())
+            sketch.add(value)
+            for tap in self._taps.get(metric, ()):
+                tap.add(value)
+
+            recent = self._recent.setdefault(
+                metric, deque(maxlen=self._recent_size)
+            )
+            if not recent or recent[-1][0] != second:
+                recent.append((second, QuantileSketch()))
+            recent[-1][1].add(value)
+
+    def merge(self, other: "MetricsAggregator") -> "MetricsAggregator":
+        """
+        Add the series and rolling windows of `other`, say aggregated by
+        another k6 process running a segment of the same test, to this
+        aggregator and return it.
+        """
+        with other._lock:
+            series = dict(other.series)
+            recent = {m: list(r) for m, r in other._recent.items()}
+            types = dict(other.types)
+            first_samples = dict(other.first_samples)
+            samples, started = other.samples, other.started
+
+        with self._lock:
+            self.samples += samples
+            self.started = min(self.started, started)
+            self.types.update(types)
+            for metric, at in first_samples.items():
+                self.first_samples[metric] = min(
+                    self.first_samples.get(metric, at), at
+                )
+            for key, sketch in series.items():
+                self.series.setdefault(key, QuantileSketch()).merge(sketch)
+
+            for metric, seconds in recent.items():
+                merged: Dict[int, QuantileSketch] = {}
+                for second, sketch in [
+                    *self._recent.get(metric, ()),
+                    *seconds,
+                ]:
+                    merged.setdefault(second, QuantileSketch()).merge(sketch)
+                self._recent[metric] = deque(
+                    sorted(merged.items()), maxlen=self._recent_size
+                )
+        return self
+
+    def window(self, metric: str, seconds: int) -> Dict[str, Any]:
+        """Statistics of a metric over the last `seconds` seconds."""
+        merged = self.window_sketch(metric, seconds)
+        stats = merged.stats()
+        stats["rate"] = merged.count / seconds
+        return stats
+
+    def window_sketch(self, metric: str, seconds: int) -> QuantileSketch:
+        """A sketch of a metric over the last `seconds` seconds."""
+        since = int(time.time()) - seconds
+        merged = QuantileSketch()
+        with self._lock:
+            for second, sketch in self._recent.get(metric, ()):
+                if second > since:
+                    merged.merge(sketch)
+        return merged
+
+    def tap(self, metric: str) -> QuantileSketch:
+        """
+        A sketch of its own receiving the samples of a metric from now on,
+        until it is untapped
+        """
+        sketch = QuantileSketch()
+        with self._lock:
+            self._taps.setdefault(metric, []).append(sketch)
+        return sketch
+
+    def untap(self, metric: str, sketch: QuantileSketch) -> None:
+        with self._lock:
+            taps = self._taps.get(metric, [])
+            self._taps[metric] = [t for t in taps if t is not sketch]
+
+    def elapsed(self, metric: str) -> float:
+        """Seconds since the first sample of a metric, `0` without any"""
+        first = self.first_samples.get(metric)
+        if first is None:
+            return 0.0
+        return max(0.0, time.time() - first)
+
+    def metric(self, metric: str) -> Dict[str, Any]:
+        """Statistics of a metric across all its series."""
+        return self.sketch(metric).stats()
+
+    def sketch(self, metric: str) -> QuantileSketch:
+        """A sketch of a metric merging all its series."""
+        merged = QuantileSketch()
+        with self._lock:
+            for key, sketch in self.series.items():
+                if key[0] == metric:
+                    merged.merge(sketch)
+        return merged
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Statistics of every series and rolling window so far."""
+        with self._lock:
+            series = [
+                {
+                    "metric": key[0],
+                    "tags": {t: v for t, v in zip(self.group_by, key[1:]) if v},
+                    **sketch.stats(),
+                }
+                for key, sketch in self.series.items()
+            ]
+            metrics = list(self._recent)
+
+        return {
+            "samples": self.samples,
+            "elapsed": time.time() - self.started,
+            "series": series,
+            "windows": {
+                name: {m: self.window(m, seconds) for m in metrics}
+                for name, seconds in self.windows.items()
+            },
+        }
+
+
+class MetricsReader:
+    """
+    Background reader of the NDJSON stream k6 writes with `--out json=path`.
+
+    On POSIX systems, `path` is a named pipe so samples are aggregated while
+    k6 runs and nothing is written to disk. Elsewhere, it is a regular file
+    which is only read once k6 has exited.
+    """
+
+    def __init__(
+        self,
+        aggregator: MetricsAggregator = None,
+        progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+    ):
+        self.aggregator = aggregator or MetricsAggregator()
+        self.progress_interval = progress_interval
+        self.path = None
+        #: When the first line was read, from `time.monotonic`
+        self.first_sample_at = None
+        self._dir = None
+        self._thread = None
+        self._live = hasattr(os, "mkfifo")
+
+    def output_option(self) -> List[str]:
+        """The k6 command-line option making it write to this reader."""
+        return ["--out", f"json={self.path}"]
+
+    def start(self) -> None:
+        self._dir = tempfile.mkdtemp(prefix="chaosgrafana-k6-")
+        self.path = os.path.join(self._dir, "metrics.json")
+        if self._live:
+            os.mkfifo(self.path)
+            self._thread = threading.Thread(
+                target=self._read, name="chaosgrafana-k6-metrics", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> Dict[str, Any]:
+        """
+        Wait for the end of the stream, once k6 has exited, and return the
+        aggregated snapshot.
+        """
+        try:
+            if self._thread is not None:
+                self._unblock(timeout)
+            elif os.path.exists(self.path):
+                self._read()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rmdir(self._dir)
+        return self.aggregator.snapshot()
+
+    def _read(self) -> None:
+        last_progress = time.monotonic()
+        with open(self.path) as f:
+            for line in f:
+                self.aggregator.add_line(line)
+                now = time.monotonic()
+                if self.first_sample_at is None:
+                    self.first_sample_at = now
+                if self._live and now - last_progress >= self.progress_interval:
+                    last_progress = now
+                    self._log_progress()
+
+    def _unblock(self, timeout: float) -> None:
+        # when k6 exited without opening the pipe, the reader is still
+        # waiting for a writer, give it one so it sees the end of the stream
+        deadline = time.monotonic() + timeout
+        while self._thread.is_alive() and time.monotonic() < deadline:
+            try:
+                os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self._thread.join(0.05)
+
+    def _log_progress(self) -> None:
+        window = self.aggregator.window("http_req_duration", 10)
+        if window["count"]:
+            logger.info(
+                "k6 last 10s: %.1f req/s, p95 %.1fms, p99 %.1fms",
+                window["rate"],
+                window["p95"],
+                window["p99"],
+            )
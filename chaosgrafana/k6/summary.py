@@ -0,0 +1,199 @@
+""" Parsing of the end-of-test summary exported by Grafana k6 """
+import json
+import logging
+import os
+from typing import Any, Dict, List
+
+from .stream import MetricsAggregator, QuantileSketch
+
+__all__ = ["load_summary", "parse_summary", "merge_results", "log_result"]
+
+# Trend statistics k6 is asked to export for every trend metric
+SUMMARY_TREND_STATS = "avg,min,med,max,p(50),p(90),p(95),p(99)"
+
+# The logger the Loki control ships, results go nowhere when it is disabled
+results_logger = logging.getLogger("chaostoolkit-loki")
+
+
+def load_summary(path: str) -> Dict[str, Any]:
+    """
+    Load a summary written by `k6 run --summary-export`. Returns an empty
+    summary when k6 did not write it, for instance when the script failed to
+    compile.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def parse_summary(summary: Dict[str, Any], exit_code: int) -> Dict[str, Any]:
+    """
+    Turn a k6 summary into a compact result for tolerances to assert on.
+
+    Latencies are in milliseconds, rates are per second except for the
+    `failure_rate` which is the ratio of failed requests. Thresholds are
+    reported per metric, `True` meaning the threshold was met. Sub-metrics
+    k6 reported, such as `http_req_duration{endpoint:0}`, are listed under
+    `submetrics` with the same statistics as their parent metric.
+    """
+    metrics = summary.get("metrics", {})
+    duration = _trend(metrics.get("http_req_duration", {}))
+    reqs = metrics.get("http_reqs", {})
+    failed = metrics.get("http_req_failed", {})
+    iterations = metrics.get("iterations", {})
+
+    thresholds = {}
+    submetrics = {}
+    for name, metric in metrics.items():
+        for expression, breached in metric.get("thresholds", {}).items():
+            thresholds.setdefault(name, {})[expression] = not breached
+        if "{" in name:
+            submetrics[name] = _compact(metric)
+
+    result = {
+        "success": exit_code == 0,
+        "exit_code": exit_code,
+        "http_req_duration": duration,
+        "http_reqs": reqs.get("count", 0),
+        "request_rate": reqs.get("rate", 0.0),
+        "failure_rate": failed.get("value", 0.0),
+        "iterations": iterations.get("count", 0),
+        "thresholds": thresholds,
+        "thresholds_ok": all(
+            ok for metric in thresholds.values() for ok in metric.values()
+        ),
+    }
+    if submetrics:
+        result["submetrics"] = submetrics
+    return result
+
+
+def merge_results(
+    results: List[Dict[str, Any]], aggregators: List[MetricsAggregator]
+) -> Dict[str, Any]:
+    """
+    Merge the results of k6 processes that each ran a segment of the same
+    test into a single result.
+
+    Percentiles are computed from the merged sketches of the samples each
+    process streamed, not averaged across processes. Counts and rates are
+    summed and a threshold is met only when it was met by every process.
+    """
+    duration = QuantileSketch()
+    failed = QuantileSketch()
+    for aggregator in aggregators:
+        duration.merge(aggregator.sketch("http_req_duration"))
+        failed.merge(aggregator.sketch("http_req_failed"))
+
+    stats = duration.stats()
+    thresholds = {}
+    for result in results:
+        for name, expressions in result["thresholds"].items():
+            merged = thresholds.setdefault(name, {})
+            for expression, ok in expressions.items():
+                merged[expression] = merged.get(expression, True) and ok
+
+    exit_codes = [r["exit_code"] for r in results if r["exit_code"] != 0]
+    return {
+        "success": all(r["success"] for r in results),
+        "exit_code": exit_codes[0] if exit_codes else 0,
+        "http_req_duration": {
+            k: stats.get(k)
+            for k in ("avg", "min", "max", "p50", "p90", "p95", "p99")
+        },
+        "http_reqs": sum(r["http_reqs"] for r in results),
+        "request_rate": sum(r["request_rate"] for r in results),
+        "failure_rate": failed.sum / failed.count if failed.count else 0.0,
+        "iterations": sum(r["iterations"] for r in results),
+        "thresholds": thresholds,
+        "thresholds_ok": all(r["thresholds_ok"] for r in results),
+        "segments": results,
+    }
+
+
+def log_result(result: Dict[str, Any], script: str) -> None:
+    """
+    Send a result to Loki, through the Loki control, as a single line of
+    `key=value` pairs which LogQL aggregates with `| logfmt | unwrap <key>`.
+
+    The line belongs to a `type="k6-result"` stream which, like every record
+    of the control, is labelled with the run's `chaostoolkit_run_trace_id`.
+    """
+    if not results_logger.isEnabledFor(logging.INFO):
+        return
+
+    fields = _result_fields(result, script)
+    results_logger.info(
+        " ".join(f"{k}={_logfmt_value(v)}" for k, v in fields.items()),
+        extra={
+            "tags": {
+                "type": "k6-result",
+                "name": fields["script"],
+                "status": "succeeded" if result["success"] else "failed",
+            },
+            "fields": fields,
+        },
+    )
+
+
+def _result_fields(result: Dict[str, Any], script: str) -> Dict[str, Any]:
+    """The figures of a result, flattened into a single level mapping."""
+    fields = {
+        "script": os.path.basename(script),
+        "success": result["success"],
+        "exit_code": result["exit_code"],
+        "http_reqs": result["http_reqs"],
+        "request_rate": result["request_rate"],
+        "failure_rate": result["failure_rate"],
+        "iterations": result["iterations"],
+        "thresholds_ok": result["thresholds_ok"],
+    }
+    for stat, value in result["http_req_duration"].items():
+        fields[f"http_req_duration_{stat}"] = value
+
+    breach = result.get("threshold_breach")
+    if breach:
+        fields["threshold_breach"] = f"{breach['metric']}:{breach['threshold']}"
+
+    return {
+        k: round(v, 3) if isinstance(v, float) else v
+        for k, v in fields.items()
+        if v is not None
+    }
+
+
+def _trend(metric: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "avg": metric.get("avg"),
+        "min": metric.get("min"),
+        "max": metric.get("max"),
+        "p50": metric.get("p(50)", metric.get("med")),
+        "p90": metric.get("p(90)"),
+        "p95": metric.get("p(95)"),
+        "p99": metric.get("p(99)"),
+    }
+
+
+def _compact(metric: Dict[str, Any]) -> Dict[str, Any]:
+    if "avg" in metric:
+        return _trend(metric)
+    if "passes" in metric:
+        return {
+            "rate": metric.get("value"),
+            "passes": metric.get("passes"),
+            "fails": metric.get("fails"),
+        }
+    if "count" in metric:
+        return {"count": metric.get("count"), "rate": metric.get("rate")}
+    return {"value": metric.get("value")}
+
+
+def _logfmt_value(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    value = str(value)
+    if value and not any(c in value for c in ' ="\\\n'):
+        return value
+    return json.dumps(value)
@@ -0,0 +1,199 @@
+""" Thresholds evaluated against the live Grafana k6 metric stream """
+import math
+import operator
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from logzero import logger
+
+from .driver import parse_duration
+from .stream import MetricsAggregator, QuantileSketch
+
+__all__ = ["Threshold", "ThresholdMonitor", "parse_thresholds"]
+
+DEFAULT_WINDOW = "10s"
+DEFAULT_CHECK_INTERVAL = 1.0
+# Samples per second are not evaluated over less than this many seconds
+MIN_RATE_ELAPSED = 1.0
+
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+EXPRESSION = re.compile(
+    r"^\s*(?P<stat>avg|min|max|med|count|rate|p\((?P<q>\d+(?:\.\d+)?)\))"
+    r"\s*(?P<op><=|>=|==|!=|<|>)"
+    r"\s*(?P<value>-?\d+(?:\.\d+)?)\s*$"
+)
+
+
+class Threshold:
+    """
+    A condition a metric must meet over a sliding window, written like a k6
+    threshold, for instance `p(95)<500` on `http_req_duration` or `rate<0.05`
+    on `http_req_failed`.
+
+    As in k6, `rate` is the ratio of non-zero samples for rate metrics, such
+    as `http_req_failed`, and the number of samples per second otherwise.
+    Until the window has filled, the latter is computed over the time since
+    the first sample, and not before a second has passed.
+    """
+
+    def __init__(self, metric: str, threshold: str, window: str = None):
+        match = EXPRESSION.match(threshold)
+        if match is None:
+            raise ValueError(f"Invalid threshold '{threshold}' on '{metric}'")
+
+        self.metric = metric
+        self.threshold = threshold
+        self.window = window or DEFAULT_WINDOW
+        self.seconds = max(1, math.ceil(parse_duration(self.window)))
+        self.stat = match.group("stat")
+        q = match.group("q")
+        self.quantile = float(q) / 100 if q else None
+        self.compare = OPERATORS[match.group("op")]
+        self.limit = float(match.group("value"))
+
+    def observe(
+        self,
+        sketch: QuantileSketch,
+        metric_type: str = None,
+        elapsed: float = None,
+    ) -> float:
+        """
+        The value of the threshold statistic for these samples, gathered over
+        `elapsed` seconds when the window is not full yet
+        """
+        if self.quantile is not None:
+            return sketch.quantile(self.quantile)
+        if self.stat == "med":
+            return sketch.quantile(0.5)
+        if self.stat == "count":
+            return sketch.count
+        if self.stat == "rate":
+            if metric_type == "rate":
+                return sketch.sum / sketch.count
+            seconds = self.seconds
+            if elapsed is not None:
+                seconds = min(seconds, max(elapsed, MIN_RATE_ELAPSED))
+            return sketch.count / seconds
+        if self.stat == "avg":
+            return sketch.sum / sketch.count
+        return getattr(sketch, self.stat)
+
+    def check(
+        self, aggregators: List[MetricsAggregator]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Evaluate the threshold over its window, across all the aggregators,
+        and return the breach when it is not met. Windows without samples are
+        not evaluated, nor are samples per second during the first second.
+        """
+        sketch = QuantileSketch()
+        metric_type = None
+        elapsed = 0.0
+        for aggregator in aggregators:
+            sketch.merge(aggregator.window_sketch(self.metric, self.seconds))
+            metric_type = metric_type or aggregator.types.get(self.metric)
+            elapsed = max(elapsed, aggregator.elapsed(self.metric))
+
+        if sketch.count == 0:
+            return None
+        per_second = self.stat == "rate" and metric_type != "rate"
+        if per_second and elapsed < MIN_RATE_ELAPSED:
+            return None
+
+        value = self.observe(sketch, metric_type, elapsed)
+        if self.compare(value, self.limit):
+            return None
+        return {
+            "metric": self.metric,
+            "threshold": self.threshold,
+            "window": self.window,
+            "value": value,
+        }
+
+
+class ThresholdMonitor:
+    """
+    Background thread checking thresholds every `interval` seconds while k6
+    runs. The first breach is recorded and passed to `on_breach`, which
+    typically interrupts k6, after which the monitor stops checking.
+    """
+
+    def __init__(
+        self,
+        aggregators: List[MetricsAggregator],
+        thresholds: List[Threshold],
+        on_breach: Callable[[Dict[str, Any]], None],
+        interval: float = DEFAULT_CHECK_INTERVAL,
+    ):
+        self.aggregators = aggregators
+        self.thresholds = thresholds
+        self.on_breach = on_breach
+        self.interval = interval
+        self.breach = None
+        self._started = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._started = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._watch, name="chaosgrafana-k6-thresholds", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> Optional[Dict[str, Any]]:
+        """Stop checking and return the breach, if any"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.breach
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.interval):
+            for threshold in self.thresholds:
+                breach = threshold.check(self.aggregators)
+                if breach is not None:
+                    breach["at"] = time.time()
+                    breach["elapsed"] = time.monotonic() - self._started
+                    self.breach = breach
+                    logger.warning(
+                        "k6 threshold '%s' on %s breached after %.1fs "
+                        "(%s over %s), stopping k6",
+                        threshold.threshold,
+                        threshold.metric,
+                        breach["elapsed"],
+                        breach["value"],
+                        threshold.window,
+                    )
+                    self.on_breach(breach)
+                    return
+
+
+def parse_thresholds(thresholds: List[Dict[str, str]]) -> List[Threshold]:
+    """
+    Build thresholds from their declaration in an experiment, each a mapping
+    with `metric`, `threshold` and, optionally, `window` keys
+    """
+    parsed = []
+    for declaration in thresholds or []:
+        if "metric" not in declaration or "threshold" not in declaration:
+            raise ValueError(
+                "A threshold must declare its 'metric' and 'threshold'"
+            )
+        parsed.append(
+            Threshold(
+                declaration["metric"],
+                declaration["threshold"],
+                declaration.get("window"),
+            )
+        )
+    return parsed
@@ -0,0 +1,24 @@
+""" Trace context the Grafana k6 runs carry """
+from typing import Callable, Optional
+
+__all__ = ["set_traceparent_source", "current_traceparent"]
+
+# Environment variable carrying the current span to child processes, as
+# OpenTelemetry's environment carrier does, k6 scripts read it
+TRACEPARENT_ENV = "TRACEPARENT"
+
+# Tells the traceparent of the calling thread, set by the Loki control when
+# the run is traced
+_source: Optional[Callable[[], Optional[str]]] = None
+
+
+def set_traceparent_source(source: Optional[Callable[[], Optional[str]]]):
+    """Read the traceparent of the k6 runs started from now on from `source`"""
+    global _source
+    _source = source
+
+
+def current_traceparent() -> Optional[str]:
+    """The `traceparent` of the span the calling thread runs in, if any"""
+    source = _source
+    return source() if source is not None else None
@@ -0,0 +1,232 @@
+""" Client of the Loki query API, with paginated and incremental queries """
+import math
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+__all__ = ["LokiQueryClient", "MetricWindow", "LogWindow", "LokiQueryError"]
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_QUERY_TIMEOUT = 30.0
+NANOSECONDS = 1_000_000_000
+
+Labels = Tuple[Tuple[str, str], ...]
+Entry = Tuple[int, Labels, str]
+
+
+class LokiQueryError(Exception):
+    """Loki rejected a query or could not be reached"""
+
+
+class LokiQueryClient:
+    """
+    Run LogQL queries against the `query_range` endpoint of a Loki service,
+    over a single pooled keep-alive session. Times are in nanoseconds.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        tenant: str = None,
+        auth: Tuple[str, str] = None,
+        timeout: float = DEFAULT_QUERY_TIMEOUT,
+    ):
+        self.url = f"{endpoint.rstrip('/')}/loki/api/v1/query_range"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = tuple(auth) if auth else None
+        if tenant:
+            self.session.headers["X-Scope-OrgID"] = tenant
+
+    def query_range(self, query: str, start: int, end: int, **params) -> dict:
+        """The `data` of the response to a `query_range` request."""
+        try:
+            response = self.session.get(
+                self.url,
+                params={"query": query, "start": start, "end": end, **params},
+                timeout=self.timeout,
+            )
+        except requests.RequestException as x:
+            raise LokiQueryError(f"Failed to query Loki: {x}") from x
+
+        if response.status_code != 200:
+            raise LokiQueryError(
+                f"Loki answered {response.status_code} to '{query}': "
+                f"{response.text.strip()}"
+            )
+        return response.json()["data"]
+
+    def matrix(
+        self, query: str, start: int, end: int, step: int
+    ) -> Dict[Labels, List[Tuple[int, float]]]:
+        """
+        Evaluate a metric query every `step` seconds from `start` to `end`
+        and return the samples of each series, keyed by its label set.
+        """
+        data = self.query_range(query, start, end, step=step)
+        if data.get("resultType") != "matrix":
+            raise LokiQueryError(f"'{query}' is not a LogQL metric query")
+
+        return {
+            _labels(series.get("metric")): [
+                (round(float(ts) * 1000) * 1_000_000, float(value))
+                for ts, value in series.get("values", [])
+            ]
+            for series in data.get("result", [])
+        }
+
+    def stream_lines(
+        self,
+        query: str,
+        start: int,
+        end: int,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> Iterator[Entry]:
+        """
+        Yield the lines matching a log query from `start` to `end`, oldest
+        first, fetching them `page_size` at a time so a large result is never
+        held in memory at once.
+
+        Each page starts at the timestamp of the last line of the previous
+        one, the lines of that timestamp already yielded are skipped.
+        """
+        seen_at_boundary = set()
+        while start < end:
+            data = self.query_range(
+                query, start, end, limit=page_size, direction="forward"
+            )
+            if data.get("resultType") != "streams":
+                raise LokiQueryError(f"'{query}' is not a LogQL log query")
+
+            entries = sorted(
+                (int(ts), _labels(stream.get("stream")), line)
+                for stream in data.get("result", [])
+                for ts, line in stream.get("values", [])
+            )
+
+            fresh = [e for e in entries if e not in seen_at_boundary]
+            yield from fresh
+
+            if len(entries) < page_size:
+                return
+
+            last = entries[-1][0]
+            if fresh:
+                boundary = {e for e in entries if e[0] == last}
+                seen_at_boundary = (
+                    boundary | seen_at_boundary if last == start else boundary
+                )
+                start = last
+            else:
+                # a full page of lines all sharing one timestamp was already
+                # seen, there is no way to page within it
+                start = last + 1
+                seen_at_boundary = set()
+
+
+class MetricWindow:
+    """
+    Samples of a metric query over a sliding window, kept between
+    evaluations so that each one only fetches the samples added since the
+    previous one.
+
+    Evaluation times are aligned to the step so the samples of successive
+    fetches fall on the same grid. The last sample fetched is fetched again,
+    as it may have been computed before all its lines were ingested.
+    """
+
+    def __init__(self, query: str, window: float, step: float):
+        self.query = query
+        self.window = int(window * NANOSECONDS)
+        self.step = max(1, int(step))
+        self.series: Dict[Labels, Dict[int, float]] = {}
+        self.fetched_until: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def update(
+        self, client: LokiQueryClient, now: int
+    ) -> Dict[Labels, Dict[int, float]]:
+        """Fetch the new samples of the window ending `now`."""
+        step = self.step * NANOSECONDS
+        start = -_align(self.window - now, step)
+        with self._lock:
+            fetch_from = start
+            if self.fetched_until is not None:
+                fetch_from = max(start, _align(self.fetched_until, step))
+
+            matrix = client.matrix(self.query, fetch_from, now, self.step)
+            for labels, samples in matrix.items():
+                self.series.setdefault(labels, {}).update(samples)
+            self.fetched_until = now
+
+            for labels in list(self.series):
+                samples = self.series[labels]
+                for ts in [ts for ts in samples if ts < start]:
+                    del samples[ts]
+                if not samples:
+                    del self.series[labels]
+            return {labels: dict(s) for labels, s in self.series.items()}
+
+
+class LogWindow:
+    """
+    Number of lines a log query matched over a sliding window, counted per
+    second and kept between evaluations so that each one only streams the
+    lines logged since the previous one.
+
+    Lines ingested after a later line was already fetched are not counted.
+    """
+
+    def __init__(self, query: str, window: float, page_size: int):
+        self.query = query
+        self.window = int(window * NANOSECONDS)
+        self.page_size = page_size
+        self.counts: Deque[Tuple[int, int]] = deque()
+        self.fetched_until: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def update(self, client: LokiQueryClient, now: int) -> int:
+        """Stream the new lines of the window ending `now` and count all."""
+        start = now - self.window
+        with self._lock:
+            fetch_from = start
+            if self.fetched_until is not None:
+                fetch_from = max(start, self.fetched_until)
+
+            last = None
+            try:
+                lines = client.stream_lines(
+                    self.query, fetch_from, now, self.page_size
+                )
+                for ts, _, _ in lines:
+                    second = ts // NANOSECONDS
+                    if self.counts and self.counts[-1][0] == second:
+                        self.counts[-1] = (second, self.counts[-1][1] + 1)
+                    else:
+                        self.counts.append((second, 1))
+                    last = ts
+            except LokiQueryError:
+                # the lines counted so far must not be counted again
+                if last is not None:
+                    self.fetched_until = last + 1
+                raise
+            self.fetched_until = now
+
+            oldest = math.ceil(start / NANOSECONDS)
+            while self.counts and self.counts[0][0] < oldest:
+                self.counts.popleft()
+            return sum(count for _, count in self.counts)
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _labels(labels: Optional[Dict[str, Any]]) -> Labels:
+    return tuple(sorted((str(k), str(v)) for k, v in (labels or {}).items()))
+
+
+def _align(ts: int, step: int) -> int:
+    # the latest multiple of `step` up to `ts`
+    return ts - ts % step
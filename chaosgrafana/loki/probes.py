@@ -0,0 +1,160 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple
+
+from chaoslib.types import Configuration, Secrets
+
+from ..k6.driver import parse_duration
+from .client import (
+    DEFAULT_PAGE_SIZE,
+    LogWindow,
+    LokiQueryClient,
+    MetricWindow,
+)
+
+__all__ = ["query_metric", "count_log_lines"]
+
+DEFAULT_LOKI_URL = "http://localhost:3100"
+REDUCERS = {
+    "max": max,
+    "min": min,
+    "avg": lambda values: sum(values) / len(values),
+    "sum": sum,
+}
+
+# Clients and windows outlive a single call, so that repeated evaluations,
+# as in a continuous hypothesis, reuse connections and only fetch what is new
+_clients: Dict[Tuple, LokiQueryClient] = {}
+_windows: Dict[Tuple, Any] = {}
+_lock = threading.Lock()
+
+
+def query_metric(
+    query: str,
+    window: str = "5m",
+    step: str = "15s",
+    reduce: str = "max",
+    loki_endpoint: str = DEFAULT_LOKI_URL,
+    tenant: str = None,
+    configuration: Configuration = None,
+    secrets: Secrets = None,
+) -> float:
+    """
+    Evaluate a LogQL metric query, such as
+    `sum(rate({app="checkout"} |= "error" [1m]))`, over the last `window` and
+    reduce its samples to a single value, for instance to check that the
+    error log rate stays below some number of lines per second.
+
+    Parameters
+    ----------
+    query : str
+        A LogQL metric query, such as `rate` or `count_over_time`
+    window : str
+        How far back to evaluate the query. Expressed as a duration string,
+        i.e "30s", "5m", "1h" etc.
+    step : str
+        How often, within the window, the query is evaluated
+    reduce : str
+        How the samples of every series over the window are reduced to the
+        returned value: `"max"`, `"min"`, `"avg"`, `"sum"` or `"last"`, the
+        highest value of the latest evaluation
+    loki_endpoint : str
+        The base url of the Loki service
+    tenant : str
+        Sent in the `X-Scope-OrgID` header to multi-tenant Lokis
+
+    Returns the reduced value, or `0` when the query matched no sample.
+    The samples are cached per query and window, subsequent calls only fetch
+    those evaluated since the previous call.
+    """
+    if reduce not in REDUCERS and reduce != "last":
+        raise ValueError(
+            f"Unknown reducer '{reduce}', use one of "
+            f"{', '.join([*REDUCERS, 'last'])}"
+        )
+
+    seconds = parse_duration(window)
+    step_seconds = max(1, round(parse_duration(step)))
+    client = _client(loki_endpoint, tenant, secrets)
+    metric = _window(
+        ("metric", loki_endpoint, tenant, query, seconds, step_seconds),
+        lambda: MetricWindow(query, seconds, step_seconds),
+    )
+
+    series = metric.update(client, time.time_ns())
+    if reduce == "last":
+        latest = max((ts for s in series.values() for ts in s), default=None)
+        values = [s[latest] for s in series.values() if latest in s]
+        reduce = "max"
+    else:
+        values = [value for s in series.values() for value in s.values()]
+
+    if not values:
+        return 0
+    return REDUCERS[reduce](values)
+
+
+def count_log_lines(
+    query: str,
+    window: str = "5m",
+    page_size: int = DEFAULT_PAGE_SIZE,
+    loki_endpoint: str = DEFAULT_LOKI_URL,
+    tenant: str = None,
+    configuration: Configuration = None,
+    secrets: Secrets = None,
+) -> int:
+    """
+    Count the lines a LogQL log query, such as
+    `{app="checkout"} |= "error"`, matched over the last `window`.
+
+    Parameters
+    ----------
+    query : str
+        A LogQL log query
+    window : str
+        How far back to count lines. Expressed as a duration string,
+        i.e "30s", "5m", "1h" etc.
+    page_size : int
+        How many lines are fetched per request, lines are streamed page by
+        page and never all held in memory
+    loki_endpoint : str
+        The base url of the Loki service
+    tenant : str
+        Sent in the `X-Scope-OrgID` header to multi-tenant Lokis
+
+    Returns the number of lines. Counts are cached per second, per query and
+    window, subsequent calls only fetch the lines logged since the previous
+    call.
+    """
+    seconds = parse_duration(window)
+    client = _client(loki_endpoint, tenant, secrets)
+    lines = _window(
+        ("log", loki_endpoint, tenant, query, seconds, page_size),
+        lambda: LogWindow(query, seconds, page_size),
+    )
+    return lines.update(client, time.time_ns())
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _client(
+    loki_endpoint: str, tenant: str, secrets: Secrets
+) -> LokiQueryClient:
+    auth = (secrets or {}).get("auth")
+    key = (loki_endpoint, tenant, tuple(auth) if auth else None)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = LokiQueryClient(
+                loki_endpoint, tenant, auth
+            )
+        return client
+
+
+def _window(key: Tuple, factory: Callable[[], Any]) -> Any:
+    with _lock:
+        window = _windows.get(key)
+        if window is None:
+            window = _windows[key] = factory()
+        return window
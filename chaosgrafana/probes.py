@@ -0,0 +1,20 @@
+""" Probes about the extension itself """
+from typing import Any, Dict
+
+from .stats import stats
+
+__all__ = ["get_extension_stats"]
+
+
+def get_extension_stats() -> Dict[str, Any]:
+    """
+    Return the counters and timers the extension recorded about itself since
+    the run started, so tolerances can be set on its own overhead.
+
+    Counters include the records enqueued, sent, dropped and spooled by the
+    Loki control and the bytes it sent. Timers, in milliseconds, include the
+    time spent enqueuing a record, Loki push latency, k6 spawn time, time to
+    the first streamed k6 sample and the parsing of the k6 summary. Each has
+    its `count`, `sum`, `avg`, `min`, `max`, `p50`, `p90`, `p95` and `p99`.
+    """
+    return stats.snapshot()
@@ -0,0 +1,88 @@
+""" Self-metrics of the extension, what it costs a Chaos Toolkit run """
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+from .k6.stream import QuantileSketch
+
+__all__ = ["ExtensionStats", "stats"]
+
+
+class ExtensionStats:
+    """
+    Counters and timers the Loki control and the k6 driver record about
+    themselves, such as records sent to Loki or how long k6 took to spawn.
+
+    Timers keep a quantile sketch of their durations, in milliseconds, so
+    their memory does not grow with the length of the run.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters: Dict[str, float] = {}
+        self._timers: Dict[str, QuantileSketch] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            sketch = self._timers.get(name)
+            if sketch is None:
+                sketch = self._timers[name] = QuantileSketch()
+            sketch.add(seconds * 1000)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Time the enclosed block, whether it raises or not"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The counters and the statistics of the timers, in milliseconds"""
+        with self._lock:
+            timers = self._timers.items()
+            return {
+                "since": self.started,
+                "counters": dict(self._counters),
+                "timers": {name: sketch.stats() for name, sketch in timers},
+            }
+
+    def fields(self) -> Dict[str, Any]:
+        """
+        The snapshot flattened into a single level mapping, such as
+        `loki_push_p95_ms`, fit for a log line
+        """
+        snapshot = self.snapshot()
+        fields = {}
+        for name, value in snapshot["counters"].items():
+            fields[_field_name(name)] = value
+        for name, timer in snapshot["timers"].items():
+            prefix = _field_name(name)
+            fields[f"{prefix}_count"] = timer["count"]
+            for stat in ("avg", "max", "p50", "p95", "p99"):
+                fields[f"{prefix}_{stat}_ms"] = round(timer[stat], 3)
+        return fields
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.time()
+            self._counters.clear()
+            self._timers.clear()
+
+
+#: The statistics of this process, shared by every part of the extension
+stats = ExtensionStats()
+
+
+###############################################################################
+# Private functions
+###############################################################################
+def _field_name(name: str) -> str:
+    return name.replace(".", "_")
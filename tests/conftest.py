@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import patch
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def no_k6_archive():
+    # k6 is never really run by the tests, so neither are its archives built
+    with patch("chaosgrafana.k6.archive.k6_version", return_value=None):
+        yield
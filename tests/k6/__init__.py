@@ -1,4 +1,8 @@
 from pathlib import Path
+from typing import List
+from unittest.mock import ANY
+
+from chaosgrafana.k6.summary import SUMMARY_TREND_STATS
 
 
 class MockSubprocessContext:
@@ -9,10 +13,35 @@ class MockSubprocessContext:
     def __enter__(self):
         return self
 
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, sig):
+        self.returncode = -sig
+
+    def kill(self):
+        self.returncode = -9
+
     def __exit__(self, type, value, traceback):
         pass
 
 
+def k6_run_command(*args: str) -> List:
+    return [
+        "k6",
+        "run",
+        "--quiet",
+        "--summary-export",
+        ANY,
+        "--summary-trend-stats",
+        SUMMARY_TREND_STATS,
+        *args,
+    ]
+
+
 def full_plugin_path(path: str) -> str:
     basePath = Path(__file__).parent.parent
     return str(basePath.parent) + f"/chaosgrafana/{path}"
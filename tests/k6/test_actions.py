@@ -1,14 +1,17 @@
+import json
 from unittest.mock import ANY, patch
 
+import pytest
+
 from chaosgrafana.k6.actions import run_script, stress_endpoint
 
-from . import MockSubprocessContext, full_plugin_path
+from . import MockSubprocessContext, full_plugin_path, k6_run_command
 
 
 @patch("subprocess.Popen")
 @patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
 def test_run_script(mocked_popen):
-    mocked_popen.return_value = MockSubprocessContext(returncode=None)
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
 
     result = run_script(
         script_path="../myscript.js",
@@ -17,21 +20,18 @@ def test_run_script(mocked_popen):
         debug=True,
     )
 
-    assert result is True
+    assert result["success"] is True
     mocked_popen.assert_called_once_with(
-        [
-            "k6",
-            "run",
-            "--quiet",
+        k6_run_command(
             "--vus",
             "5",
             "--duration",
             "10m",
             "../myscript.js",
-        ],
+        ),
         stderr=ANY,
         stdout=ANY,
-        env={},
+        env=None,
     )
 
 
@@ -42,7 +42,7 @@ def test_run_script(mocked_popen):
     clear=True,
 )
 def test_run_script_env_overrides(mocked_popen):
-    mocked_popen.return_value = MockSubprocessContext(returncode=None)
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
 
     result = run_script(
         script_path="../myscript.js",
@@ -52,18 +52,15 @@ def test_run_script_env_overrides(mocked_popen):
         environ={"TEST": "newvalue"},
     )
 
-    assert result is True
+    assert result["success"] is True
     mocked_popen.assert_called_once_with(
-        [
-            "k6",
-            "run",
-            "--quiet",
+        k6_run_command(
             "--vus",
             "5",
             "--duration",
             "10m",
             "../myscript.js",
-        ],
+        ),
         stderr=ANY,
         stdout=ANY,
         env={"TEST": "newvalue", "OTHER": "123"},
@@ -73,7 +70,7 @@ def test_run_script_env_overrides(mocked_popen):
 @patch("subprocess.Popen")
 @patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
 def test_run_script_stages(mocked_popen):
-    mocked_popen.return_value = MockSubprocessContext(returncode=None)
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
 
     result = run_script(
         script_path="../myscript.js",
@@ -85,12 +82,9 @@ def test_run_script_stages(mocked_popen):
         debug=True,
     )
 
-    assert result is True
+    assert result["success"] is True
     mocked_popen.assert_called_once_with(
-        [
-            "k6",
-            "run",
-            "--quiet",
+        k6_run_command(
             "--stage",
             "10m:10",
             "--stage",
@@ -98,17 +92,17 @@ def test_run_script_stages(mocked_popen):
             "--stage",
             "1h10m2s:100",
             "../myscript.js",
-        ],
+        ),
         stderr=ANY,
         stdout=ANY,
-        env={},
+        env=None,
     )
 
 
 @patch("subprocess.Popen")
 @patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
 def test_run_script_iterations(mocked_popen):
-    mocked_popen.return_value = MockSubprocessContext(returncode=None)
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
 
     result = run_script(
         script_path="../myscript.js",
@@ -118,28 +112,25 @@ def test_run_script_iterations(mocked_popen):
         debug=True,
     )
 
-    assert result is True
+    assert result["success"] is True
     mocked_popen.assert_called_once_with(
-        [
-            "k6",
-            "run",
-            "--quiet",
+        k6_run_command(
             "--iterations",
             "10",
             "--vus",
             "2",
             "../myscript.js",
-        ],
+        ),
         stderr=ANY,
         stdout=ANY,
-        env={},
+        env=None,
     )
 
 
 @patch("subprocess.Popen")
 @patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
 def test_stress_endpoint(mocked_popen):
-    mocked_popen.return_value = MockSubprocessContext(returncode=None)
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
 
     result = stress_endpoint(
         endpoint="http://localhost:3000",
@@ -150,10 +141,104 @@ def test_stress_endpoint(mocked_popen):
 
     js_path = full_plugin_path("k6/scripts/single-endpoint.js")
 
-    assert result is True
+    assert result["success"] is True
     mocked_popen.assert_called_once_with(
-        ["k6", "run", "--quiet", "--vus", "100", "--duration", "10m", js_path],
+        k6_run_command("--vus", "100", "--duration", "10m", js_path),
         stderr=ANY,
         stdout=ANY,
         env={"CHAOS_K6_URL": "http://localhost:3000"},
     )
+
+
+def _segments(mocked_popen, samples):
+    """A fake k6 whose every process streams its own segment's samples"""
+
+    def k6(cmd, **kwargs):
+        segment = len(mocked_popen.call_args_list) - 1
+        with open(cmd[4], "w") as f:
+            json.dump(
+                {
+                    "metrics": {
+                        "http_reqs": {"count": len(samples[segment]), "rate": 1}
+                    }
+                },
+                f,
+            )
+        with open(cmd[8].split("=", 1)[1], "w") as f:
+            for value in samples[segment]:
+                f.write(
+                    json.dumps(
+                        {
+                            "type": "Point",
+                            "metric": "http_req_duration",
+                            "data": {"value": value, "tags": {}},
+                        }
+                    )
+                    + "\n"
+                )
+        return MockSubprocessContext(returncode=0)
+
+    return k6
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_run_script_distributed(mocked_popen):
+    mocked_popen.side_effect = _segments(
+        mocked_popen, [[10] * 100, [1000] * 10]
+    )
+
+    result = run_script(
+        script_path="../myscript.js",
+        vus=10,
+        duration="10s",
+        distributed=True,
+        processes=2,
+    )
+
+    assert result["success"] is True
+    assert result["http_reqs"] == 110
+    assert result["request_rate"] == 2
+    assert result["http_req_duration"]["p90"] == pytest.approx(10, rel=0.01)
+    assert result["http_req_duration"]["max"] == 1000
+    assert len(result["segments"]) == 2
+
+    commands = [c[0][0] for c in mocked_popen.call_args_list]
+    assert commands[0][9:] == [
+        "--vus",
+        "10",
+        "--duration",
+        "10s",
+        "--execution-segment",
+        "0:1/2",
+        "--execution-segment-sequence",
+        "0,1/2,1",
+        "../myscript.js",
+    ]
+    assert commands[1][14] == "1/2:1"
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_run_script_distributed_with_streamed_metrics(mocked_popen):
+    mocked_popen.side_effect = _segments(
+        mocked_popen, [[10] * 100, [1000] * 10]
+    )
+
+    result = run_script(
+        script_path="../myscript.js",
+        distributed=True,
+        processes=2,
+        stream_metrics=True,
+    )
+
+    metrics = result["metrics"]
+    assert metrics["samples"] == 110
+    [series] = metrics["series"]
+    assert series["metric"] == "http_req_duration"
+    assert series["count"] == 110
+    assert series["max"] == 1000
+    window = metrics["windows"]["10s"]["http_req_duration"]
+    assert window["count"] == 110
+    assert window["p90"] == pytest.approx(10, rel=0.01)
+    assert all("metrics" not in s for s in result["segments"])
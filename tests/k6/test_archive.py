@@ -0,0 +1,135 @@
+import os
+from unittest.mock import patch
+
+from chaosgrafana.k6.actions import run_script
+from chaosgrafana.k6.archive import archive_script
+from chaosgrafana.k6.probes import http
+
+from . import MockSubprocessContext
+
+
+class CompletedProcess:
+    def __init__(self, cmd, returncode=0):
+        self.returncode = returncode
+        self.stderr = ""
+        if returncode == 0:
+            with open(cmd[4], "w") as f:
+                f.write("archive")
+
+
+@patch("chaosgrafana.k6.archive.subprocess.run")
+@patch("chaosgrafana.k6.archive.k6_version", return_value="k6 v0.45.0")
+def test_archive_is_built_once(k6_version, mocked_run, tmp_path):
+    script = tmp_path / "script.js"
+    script.write_text("export default function () {}")
+    mocked_run.side_effect = lambda cmd, **kwargs: CompletedProcess(cmd)
+
+    with patch.dict(os.environ, {"CHAOSGRAFANA_K6_CACHE_DIR": str(tmp_path)}):
+        first = archive_script(str(script), {"CHAOS_K6_URL": "http://a"})
+        second = archive_script(str(script), {"CHAOS_K6_URL": "http://a"})
+        other = archive_script(str(script), {"CHAOS_K6_URL": "http://b"})
+
+    assert first == second
+    assert first.endswith(".tar")
+    assert os.path.dirname(first) == str(tmp_path)
+    assert other != first
+    assert mocked_run.call_count == 2
+    cmd = mocked_run.call_args_list[0][0][0]
+    assert cmd[:3] == ["k6", "archive", "--quiet"]
+    assert cmd[5:] == ["-e", "CHAOS_K6_URL=http://a", str(script)]
+
+
+@patch("chaosgrafana.k6.archive.subprocess.run")
+@patch("chaosgrafana.k6.archive.k6_version", return_value="k6 v0.45.0")
+def test_script_is_run_as_is_when_it_cannot_be_archived(
+    k6_version, mocked_run, tmp_path
+):
+    script = tmp_path / "script.js"
+    script.write_text("syntax error")
+    mocked_run.side_effect = lambda cmd, **kwargs: CompletedProcess(cmd, 107)
+
+    with patch.dict(os.environ, {"CHAOSGRAFANA_K6_CACHE_DIR": str(tmp_path)}):
+        assert archive_script(str(script)) == str(script)
+
+    assert os.listdir(tmp_path) == ["script.js"]
+
+
+@patch("chaosgrafana.k6.archive.subprocess.run")
+@patch("chaosgrafana.k6.archive.k6_version", return_value="k6 v0.45.0")
+def test_least_recently_used_archives_are_evicted(
+    k6_version, mocked_run, tmp_path
+):
+    script = tmp_path / "script.js"
+    script.write_text("export default function () {}")
+    mocked_run.side_effect = lambda cmd, **kwargs: CompletedProcess(cmd)
+
+    def archive(url):
+        # every archive is 7 bytes, at most two fit in the cache
+        return archive_script(str(script), {"CHAOS_K6_URL": url}, 15)
+
+    with patch.dict(os.environ, {"CHAOSGRAFANA_K6_CACHE_DIR": str(tmp_path)}):
+        a, b = archive("http://a"), archive("http://b")
+        os.utime(a, (1000, 1000))
+        os.utime(b, (2000, 2000))
+        assert archive("http://a") == a
+        c = archive("http://c")
+
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    assert os.path.exists(c)
+    assert mocked_run.call_count == 3
+
+
+def test_script_is_run_as_is_without_k6():
+    assert archive_script("script.js") == "script.js"
+
+
+@patch("chaosgrafana.k6.archive.subprocess.run")
+@patch("chaosgrafana.k6.archive.k6_version", return_value="k6 v0.45.0")
+def test_archive_is_rebuilt_when_an_import_changes(
+    k6_version, mocked_run, tmp_path
+):
+    script = tmp_path / "script.js"
+    script.write_text(
+        'import { check } from "./lib/checks.js";\n'
+        'import http from "k6/http";\n'
+        "export default function () {}"
+    )
+    (tmp_path / "lib").mkdir()
+    lib = tmp_path / "lib" / "checks.js"
+    lib.write_text('import "../script.js";\nexport const check = 1;')
+    mocked_run.side_effect = lambda cmd, **kwargs: CompletedProcess(cmd)
+
+    with patch.dict(os.environ, {"CHAOSGRAFANA_K6_CACHE_DIR": str(tmp_path)}):
+        first = archive_script(str(script))
+        assert archive_script(str(script)) == first
+        lib.write_text("export const check = 2;")
+        second = archive_script(str(script))
+
+    assert second != first
+    assert mocked_run.call_count == 2
+    assert os.stat(second).st_mode & 0o777 == 0o600
+
+
+@patch("subprocess.Popen")
+@patch("chaosgrafana.k6.driver.archive_script")
+def test_user_scripts_are_not_archived_by_default(mocked_archive, mocked_popen):
+    mocked_archive.return_value = "archive.tar"
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
+
+    run_script(script_path="script.js", environ={"TOKEN": "secret"})
+    assert not mocked_archive.called
+
+    run_script(script_path="script.js", archive=True)
+    mocked_archive.assert_called_once_with("script.js", None)
+    assert "archive.tar" in mocked_popen.call_args[0][0]
+
+
+@patch("subprocess.Popen")
+@patch("chaosgrafana.k6.driver.archive_script")
+def test_probes_sending_a_body_are_not_archived(mocked_archive, mocked_popen):
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
+
+    http("http://localhost:3000", method="POST", body='{"token": "secret"}')
+
+    assert not mocked_archive.called
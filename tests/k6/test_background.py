@@ -0,0 +1,73 @@
+import signal
+from unittest.mock import ANY, patch
+
+import pytest
+
+from chaosgrafana.k6.actions import (
+    start_script,
+    start_stress,
+    stop_run,
+    wait_for_run,
+)
+from chaosgrafana.k6.probes import get_run_metrics
+from chaosgrafana.stats import stats
+
+from . import MockSubprocessContext, full_plugin_path, k6_run_command
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_start_script_and_wait_for_it(mocked_popen):
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
+
+    run_id = start_script(script_path="../myscript.js", vus=2, duration="5s")
+    result = wait_for_run(run_id)
+
+    assert result["success"] is True
+    assert result["metrics"]["samples"] == 0
+    mocked_popen.assert_called_once_with(
+        k6_run_command(
+            "--out", ANY, "--vus", "2", "--duration", "5s", "../myscript.js"
+        ),
+        stderr=ANY,
+        stdout=ANY,
+        env=None,
+    )
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_runs_are_recorded_in_extension_stats(mocked_popen):
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
+    stats.reset()
+
+    wait_for_run(start_script(script_path="../myscript.js"))
+
+    snapshot = stats.snapshot()
+    assert snapshot["counters"]["k6.runs"] == 1
+    assert snapshot["timers"]["k6.spawn"]["count"] == 1
+    assert snapshot["timers"]["k6.summary_parse"]["count"] == 1
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_stop_run_interrupts_k6(mocked_popen):
+    process = MockSubprocessContext(returncode=None)
+    mocked_popen.return_value = process
+
+    run_id = start_stress(endpoint="http://localhost:3000", duration="1h")
+    assert get_run_metrics(run_id)["running"] is True
+
+    result = stop_run(run_id)
+
+    assert process.returncode == -signal.SIGINT
+    assert result["exit_code"] == -signal.SIGINT
+    assert get_run_metrics(run_id)["running"] is False
+    assert mocked_popen.call_args[0][0][-1] == full_plugin_path(
+        "k6/scripts/single-endpoint.js"
+    )
+
+
+def test_unknown_run():
+    with pytest.raises(ValueError):
+        wait_for_run("unknown")
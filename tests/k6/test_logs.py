@@ -0,0 +1,138 @@
+import io
+import logging
+import subprocess
+from unittest.mock import ANY, patch
+
+import pytest
+
+from chaosgrafana.k6 import logs
+from chaosgrafana.k6.actions import run_script
+from chaosgrafana.k6.logs import K6LogStreamer, parse_line, set_activity
+from chaosgrafana.stats import stats
+
+from . import MockSubprocessContext, k6_run_command
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def shipped():
+    handler = ListHandler()
+    previous = logs.logs_logger.level
+    logs.logs_logger.addHandler(handler)
+    logs.logs_logger.setLevel(logging.DEBUG)
+    try:
+        yield handler.records
+    finally:
+        logs.logs_logger.removeHandler(handler)
+        logs.logs_logger.setLevel(previous)
+        set_activity(None)
+
+
+def test_parse_logfmt_line():
+    entry = parse_line(
+        'time="2023-01-01T00:00:00Z" level=warning '
+        'msg="Request \\"GET /\\" failed" source=console\n'
+    )
+
+    assert entry == {
+        "time": "2023-01-01T00:00:00Z",
+        "level": "warning",
+        "msg": 'Request "GET /" failed',
+        "source": "console",
+    }
+
+
+def test_parse_json_line():
+    entry = parse_line('{"level":"error","msg":"boom","source":"console"}')
+
+    assert entry == {"level": "error", "msg": "boom", "source": "console"}
+
+
+def test_parse_plain_line():
+    assert parse_line("running (0m01.0s), 5/5 VUs\n") == {
+        "level": "info",
+        "msg": "running (0m01.0s), 5/5 VUs",
+    }
+
+
+def test_lines_are_logged_with_their_level_and_tags(shipped, tmp_path):
+    set_activity("load the shop")
+    log_file = tmp_path / "k6.log"
+    output = (
+        b'level=info msg="hello" source=console\n'
+        b"plain output\n"
+        b'{"level":"error","msg":"boom"}\n'
+    )
+    streamer = K6LogStreamer(
+        io.BytesIO(output), "/tmp/shop.js", str(log_file), batch_size=2
+    )
+    streamer.start()
+    streamer.stop()
+
+    assert [(r.levelno, r.getMessage()) for r in shipped] == [
+        (logging.INFO, "hello"),
+        (logging.INFO, "plain output"),
+        (logging.ERROR, "boom"),
+    ]
+    assert shipped[0].tags == {
+        "type": "k6-log",
+        "name": "shop.js",
+        "activity": "load the shop",
+    }
+    assert shipped[0].fields == {
+        "level": "info",
+        "msg": "hello",
+        "source": "console",
+    }
+    assert log_file.read_bytes() == output
+
+
+def test_lines_beyond_the_buffer_are_dropped_not_waited_for(shipped, tmp_path):
+    log_file = tmp_path / "k6.log"
+    output = b"".join(f"line {i}\n".encode() for i in range(10))
+    streamer = K6LogStreamer(
+        io.BytesIO(output), log_file=str(log_file), max_buffered=4
+    )
+    stats.reset()
+
+    # read everything before anything is shipped
+    streamer._read()
+    streamer._ship()
+    streamer.stop()
+
+    assert [r.getMessage() for r in shipped] == [f"line {i}" for i in range(4)]
+    assert (streamer.lines, streamer.dropped) == (10, 6)
+    assert log_file.read_bytes() == output
+    assert stats.snapshot()["counters"] == {
+        "k6.log_lines": 10,
+        "k6.log_lines_dropped": 6,
+    }
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_run_script_streams_its_output(mocked_popen, shipped):
+    process = MockSubprocessContext(returncode=0)
+    process.stdout = io.BytesIO(b'level=info msg="from k6"\n')
+    mocked_popen.return_value = process
+
+    result = run_script(script_path="../myscript.js", stream_logs=True)
+
+    assert result["success"] is True
+    mocked_popen.assert_called_once_with(
+        k6_run_command("--vus", "1", "--duration", "1s", "../myscript.js"),
+        stderr=subprocess.STDOUT,
+        stdout=subprocess.PIPE,
+        env=ANY,
+    )
+    lines = [r for r in shipped if r.tags["type"] == "k6-log"]
+    assert [r.getMessage() for r in lines] == ["from k6"]
+    assert lines[0].tags["name"] == "myscript.js"
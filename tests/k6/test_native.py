@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from chaosgrafana.k6.native import HTTPConnection
+from chaosgrafana.k6.probes import http
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+    requests = []
+    headers = []
+
+    def do_GET(self):
+        StandInHandler.connections.add(self.client_address)
+        StandInHandler.requests.append((self.command, self.path, self.headers))
+        if self.path == "/slow":
+            time.sleep(0.5)
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"5\r\nhello\r\n0\r\n\r\n")
+            return
+        if self.path == "/close":
+            self.send_response(200)
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(b"bye")
+            self.close_connection = True
+            return
+
+        status = 500 if self.path == "/broken" else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        StandInHandler.requests.append((self.command, self.path, body))
+        StandInHandler.headers.append(self.headers)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    StandInHandler.connections = set()
+    StandInHandler.requests = []
+    StandInHandler.headers = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_python_engine_succeeds(server):
+    result = http(f"{server}/", vus=2, duration="200ms", engine="python")
+
+    assert result["success"] is True
+    assert result["engine"] == "python"
+    assert result["http_reqs"] > 2
+    assert result["failure_rate"] == 0.0
+    assert result["http_req_duration"]["p95"] > 0
+    # each worker keeps its connection alive across requests
+    assert len(StandInHandler.connections) == 2
+
+
+def test_python_engine_aborts_on_unexpected_status(server):
+    result = http(f"{server}/broken", duration="5s", engine="python")
+
+    assert result["success"] is False
+    assert result["http_reqs"] == 1
+    assert result["failure_rate"] == 1.0
+
+
+def test_python_engine_times_out(server):
+    result = http(f"{server}/slow", duration="5s", timeout=0.1, engine="python")
+
+    assert result["success"] is False
+    assert result["http_req_duration"]["max"] < 500
+
+
+def test_python_engine_sends_body_and_headers(server):
+    result = http(
+        f"{server}/items",
+        method="POST",
+        status=201,
+        body='{"a": 1}',
+        headers={"X-Test": "yes"},
+        duration="50ms",
+        engine="python",
+    )
+
+    assert result["success"] is True
+    assert StandInHandler.requests[0] == ("POST", "/items", b'{"a": 1}')
+
+
+@pytest.mark.parametrize("path", ["/chunked", "/close"])
+def test_connection_reads_whole_responses(server, path):
+    async def twice():
+        connection = HTTPConnection(f"{server}{path}")
+        try:
+            return [await connection.request("GET") for _ in range(2)]
+        finally:
+            await connection.close()
+
+    assert asyncio.run(twice()) == [200, 200]
+
+
+def test_python_engine_propagates_trace_context(server, monkeypatch):
+    traceparent = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+    monkeypatch.setattr(
+        "chaosgrafana.k6.native.current_traceparent", lambda: traceparent
+    )
+
+    http(
+        f"{server}/items",
+        method="POST",
+        status=201,
+        duration="10ms",
+        engine="python",
+    )
+
+    assert StandInHandler.headers[0]["traceparent"] == traceparent
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        http("http://localhost:3000", engine="curl")
@@ -1,14 +1,17 @@
+import json
 from unittest.mock import ANY, patch
 
-from chaosgrafana.k6.probes import http
+import pytest
 
-from . import MockSubprocessContext, full_plugin_path
+from chaosgrafana.k6.probes import http, http_many
+
+from . import MockSubprocessContext, full_plugin_path, k6_run_command
 
 
 @patch("subprocess.Popen")
 @patch.dict("chaosgrafana.k6.probes.os.environ", clear=True)
 def test_http(mocked_popen):
-    mocked_popen.return_value = MockSubprocessContext(returncode=None)
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
 
     result = http(
         endpoint="http://localhost:3000",
@@ -31,10 +34,79 @@ def test_http(mocked_popen):
         "CHAOS_K6_DURATION": "10s",
         "CHAOS_K6_HTTP_TIMEOUT": "3",
     }
-    assert result is True
+    assert result["success"] is True
     mocked_popen.assert_called_once_with(
-        ["k6", "run", "--quiet", js_path],
+        k6_run_command(js_path),
         stderr=ANY,
         stdout=ANY,
         env=expected_env,
     )
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.probes.os.environ", clear=True)
+def test_http_many(mocked_popen):
+    def k6(cmd, **kwargs):
+        with open(cmd[4], "w") as f:
+            json.dump(
+                {
+                    "metrics": {
+                        "http_req_duration{endpoint:0}": {
+                            "avg": 10,
+                            "p(95)": 12,
+                        },
+                        "http_req_duration{endpoint:1}": {
+                            "avg": 20,
+                            "p(95)": 25,
+                        },
+                        "failures{endpoint:0}": {
+                            "passes": 0,
+                            "fails": 4,
+                            "value": 0,
+                        },
+                        "failures{endpoint:1}": {
+                            "passes": 1,
+                            "fails": 3,
+                            "value": 0.25,
+                        },
+                    }
+                },
+                f,
+            )
+        return MockSubprocessContext(returncode=99)
+
+    mocked_popen.side_effect = k6
+
+    result = http_many(
+        endpoints=[
+            {"url": "http://localhost:3000/a"},
+            {"url": "http://localhost:3000/b", "method": "POST", "status": 201},
+        ],
+        vus=2,
+        duration="2s",
+    )
+
+    assert result["success"] is False
+    assert [e["success"] for e in result["endpoints"]] == [True, False]
+    assert result["endpoints"][1]["failure_rate"] == 0.25
+    assert result["endpoints"][1]["http_req_duration"]["p95"] == 25
+
+    env = mocked_popen.call_args[1]["env"]
+    assert json.loads(env["CHAOS_K6_ENDPOINTS"])[1] == {
+        "url": "http://localhost:3000/b",
+        "method": "POST",
+        "status": 201,
+        "headers": {},
+        "body": "",
+        "timeout": 1,
+    }
+    assert mocked_popen.call_args[0][0][-1] == full_plugin_path(
+        "k6/scripts/probe-many.js"
+    )
+
+
+def test_http_many_validates_endpoints():
+    with pytest.raises(ValueError):
+        http_many(endpoints=[{"url": "http://localhost", "method": "FOO"}])
+    with pytest.raises(ValueError):
+        http_many(endpoints=[])
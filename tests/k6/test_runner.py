@@ -0,0 +1,115 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+
+from chaosgrafana.k6 import runner
+from chaosgrafana.k6.driver import parse_duration, stop_all_runs
+from chaosgrafana.k6.probes import http
+
+from . import MockSubprocessContext
+
+
+class FakeK6API(BaseHTTPRequestHandler):
+    """Stands in for the REST API of a k6 process"""
+
+    paused = True
+    completed = 0
+    failed = 0
+    on_resume = None
+
+    def do_GET(self):
+        if self.path == "/v1/metrics":
+            data = [
+                {
+                    "id": "completed",
+                    "attributes": {"sample": {"count": FakeK6API.completed}},
+                },
+                {
+                    "id": "failed",
+                    "attributes": {"sample": {"count": FakeK6API.failed}},
+                },
+            ]
+        else:
+            data = {"attributes": {"paused": FakeK6API.paused}}
+        self._reply({"data": data})
+
+    def do_PATCH(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        FakeK6API.paused = body["data"]["attributes"]["paused"]
+        if not FakeK6API.paused:
+            FakeK6API.completed += 10
+            FakeK6API.failed += 1
+            if FakeK6API.on_resume is not None:
+                FakeK6API.on_resume()
+        self._reply({"data": {}})
+
+    def _reply(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def k6_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeK6API)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    FakeK6API.on_resume = None
+    stop_all_runs()
+
+
+@pytest.mark.parametrize(
+    "duration,seconds",
+    [("", 1.0), ("20s", 20), ("1m30s", 90), ("1h", 3600), ("250ms", 0.25)],
+)
+def test_parse_duration(duration, seconds):
+    assert parse_duration(duration) == seconds
+
+
+def test_parse_invalid_duration():
+    with pytest.raises(ValueError):
+        parse_duration("10 minutes")
+
+
+@patch("subprocess.Popen")
+def test_persistent_probe_reuses_k6(mocked_popen, k6_api):
+    mocked_popen.return_value = MockSubprocessContext(returncode=None)
+
+    def stream_latencies():
+        # stands in for the samples k6 writes to its json output
+        (persistent,) = runner._runners.values()
+        for value in range(10, 110, 10):
+            persistent.run.reader.aggregator.add("http_req_duration", value)
+
+    FakeK6API.on_resume = stream_latencies
+    with patch("chaosgrafana.k6.runner._free_port", return_value=k6_api):
+        first = http("http://localhost:3000", duration="10ms", persistent=True)
+        second = http("http://localhost:3000", duration="10ms", persistent=True)
+
+    assert mocked_popen.call_count == 1
+    command = mocked_popen.call_args[0][0]
+    assert command[command.index("--address") + 1] == f"127.0.0.1:{k6_api}"
+    assert "--paused" in command
+    assert command[-1].endswith("probe-runner.js")
+    assert "CHAOS_K6_DURATION" not in mocked_popen.call_args[1]["env"]
+
+    for result in (first, second):
+        assert result["http_reqs"] == 10
+        assert result["failures"] == 1
+        assert result["failure_rate"] == 0.1
+        assert result["success"] is False
+        assert result["request_rate"] > 0
+        assert result["http_req_duration"]["min"] == 10
+        assert result["http_req_duration"]["max"] == 100
+        assert result["http_req_duration"]["p50"] == pytest.approx(50, 0.02)
+    assert FakeK6API.paused is True
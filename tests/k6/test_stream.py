@@ -0,0 +1,122 @@
+import json
+import threading
+from unittest.mock import ANY, patch
+
+from chaosgrafana.k6.actions import run_script
+from chaosgrafana.k6.stream import (
+    MetricsAggregator,
+    MetricsReader,
+    QuantileSketch,
+)
+
+from . import MockSubprocessContext, k6_run_command
+
+
+def point(metric: str, value: float, **tags) -> str:
+    return json.dumps(
+        {
+            "type": "Point",
+            "metric": metric,
+            "data": {
+                "time": "2023-01-01T00:00:00Z",
+                "value": value,
+                "tags": tags,
+            },
+        }
+    )
+
+
+def test_sketch_quantiles_are_within_relative_accuracy():
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for value in range(1, 10001):
+        sketch.add(value)
+
+    assert sketch.count == 10000
+    assert sketch.min == 1
+    assert sketch.max == 10000
+    for q, expected in ((0.5, 5000), (0.9, 9000), (0.99, 9900)):
+        assert abs(sketch.quantile(q) - expected) / expected <= 0.011
+
+
+def test_sketch_memory_is_bounded():
+    sketch = QuantileSketch(max_buckets=10)
+    for value in range(1, 10001):
+        sketch.add(value)
+
+    assert len(sketch.buckets) == 10
+    assert abs(sketch.quantile(0.99) - 9900) / 9900 <= 0.011
+
+
+def test_merged_sketches_match_a_single_sketch():
+    single, left, right = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for value in range(1, 1001):
+        single.add(value)
+        (left if value % 2 else right).add(value)
+
+    assert left.merge(right).stats() == single.stats()
+
+
+def test_aggregator_groups_series_by_tags():
+    aggregator = MetricsAggregator(group_by=("status",), max_series=2)
+    aggregator.add_line(point("http_req_duration", 10, status="200", url="/a"))
+    aggregator.add_line(point("http_req_duration", 20, status="200", url="/b"))
+    aggregator.add_line(point("http_req_duration", 30, status="500"))
+    aggregator.add_line(point("http_req_duration", 40, status="404"))
+    aggregator.add_line(json.dumps({"type": "Metric", "metric": "x"}))
+    aggregator.add_line("not json")
+
+    snapshot = aggregator.snapshot()
+
+    assert snapshot["samples"] == 4
+    series = {tuple(s["tags"].items()): s["count"] for s in snapshot["series"]}
+    assert series == {(("status", "200"),): 2, (("status", "500"),): 1, (): 1}
+    assert snapshot["windows"]["10s"]["http_req_duration"]["count"] == 4
+    assert aggregator.metric("http_req_duration")["max"] == 40
+
+
+def test_reader_aggregates_while_k6_writes():
+    reader = MetricsReader()
+    reader.start()
+
+    def k6():
+        with open(reader.path, "w") as f:
+            for i in range(100):
+                f.write(point("http_reqs", 1) + "\n")
+
+    writer = threading.Thread(target=k6)
+    writer.start()
+    writer.join()
+    snapshot = reader.stop()
+
+    assert snapshot["samples"] == 100
+
+
+def test_reader_stops_when_k6_never_wrote():
+    reader = MetricsReader()
+    reader.start()
+
+    assert reader.stop()["samples"] == 0
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_run_script_with_streamed_metrics(mocked_popen):
+    mocked_popen.return_value = MockSubprocessContext(returncode=0)
+
+    result = run_script(
+        script_path="../myscript.js",
+        vus=1,
+        duration="1s",
+        stream_metrics=True,
+    )
+
+    assert result["metrics"]["samples"] == 0
+    mocked_popen.assert_called_once_with(
+        k6_run_command(
+            "--out", ANY, "--vus", "1", "--duration", "1s", "../myscript.js"
+        ),
+        stderr=ANY,
+        stdout=ANY,
+        env=None,
+    )
+    assert mocked_popen.call_args[0][0][8].startswith("json=")
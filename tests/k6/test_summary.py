@@ -0,0 +1,124 @@
+import json
+import logging
+
+from chaosgrafana.k6.summary import load_summary, log_result, parse_summary
+
+SUMMARY = {
+    "root_group": {"name": "", "path": "", "id": "d41d8", "groups": {}},
+    "metrics": {
+        "http_req_duration": {
+            "avg": 12.5,
+            "min": 3.1,
+            "med": 11.0,
+            "max": 98.7,
+            "p(50)": 11.0,
+            "p(90)": 20.4,
+            "p(95)": 31.2,
+            "p(99)": 80.9,
+        },
+        "http_reqs": {"count": 200, "rate": 19.8},
+        "http_req_failed": {"passes": 2, "fails": 198, "value": 0.01},
+        "iterations": {"count": 200, "rate": 19.8},
+        "failures": {
+            "passes": 2,
+            "fails": 198,
+            "value": 0.01,
+            "thresholds": {"rate<=0": True},
+        },
+        "completed": {
+            "count": 200,
+            "rate": 19.8,
+            "thresholds": {"count>0": False},
+        },
+    },
+}
+
+
+def test_parse_summary():
+    result = parse_summary(SUMMARY, 99)
+
+    assert result == {
+        "success": False,
+        "exit_code": 99,
+        "http_req_duration": {
+            "avg": 12.5,
+            "min": 3.1,
+            "max": 98.7,
+            "p50": 11.0,
+            "p90": 20.4,
+            "p95": 31.2,
+            "p99": 80.9,
+        },
+        "http_reqs": 200,
+        "request_rate": 19.8,
+        "failure_rate": 0.01,
+        "iterations": 200,
+        "thresholds": {
+            "failures": {"rate<=0": False},
+            "completed": {"count>0": True},
+        },
+        "thresholds_ok": False,
+    }
+
+
+def test_parse_empty_summary():
+    result = parse_summary({}, 0)
+
+    assert result["success"] is True
+    assert result["http_reqs"] == 0
+    assert result["thresholds_ok"] is True
+
+
+def test_load_summary(tmp_path):
+    path = tmp_path / "summary.json"
+    path.write_text(json.dumps(SUMMARY))
+
+    assert load_summary(str(path)) == SUMMARY
+    assert load_summary(str(tmp_path / "missing.json")) == {}
+
+
+def test_parse_summary_submetrics():
+    summary = {
+        "metrics": {
+            "http_req_duration{endpoint:0}": {"avg": 1.0, "p(95)": 2.0},
+            "failures{endpoint:0}": {"passes": 1, "fails": 3, "value": 0.25},
+            "http_reqs{endpoint:0}": {"count": 4, "rate": 2.0},
+        }
+    }
+
+    submetrics = parse_summary(summary, 0)["submetrics"]
+
+    assert submetrics["http_req_duration{endpoint:0}"]["p95"] == 2.0
+    assert submetrics["failures{endpoint:0}"]["rate"] == 0.25
+    assert submetrics["http_reqs{endpoint:0}"] == {"count": 4, "rate": 2.0}
+
+
+def test_log_result(caplog):
+    result = parse_summary(SUMMARY, 99)
+    result["threshold_breach"] = {
+        "metric": "http_req_duration",
+        "threshold": "p(95)<10",
+    }
+
+    with caplog.at_level(logging.INFO, logger="chaostoolkit-loki"):
+        log_result(result, "/scripts/load test.js")
+
+    record = caplog.records[0]
+    assert record.tags == {
+        "type": "k6-result",
+        "name": "load test.js",
+        "status": "failed",
+    }
+    assert record.fields["http_req_duration_p95"] == 31.2
+    assert record.fields["threshold_breach"] == "http_req_duration:p(95)<10"
+    assert record.getMessage().startswith(
+        'script="load test.js" success=false exit_code=99 http_reqs=200 '
+    )
+    assert "http_req_duration_p99=80.9" in record.getMessage()
+
+
+def test_log_result_is_skipped_without_loki(caplog):
+    with caplog.at_level(logging.WARNING, logger="chaostoolkit-loki"):
+        log_result(parse_summary(SUMMARY, 0), "x.js")
+
+    assert caplog.records == []
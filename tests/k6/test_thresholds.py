@@ -0,0 +1,190 @@
+import json
+import signal
+import subprocess
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from chaosgrafana.k6.actions import run_script
+from chaosgrafana.k6.stream import MetricsAggregator
+from chaosgrafana.k6.thresholds import (
+    Threshold,
+    ThresholdMonitor,
+    parse_thresholds,
+)
+
+
+class BlockingProcess:
+    """A k6 process running until it is interrupted"""
+
+    def __init__(self):
+        self.returncode = None
+        self._exited = threading.Event()
+
+    def wait(self, timeout=None):
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired("k6", timeout)
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, sig):
+        self.returncode = -sig
+        self._exited.set()
+
+    def kill(self):
+        self.send_signal(9)
+
+
+def test_parse_thresholds():
+    thresholds = parse_thresholds(
+        [
+            {"metric": "http_req_duration", "threshold": "p(95) < 500"},
+            {
+                "metric": "http_req_failed",
+                "threshold": "rate<=0.05",
+                "window": "1m",
+            },
+        ]
+    )
+
+    assert thresholds[0].quantile == 0.95
+    assert thresholds[0].seconds == 10
+    assert thresholds[1].stat == "rate"
+    assert thresholds[1].seconds == 60
+
+
+@pytest.mark.parametrize(
+    "declaration",
+    [
+        {"metric": "http_req_duration", "threshold": "p95 < 500"},
+        {"metric": "http_req_duration", "threshold": "avg ~ 500"},
+        {"threshold": "avg<500"},
+        {"metric": "http_req_duration", "threshold": "avg<1", "window": "1y"},
+    ],
+)
+def test_invalid_thresholds(declaration):
+    with pytest.raises(ValueError):
+        parse_thresholds([declaration])
+
+
+def test_threshold_check():
+    aggregator = MetricsAggregator()
+    for value in range(1, 101):
+        aggregator.add("http_req_duration", value)
+
+    breach = Threshold("http_req_duration", "p(95)<50").check([aggregator])
+    assert breach["value"] == pytest.approx(95, rel=0.02)
+    assert (
+        Threshold("http_req_duration", "max<=101").check([aggregator]) is None
+    )
+    assert Threshold("http_reqs", "count>0").check([aggregator]) is None
+
+
+def test_rate_threshold_follows_metric_type():
+    aggregator = MetricsAggregator()
+    aggregator.add_line(
+        json.dumps(
+            {
+                "type": "Metric",
+                "metric": "http_req_failed",
+                "data": {"type": "rate"},
+            }
+        )
+    )
+    with patch("chaosgrafana.k6.stream.time.time", return_value=1000.0):
+        for value in (1, 0, 0, 0):
+            aggregator.add("http_req_failed", value)
+            aggregator.add("http_reqs", 1)
+
+    with patch("chaosgrafana.k6.stream.time.time", return_value=1002.0):
+        failed = Threshold("http_req_failed", "rate<0.1").check([aggregator])
+        # not a rate metric, so samples per second since the first one
+        reqs = Threshold("http_reqs", "rate>5").check([aggregator])
+    assert failed["value"] == 0.25
+    assert reqs["value"] == 2.0
+
+
+def test_rate_threshold_during_warm_up():
+    aggregator = MetricsAggregator()
+    threshold = Threshold("http_reqs", "rate>20", "10s")
+    with patch("chaosgrafana.k6.stream.time.time") as now:
+        # a steady 50 requests per second
+        for i in range(50):
+            now.return_value = 1000.0 + i / 50
+            aggregator.add("http_reqs", 1)
+
+        now.return_value = 1000.5
+        assert threshold.check([aggregator]) is None
+
+        now.return_value = 1001.0
+        assert threshold.check([aggregator]) is None
+        assert threshold.observe(
+            aggregator.window_sketch("http_reqs", 10), elapsed=1.0
+        ) == pytest.approx(50)
+
+        # no more requests are sent
+        now.return_value = 1009.9
+        breach = threshold.check([aggregator])
+    assert breach["value"] == pytest.approx(50 / 9.9)
+
+
+def test_monitor_reports_first_breach():
+    aggregator = MetricsAggregator()
+    aggregator.add("http_req_duration", 900)
+    breaches = []
+
+    monitor = ThresholdMonitor(
+        [aggregator],
+        parse_thresholds(
+            [{"metric": "http_req_duration", "threshold": "p(99)<500"}]
+        ),
+        breaches.append,
+        interval=0.01,
+    )
+    monitor.start()
+    while not breaches:
+        pass
+    breach = monitor.stop()
+
+    assert breaches == [breach]
+    assert breach["threshold"] == "p(99)<500"
+    assert breach["elapsed"] >= 0.01
+    assert breach["at"] > 0
+
+
+@patch("subprocess.Popen")
+@patch.dict("chaosgrafana.k6.driver.os.environ", clear=True)
+def test_run_script_stops_k6_on_breach(mocked_popen):
+    process = BlockingProcess()
+
+    def k6(cmd, **kwargs):
+        path = cmd[cmd.index("--out") + 1].split("=", 1)[1]
+
+        def write():
+            with open(path, "w") as f:
+                for _ in range(10):
+                    sample = {
+                        "type": "Point",
+                        "metric": "http_req_duration",
+                        "data": {"value": 2000, "tags": {}},
+                    }
+                    f.write(json.dumps(sample) + "\n")
+
+        threading.Thread(target=write, daemon=True).start()
+        return process
+
+    mocked_popen.side_effect = k6
+
+    result = run_script(
+        script_path="../myscript.js",
+        duration="1h",
+        thresholds=[{"metric": "http_req_duration", "threshold": "p(95)<1000"}],
+    )
+
+    assert process.returncode == -signal.SIGINT
+    assert result["success"] is False
+    assert result["threshold_breach"]["metric"] == "http_req_duration"
+    assert result["threshold_breach"]["value"] >= 1000
@@ -0,0 +1,55 @@
+from typing import List, Tuple
+from urllib.parse import parse_qs
+
+LOKI_URL = "http://loki.test:3100"
+QUERY_RANGE_URL = f"{LOKI_URL}/loki/api/v1/query_range"
+NANOSECONDS = 1_000_000_000
+
+
+class StandInLoki:
+    """
+    Answers `query_range` requests, through requests_mock, from recorded
+    log lines, for log queries, or from a function of time, for metric
+    queries.
+    """
+
+    def __init__(self, lines: List[Tuple[int, str]] = None, metric=None):
+        self.lines = sorted(lines or [])
+        self.metric = metric
+        self.queries = []
+
+    def __call__(self, request, context):
+        params = {k: v[0] for k, v in parse_qs(request.query).items()}
+        start, end = int(params["start"]), int(params["end"])
+        self.queries.append(params)
+
+        if "step" in params:
+            step = int(params["step"]) * NANOSECONDS
+            values = [
+                [t / NANOSECONDS, str(self.metric(t))]
+                for t in range(start, end + 1, step)
+            ]
+            return {
+                "status": "success",
+                "data": {
+                    "resultType": "matrix",
+                    "result": [{"metric": {}, "values": values}],
+                },
+            }
+
+        limit = int(params["limit"])
+        matching = [(ts, line) for ts, line in self.lines if start <= ts < end]
+        return {
+            "status": "success",
+            "data": {
+                "resultType": "streams",
+                "result": [
+                    {
+                        "stream": {"app": "checkout"},
+                        "values": [
+                            [str(ts), line] for ts, line in matching[:limit]
+                        ],
+                    }
+                ],
+            },
+        }
@@ -0,0 +1,165 @@
+from unittest.mock import patch
+
+import pytest
+import requests_mock
+
+from chaosgrafana.loki import probes
+from chaosgrafana.loki.client import LokiQueryError
+from chaosgrafana.loki.probes import count_log_lines, query_metric
+
+from . import LOKI_URL, NANOSECONDS, QUERY_RANGE_URL, StandInLoki
+
+NOW = 1_700_000_000 * NANOSECONDS
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    probes._clients.clear()
+    probes._windows.clear()
+    yield
+    probes._clients.clear()
+    probes._windows.clear()
+
+
+def test_query_metric():
+    loki = StandInLoki(metric=lambda t: (t // NANOSECONDS) % 100)
+    with requests_mock.Mocker() as m:
+        m.get(QUERY_RANGE_URL, json=loki)
+        with patch("time.time_ns", return_value=NOW):
+            value = query_metric(
+                'sum(rate({app="checkout"} |= "error" [1m]))',
+                window="1m",
+                step="10s",
+                loki_endpoint=LOKI_URL,
+            )
+
+    # 1700000000 is a multiple of 100, the window spans 1699999940 to it
+    assert value == 90
+    assert loki.queries[0]["step"] == "10"
+    assert int(loki.queries[0]["start"]) == NOW - 60 * NANOSECONDS
+
+
+def test_query_metric_only_fetches_the_new_tail():
+    loki = StandInLoki(metric=lambda t: t // NANOSECONDS % 1000)
+    with requests_mock.Mocker() as m:
+        m.get(QUERY_RANGE_URL, json=loki)
+        for elapsed in (0, 30, 60):
+            with patch("time.time_ns", return_value=NOW + elapsed * 10**9):
+                value = query_metric(
+                    "sum(count_over_time({app='checkout'}[10s]))",
+                    window="5m",
+                    step="10s",
+                    reduce="last",
+                    loki_endpoint=LOKI_URL,
+                )
+
+    assert value == 60
+    starts = [int(q["start"]) for q in loki.queries]
+    assert starts[0] == NOW - 300 * NANOSECONDS
+    # the last sample of the previous call is fetched again
+    assert starts[1] == NOW
+    assert starts[2] == NOW + 30 * NANOSECONDS
+
+
+def test_query_metric_window_slides():
+    loki = StandInLoki(metric=lambda t: t // NANOSECONDS - NOW // NANOSECONDS)
+    with requests_mock.Mocker() as m:
+        m.get(QUERY_RANGE_URL, json=loki)
+        for elapsed in (0, 120):
+            with patch("time.time_ns", return_value=NOW + elapsed * 10**9):
+                value = query_metric(
+                    "sum(rate({app='checkout'}[1m]))",
+                    window="1m",
+                    step="30s",
+                    reduce="min",
+                    loki_endpoint=LOKI_URL,
+                )
+
+    # 1700000060 is not a multiple of 30, samples start at the next one
+    assert value == 70
+    assert int(loki.queries[1]["start"]) == NOW + 70 * NANOSECONDS
+
+
+def test_query_metric_without_samples():
+    with requests_mock.Mocker() as m:
+        m.get(
+            QUERY_RANGE_URL,
+            json={"data": {"resultType": "matrix", "result": []}},
+        )
+        assert (
+            query_metric("rate({app='none'}[1m])", loki_endpoint=LOKI_URL) == 0
+        )
+
+
+def test_query_metric_unknown_reducer():
+    with pytest.raises(ValueError):
+        query_metric("rate({app='checkout'}[1m])", reduce="median")
+
+
+def test_count_log_lines_paginates():
+    second = NANOSECONDS
+    lines = [
+        (NOW - 50 * second, "a"),
+        (NOW - 40 * second, "b"),
+        (NOW - 40 * second, "c"),
+        (NOW - 30 * second, "d"),
+        (NOW - 20 * second, "e"),
+        (NOW - 90 * second, "too old"),
+    ]
+    loki = StandInLoki(lines=lines)
+    with requests_mock.Mocker() as m:
+        m.get(QUERY_RANGE_URL, json=loki)
+        with patch("time.time_ns", return_value=NOW):
+            count = count_log_lines(
+                '{app="checkout"} |= "error"',
+                window="1m",
+                page_size=2,
+                loki_endpoint=LOKI_URL,
+                tenant="team-a",
+            )
+
+    assert count == 5
+    assert len(loki.queries) == 5
+    assert all(q["direction"] == "forward" for q in loki.queries)
+    assert m.request_history[0].headers["X-Scope-OrgID"] == "team-a"
+
+
+def test_count_log_lines_only_streams_new_lines():
+    second = NANOSECONDS
+    loki = StandInLoki(
+        lines=[(NOW - 30 * second, "a"), (NOW + 10 * second, "b")]
+    )
+    with requests_mock.Mocker() as m:
+        m.get(QUERY_RANGE_URL, json=loki)
+        counts = []
+        for elapsed in (0, 20, 50):
+            with patch("time.time_ns", return_value=NOW + elapsed * second):
+                counts.append(
+                    count_log_lines(
+                        "{app='checkout'}", window="1m", loki_endpoint=LOKI_URL
+                    )
+                )
+
+    # the first line leaves the window on the last call
+    assert counts == [1, 2, 1]
+    assert int(loki.queries[1]["start"]) == NOW
+    assert int(loki.queries[2]["start"]) == NOW + 20 * second
+
+
+def test_count_log_lines_rejects_metric_queries():
+    with requests_mock.Mocker() as m:
+        m.get(
+            QUERY_RANGE_URL,
+            json={"data": {"resultType": "matrix", "result": []}},
+        )
+        with pytest.raises(LokiQueryError):
+            count_log_lines(
+                "rate({app='checkout'}[1m])", loki_endpoint=LOKI_URL
+            )
+
+
+def test_loki_errors_are_raised():
+    with requests_mock.Mocker() as m:
+        m.get(QUERY_RANGE_URL, status_code=400, text="parse error")
+        with pytest.raises(LokiQueryError, match="parse error"):
+            query_metric("not logql", loki_endpoint=LOKI_URL)
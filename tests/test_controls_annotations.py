@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+import requests_mock
+from chaoslib.run import EventHandlerRegistry
+
+from chaosgrafana.controls.annotations import (
+    Annotator,
+    GrafanaAnnotationsClient,
+    after_activity_control,
+    before_activity_control,
+    cleanup_control,
+    configure_control,
+)
+
+GRAFANA_URL = "http://grafana.test"
+ANNOTATIONS_URL = f"{GRAFANA_URL}/api/annotations"
+
+
+def _mock_grafana(m):
+    ids = itertools.count(1)
+    m.post(ANNOTATIONS_URL, json=lambda request, context: {"id": next(ids)})
+    m.patch(requests_mock.ANY, json={"message": "Annotation patched"})
+
+
+def _created(m):
+    return [r.json() for r in m.request_history if r.method == "POST"]
+
+
+def test_run_is_annotated():
+    with requests_mock.Mocker() as m:
+        _mock_grafana(m)
+
+        registry = EventHandlerRegistry()
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=registry,
+            secrets={"token": "glsa_secret"},
+            grafana_endpoint=GRAFANA_URL,
+            dashboard_uid="chaos",
+            trace_id="abc",
+            flush_interval=60,
+        )
+        registry.start_method({})
+        activity = {"name": "kill-pod", "type": "action"}
+        before_activity_control(activity)
+        after_activity_control(activity, {"status": "succeeded"})
+        registry.method_completed({}, [])
+        registry.finish({"status": "completed"})
+        cleanup_control()
+
+    assert all(r.method == "POST" for r in m.request_history)
+    assert m.request_history[0].headers["Authorization"] == "Bearer glsa_secret"
+    annotations = {a["text"]: a for a in _created(m)}
+    assert set(annotations) == {
+        "Experiment: hello",
+        "Phase: method",
+        "Activity 'kill-pod'",
+    }
+    for annotation in annotations.values():
+        assert annotation["timeEnd"] >= annotation["time"]
+        assert annotation["dashboardUID"] == "chaos"
+        assert "chaostoolkit_run_trace_id:abc" in annotation["tags"]
+    assert "succeeded" in annotations["Activity 'kill-pod'"]["tags"]
+    assert "completed" in annotations["Experiment: hello"]["tags"]
+
+
+def test_open_regions_are_patched_when_they_end():
+    with requests_mock.Mocker() as m:
+        _mock_grafana(m)
+
+        annotator = Annotator(GrafanaAnnotationsClient(GRAFANA_URL), ["ctk"])
+        annotator.start_region("method", "Phase: method", ["phase"])
+        assert annotator.flush()
+        annotator.end_region("method", ["done"])
+        assert annotator.flush()
+        assert annotator.flush()
+        annotator.close()
+
+    created, patched = m.request_history
+    assert created.method == "POST"
+    assert "timeEnd" not in created.json()
+    assert patched.method == "PATCH"
+    assert patched.url == f"{ANNOTATIONS_URL}/1"
+    assert patched.json()["tags"] == ["ctk", "phase", "done"]
+    assert patched.json()["timeEnd"] >= created.json()["time"]
+
+
+def test_close_ends_open_regions():
+    with requests_mock.Mocker() as m:
+        _mock_grafana(m)
+
+        annotator = Annotator(GrafanaAnnotationsClient(GRAFANA_URL))
+        annotator.start()
+        annotator.start_region("run", "Experiment: hello", [])
+        annotator.close()
+
+    (created,) = _created(m)
+    assert "timeEnd" in created
+
+
+def test_grafana_failures_do_not_raise():
+    with requests_mock.Mocker() as m:
+        m.post(ANNOTATIONS_URL, status_code=500)
+
+        annotator = Annotator(GrafanaAnnotationsClient(GRAFANA_URL))
+        annotator.start_region("run", "Experiment: hello", [])
+        assert annotator.flush() is False
+        annotator.close()
+
+
+def test_failed_writes_are_retried():
+    with requests_mock.Mocker() as m:
+        m.post(
+            ANNOTATIONS_URL,
+            [{"status_code": 503}, {"json": {"id": 1}}, {"json": {"id": 2}}],
+        )
+        m.patch(
+            requests_mock.ANY,
+            [{"status_code": 502}, {"json": {"message": "patched"}}],
+        )
+
+        annotator = Annotator(GrafanaAnnotationsClient(GRAFANA_URL))
+        annotator.start_region("run", "Experiment: hello", [])
+        annotator.start_region("method", "Phase: method", [])
+        assert annotator.flush() is False
+        annotator.end_region("run", ["completed"])
+        assert annotator.flush()
+        annotator.end_region("method", [])
+        assert annotator.flush() is False
+        assert annotator.flush()
+        annotator.close()
+
+    calls = [(r.method, r.json().get("text")) for r in m.request_history]
+    assert calls == [
+        ("POST", "Experiment: hello"),
+        ("POST", "Phase: method"),
+        ("POST", "Experiment: hello"),
+        ("PATCH", "Phase: method"),
+        ("PATCH", "Phase: method"),
+    ]
+    run = m.request_history[2].json()
+    assert "completed" in run["tags"] and "timeEnd" in run
+
+
+def test_writes_are_given_up_after_max_attempts():
+    with requests_mock.Mocker() as m:
+        m.post(ANNOTATIONS_URL, status_code=500)
+
+        annotator = Annotator(
+            GrafanaAnnotationsClient(GRAFANA_URL), max_attempts=2
+        )
+        annotator.start_region("run", "Experiment: hello", [])
+        assert annotator.flush() is False
+        assert annotator.flush() is False
+        assert annotator.flush()
+        annotator.close()
+
+    assert m.call_count == 2
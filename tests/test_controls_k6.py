@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import signal
+from unittest.mock import MagicMock, patch
+
+import pytest
+from chaoslib.run import EventHandlerRegistry
+
+from chaosgrafana.controls.k6 import configure_control
+from chaosgrafana.k6.actions import start_script
+from chaosgrafana.k6.driver import get_run
+
+
+@patch("subprocess.Popen")
+def test_orphaned_runs_are_stopped_when_the_experiment_finishes(mocked_popen):
+    process = MagicMock(returncode=None)
+    process.poll.return_value = None
+    mocked_popen.return_value = process
+    registry = EventHandlerRegistry()
+    configure_control(experiment={}, event_registry=registry)
+
+    run_id = start_script(script_path="../myscript.js")
+    registry.finish({})
+
+    process.send_signal.assert_called_once_with(signal.SIGINT)
+    with pytest.raises(ValueError):
+        get_run(run_id)
@@ -1,9 +1,28 @@
 # -*- coding: utf-8 -*-
+import gc
+import gzip
+import json
+import logging
+import threading
+import weakref
+
+import pytest
+import requests
 import requests_mock
 from chaoslib.run import EventHandlerRegistry
 from logzero import logger
 
-from chaosgrafana.controls.loki import configure_control
+from chaosgrafana.controls.loki import (
+    STRUCTURED_LABEL_KEYS,
+    FixedLokiEmitterV1,
+    IterationRollup,
+    LokiBatchHandler,
+    LokiSpool,
+    StructuredFormatter,
+    cleanup_control,
+    configure_control,
+)
+from chaosgrafana.stats import stats
 
 
 def test_sending_to_loki():
@@ -20,6 +39,7 @@ def test_sending_to_loki():
         )
 
         logger.error("hello")
+        cleanup_control()
 
     assert m.called
     payload = m.request_history[0].json()
@@ -30,3 +50,675 @@ def test_sending_to_loki():
     assert "chaostoolkit_experiment_ref" in stream
     assert "One" in stream
     assert stream["source"] == "chaostoolkit"
+
+
+def test_finish_flushes_pending_records():
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test:3100/loki/api/v1/push", status_code=204)
+
+        registry = EventHandlerRegistry()
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=registry,
+            secrets={},
+            loki_endpoint="http://localhost.test:3100",
+            batch_interval=60,
+        )
+        registry.finish({"status": "completed"})
+
+        try:
+            assert m.call_count == 1
+            streams = m.request_history[0].json()["streams"]
+            types = [s["stream"]["type"] for s in streams]
+            assert types == [
+                "experiment-started",
+                "experiment-finished",
+                "extension-stats",
+            ]
+        finally:
+            cleanup_control()
+
+
+def test_sending_to_many_sinks():
+    stats.reset()
+    with requests_mock.Mocker() as m:
+        m.post("http://regional.test/loki/api/v1/push", status_code=204)
+        m.post(
+            "http://central.test/loki/api/v1/push",
+            exc=requests.exceptions.ConnectionError,
+        )
+
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=EventHandlerRegistry(),
+            secrets={"central_auth": ("admin", "secret")},
+            sinks=[
+                {
+                    "url": "http://regional.test",
+                    "tenant": "team-a",
+                    "tags": {"region": "eu"},
+                },
+                {
+                    "url": "http://central.test",
+                    "name": "central",
+                    "tenant": "team-b",
+                    "auth": "central_auth",
+                },
+            ],
+            max_retries=0,
+        )
+        cleanup_control()
+
+    regional, central = (
+        [r for r in m.request_history if r.hostname == host]
+        for host in ("regional.test", "central.test")
+    )
+    assert len(regional) == 1
+    assert regional[0].headers["X-Scope-OrgID"] == "team-a"
+    assert "Authorization" not in regional[0].headers
+    assert regional[0].json()["streams"][0]["stream"]["region"] == "eu"
+    assert central[0].headers["X-Scope-OrgID"] == "team-b"
+    assert central[0].headers["Authorization"].startswith("Basic ")
+
+    counters = stats.snapshot()["counters"]
+    assert counters["loki.sinks.regional.test-team-a.records_sent"] == 1
+    assert counters["loki.sinks.central.push_failures"] == 1
+    assert "loki.sinks.central.records_sent" not in counters
+
+
+def test_sinks_on_one_host_are_named_after_their_tenant(tmp_path):
+    spool_path = str(tmp_path / "spool")
+    with requests_mock.Mocker() as m:
+        m.post("http://loki.eu/loki/api/v1/push", status_code=204)
+
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=EventHandlerRegistry(),
+            sinks=[
+                {"url": "http://loki.eu", "tenant": "team-a"},
+                {"url": "http://loki.eu", "tenant": "team-b"},
+            ],
+            spool_path=spool_path,
+        )
+        try:
+            handlers = logging.getLogger("chaostoolkit-loki").handlers
+            assert [(h.name, h.spool.path) for h in handlers] == [
+                ("loki.eu-team-a", f"{spool_path}.loki.eu-team-a"),
+                ("loki.eu-team-b", f"{spool_path}.loki.eu-team-b"),
+            ]
+        finally:
+            cleanup_control()
+
+
+def test_sink_names_must_be_unique():
+    with pytest.raises(ValueError):
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=EventHandlerRegistry(),
+            sinks=[
+                {"url": "http://loki.eu", "name": "eu"},
+                {"url": "http://loki.us", "name": "eu"},
+            ],
+        )
+
+
+def test_sinks_must_have_a_url():
+    with pytest.raises(ValueError):
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=EventHandlerRegistry(),
+            secrets={},
+            sinks=[{"name": "nowhere"}],
+        )
+
+
+def test_continuous_iterations_are_rolled_up():
+    def state(met: bool) -> dict:
+        return {
+            "steady_state_met": met,
+            "probes": [
+                {"activity": {"name": "api-up"}, "tolerance_met": met},
+            ],
+        }
+
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test:3100/loki/api/v1/push", status_code=204)
+
+        registry = EventHandlerRegistry()
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=registry,
+            secrets={},
+            loki_endpoint="http://localhost.test:3100",
+            line_format="json",
+            iterations="rollup",
+            rollup_size=3,
+            batch_interval=60,
+        )
+        registry.start_continuous_hypothesis(1)
+        for i in range(7):
+            registry.continuous_hypothesis_iteration(i, state(i != 4))
+        registry.continuous_hypothesis_completed({}, {})
+        cleanup_control()
+
+    lines = []
+    for request in m.request_history:
+        for stream in request.json()["streams"]:
+            for _, line in stream["values"]:
+                lines.append((stream["stream"]["type"], json.loads(line)))
+
+    rollups = [
+        fields
+        for kind, fields in lines
+        if kind == "experiment-continuous-ssh-rollup"
+    ]
+    assert [
+        (r["first_iteration"], r["last_iteration"], r["failed_iterations"])
+        for r in rollups
+    ] == [(0, 2, 0), (3, 5, 1), (6, 6, 0)]
+    assert rollups[1]["failed_probes"] == ["api-up"]
+    iterations = [
+        fields
+        for kind, fields in lines
+        if kind == "experiment-continuous-ssh-iteration"
+    ]
+    assert [i["iteration"] for i in iterations] == [4]
+
+
+def test_iteration_rollup_is_due_after_its_interval():
+    rollup = IterationRollup(interval=0)
+
+    assert rollup.add(0)["iterations"] == 1
+    assert rollup.take() is None
+
+
+def test_records_are_pushed_in_batches():
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", status_code=204)
+
+        handler = LokiBatchHandler(
+            FixedLokiEmitterV1("http://localhost.test/push", {}),
+            batch_size=3,
+            batch_interval=60,
+        )
+        try:
+            for i in range(7):
+                handler.handle(_record(f"line {i}"))
+            handler.flush()
+        finally:
+            handler.close()
+
+    sizes = [len(r.json()["streams"][0]["values"]) for r in m.request_history]
+    assert sizes == [3, 3, 1]
+
+
+def test_records_keep_the_time_they_were_produced():
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", status_code=204)
+
+        handler = LokiBatchHandler(
+            FixedLokiEmitterV1("http://localhost.test/push", {}),
+            batch_interval=60,
+        )
+        try:
+            record = _record("from k6")
+            record.time_ns = 1672531200123456789
+            handler.handle(record)
+            handler.flush()
+        finally:
+            handler.close()
+
+    values = m.request_history[0].json()["streams"][0]["values"]
+    assert values[0][0] == "1672531200123456789"
+
+
+def test_delivery_is_recorded_in_extension_stats():
+    stats.reset()
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", status_code=204)
+
+        handler = LokiBatchHandler(
+            FixedLokiEmitterV1("http://localhost.test/push", {}),
+            batch_size=2,
+            batch_interval=60,
+        )
+        try:
+            for i in range(3):
+                handler.handle(_record(f"line {i}"))
+            handler.flush()
+        finally:
+            handler.close()
+
+    snapshot = stats.snapshot()
+    assert snapshot["counters"]["loki.records_enqueued"] == 3
+    assert snapshot["counters"]["loki.records_sent"] == 3
+    assert snapshot["counters"]["loki.bytes_sent"] == sum(
+        len(r.body) for r in m.request_history
+    )
+    assert snapshot["timers"]["loki.push"]["count"] == 2
+    assert snapshot["timers"]["loki.enqueue"]["count"] == 3
+
+
+def test_label_sets_are_cached_per_emitter():
+    eu = FixedLokiEmitterV1("http://localhost.test/push", {"region": "eu"})
+    us = FixedLokiEmitterV1("http://localhost.test/push", {"region": "us"})
+    record = _record("one", tags={"type": "x"})
+
+    assert dict(eu.build_labels(record))["region"] == "eu"
+    assert dict(us.build_labels(record))["region"] == "us"
+    assert eu.build_labels(record) is eu.build_labels(record)
+
+    # the cache does not keep emitters alive
+    collected = weakref.ref(eu)
+    del eu
+    gc.collect()
+    assert collected() is None
+
+
+def test_records_are_grouped_by_label_set():
+    emitter = FixedLokiEmitterV1("http://localhost.test/push", {"a": "b"})
+    entries = [
+        (1, _record("one", tags={"type": "x", "iteration": 1}), "one"),
+        (2, _record("two", tags={"type": "y"}), "two"),
+        (3, _record("three", tags={"type": "x", "iteration": 1}), "three"),
+    ]
+
+    payload = emitter.build_batch_payload(entries)
+
+    assert payload == {
+        "streams": [
+            {
+                "stream": {
+                    "a": "b",
+                    "iteration": "1",
+                    "level": "info",
+                    "logger": "chaostoolkit-loki",
+                    "type": "x",
+                },
+                "values": [["1", "one"], ["3", "three"]],
+            },
+            {
+                "stream": {
+                    "a": "b",
+                    "level": "info",
+                    "logger": "chaostoolkit-loki",
+                    "type": "y",
+                },
+                "values": [["2", "two"]],
+            },
+        ]
+    }
+
+
+def test_records_are_dropped_when_buffer_is_full():
+    entered = threading.Event()
+    release = threading.Event()
+
+    class SlowEmitter(FixedLokiEmitterV1):
+        def emit_batch(self, entries):
+            entered.set()
+            release.wait(5)
+
+    handler = LokiBatchHandler(
+        SlowEmitter("http://localhost.test/push", {}),
+        batch_size=1,
+        max_queue_size=1,
+        when_full="drop",
+    )
+    try:
+        handler.handle(_record("first"))
+        assert entered.wait(5)
+        handler.handle(_record("second"))
+        handler.handle(_record("third"))
+        assert handler.dropped == 1
+    finally:
+        release.set()
+        handler.close()
+
+
+def test_k6_output_never_crowds_out_run_events():
+    entered = threading.Event()
+    release = threading.Event()
+    shipped = []
+
+    class SlowEmitter(FixedLokiEmitterV1):
+        def emit_batch(self, entries):
+            entered.set()
+            release.wait(5)
+            shipped.extend(record.getMessage() for _, record, _ in entries)
+
+    handler = LokiBatchHandler(
+        SlowEmitter("http://localhost.test/push", {}),
+        batch_size=1,
+        max_queue_size=10,
+        when_full="block",
+    )
+    stats.reset()
+    try:
+        handler.handle(_record("starting", {"type": "experiment-started"}))
+        assert entered.wait(5)
+        for i in range(100):
+            handler.handle(_record(f"k6 line {i}", {"type": "k6-log"}))
+        for i in range(5):
+            handler.handle(_record(f"step {i}", {"type": "activity-ended"}))
+    finally:
+        release.set()
+        handler.close()
+
+    assert shipped == [
+        "starting",
+        *(f"k6 line {i}" for i in range(5)),
+        *(f"step {i}" for i in range(5)),
+    ]
+    assert handler.dropped == 95
+    assert stats.snapshot()["counters"]["loki.records_dropped"] == 95
+
+
+def _record(msg: str, tags: dict = None) -> logging.LogRecord:
+    record = logging.LogRecord(
+        "chaostoolkit-loki", logging.INFO, __file__, 0, msg, None, None
+    )
+    if tags is not None:
+        record.tags = tags
+    return record
+
+
+def test_structured_mode_keeps_only_low_cardinality_labels():
+    emitter = FixedLokiEmitterV1(
+        "http://localhost.test/push",
+        {"a": "b"},
+        label_keys=STRUCTURED_LABEL_KEYS,
+    )
+    record = _record(
+        "done",
+        tags={"type": "x", "name": "n", "status": "ok", "duration": 1.2},
+    )
+
+    assert dict(emitter.build_labels(record)) == {
+        "a": "b",
+        "level": "info",
+        "logger": "chaostoolkit-loki",
+        "name": "n",
+        "status": "ok",
+        "type": "x",
+    }
+
+
+def test_structured_formatter_json():
+    formatter = StructuredFormatter("json", STRUCTURED_LABEL_KEYS)
+    record = _record(
+        "done",
+        tags={
+            "type": "x",
+            "duration": 1.2,
+            "output": {"k": "v"},
+            "exception": None,
+        },
+    )
+
+    assert json.loads(formatter.format(record)) == {
+        "message": "done",
+        "duration": 1.2,
+        "output": {"k": "v"},
+    }
+
+
+def test_structured_formatter_logfmt():
+    formatter = StructuredFormatter("logfmt", STRUCTURED_LABEL_KEYS)
+    record = _record(
+        "Activity 'a' finished",
+        tags={"type": "x", "duration": 1.2, "output": {"k": "v"}},
+    )
+
+    assert formatter.format(record) == (
+        """message="Activity 'a' finished" duration=1.2 """
+        '''output="{\\"k\\": \\"v\\"}"'''
+    )
+
+
+def test_structured_formatter_renders_record_fields():
+    formatter = StructuredFormatter("logfmt", STRUCTURED_LABEL_KEYS)
+    record = _record("p95=12.5", tags={"type": "k6-result", "name": "x.js"})
+    record.fields = {"script": "x.js", "http_req_duration_p95": 12.5}
+
+    assert formatter.format(record) == "script=x.js http_req_duration_p95=12.5"
+
+
+def test_structured_formatter_truncates_large_fields():
+    formatter = StructuredFormatter(
+        "json", STRUCTURED_LABEL_KEYS, max_output_size=10
+    )
+    record = _record("done", tags={"output": "x" * 100})
+
+    assert json.loads(formatter.format(record)) == {
+        "message": "done",
+        "output": "x" * 10,
+        "output_truncated": 100,
+    }
+
+
+def test_gzip_compressed_push():
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", status_code=204)
+
+        emitter = FixedLokiEmitterV1(
+            "http://localhost.test/push", {}, compression="gzip"
+        )
+        emitter.emit_batch([(1, _record("one"), "one")])
+
+    request = m.request_history[0]
+    assert request.headers["Content-Encoding"] == "gzip"
+    assert request.headers["Content-Type"] == "application/json"
+    payload = json.loads(gzip.decompress(request.body))
+    assert payload["streams"][0]["values"] == [["1", "one"]]
+
+
+def test_protobuf_payload():
+    emitter = FixedLokiEmitterV1("http://localhost.test/push", {"a": 'b"c'})
+
+    payload = emitter.build_protobuf_payload(
+        [(1_000_000_002, _record("x"), "x")]
+    )
+
+    labels = b'{a="b\\"c", level="info", logger="chaostoolkit-loki"}'
+    entry = b"\x0a\x04\x08\x01\x10\x02" + b"\x12\x01x"
+    stream = b"\x0a" + bytes([len(labels)]) + labels + b"\x12\x09" + entry
+    assert payload == b"\x0a" + bytes([len(stream)]) + stream
+
+
+def test_snappy_compressed_push():
+    snappy = pytest.importorskip("snappy")
+
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", status_code=204)
+
+        emitter = FixedLokiEmitterV1(
+            "http://localhost.test/push", {}, compression="snappy"
+        )
+        entries = [(1, _record("one"), "one")]
+        emitter.emit_batch(entries)
+
+    request = m.request_history[0]
+    assert request.headers["Content-Type"] == "application/x-protobuf"
+    assert snappy.uncompress(request.body) == emitter.build_protobuf_payload(
+        entries
+    )
+
+
+def test_snappy_push_without_python_snappy(monkeypatch):
+    monkeypatch.setattr(
+        "chaosgrafana.controls.protobuf.has_snappy", lambda: False
+    )
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test:3100/loki/api/v1/push", status_code=204)
+
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=EventHandlerRegistry(),
+            loki_endpoint="http://localhost.test:3100",
+            compression="snappy",
+        )
+        handler = logging.getLogger("chaostoolkit-loki").handlers[0]
+        entries = [(1, _record("one"), "one")]
+        handler.emitter.emit_batch(entries)
+        cleanup_control()
+
+    request = m.request_history[0]
+    assert handler.emitter.compression == "snappy"
+    assert request.headers["Content-Type"] == "application/x-protobuf"
+    assert request.body.endswith(
+        handler.emitter.build_protobuf_payload(entries)
+    )
+
+
+def test_push_is_retried_on_server_errors():
+    with requests_mock.Mocker() as m:
+        m.post(
+            "http://localhost.test/push",
+            [
+                {"status_code": 503},
+                {"status_code": 429, "headers": {"Retry-After": "0"}},
+                {"status_code": 204},
+            ],
+        )
+
+        handler = LokiBatchHandler(
+            FixedLokiEmitterV1("http://localhost.test/push", {}),
+            retry_backoff=0,
+        )
+        try:
+            handler.handle(_record("one"))
+            handler.flush()
+        finally:
+            handler.close()
+
+    assert m.call_count == 3
+
+
+def test_undelivered_pushes_are_spooled_and_replayed(tmp_path):
+    spool = LokiSpool(str(tmp_path / "loki.spool"))
+    emitter = FixedLokiEmitterV1("http://localhost.test/push", {})
+
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", status_code=503)
+
+        handler = LokiBatchHandler(
+            emitter, max_retries=1, retry_backoff=0, spool=spool
+        )
+        try:
+            handler.handle(_record("one"))
+            handler.flush()
+            handler.handle(_record("two"))
+            handler.flush()
+        finally:
+            handler.close()
+
+    assert spool.pending()
+
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", status_code=204)
+
+        handler = LokiBatchHandler(emitter, spool=spool)
+        try:
+            handler.handle(_record("three"))
+            handler.flush()
+        finally:
+            handler.close()
+
+    lines = [r.json()["streams"][0]["values"][0][1] for r in m.request_history]
+    assert lines == ["one", "two", "three"]
+    assert not spool.pending()
+
+
+def test_rejected_pushes_are_dropped_not_spooled(tmp_path):
+    spool = LokiSpool(str(tmp_path / "loki.spool"))
+    emitter = FixedLokiEmitterV1("http://localhost.test/push", {})
+    spool.append(emitter.build_batch_payload([(1, _record("old"), "old")]))
+    stats.reset()
+
+    def loki(request, context):
+        line = request.json()["streams"][0]["values"][0][1]
+        context.status_code = 400 if line in ("old", "bad") else 204
+        return ""
+
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test/push", text=loki)
+
+        handler = LokiBatchHandler(emitter, spool=spool, retry_backoff=0)
+        try:
+            for line in ("bad", "one", "two", "three"):
+                handler.handle(_record(line))
+                handler.flush()
+        finally:
+            handler.close()
+
+    lines = [r.json()["streams"][0]["values"][0][1] for r in m.request_history]
+    assert lines == ["old", "bad", "one", "two", "three"]
+    assert not spool.pending()
+    counters = stats.snapshot()["counters"]
+    assert counters["loki.records_rejected"] == 2
+    assert counters["loki.records_sent"] == 3
+    assert "loki.records_spooled" not in counters
+
+
+def test_unwritable_spool_does_not_stop_the_shipper(tmp_path):
+    spool = LokiSpool(str(tmp_path / "missing" / "loki.spool"))
+    stats.reset()
+
+    with requests_mock.Mocker() as m:
+        m.post(
+            "http://localhost.test/push",
+            [{"status_code": 503}, {"status_code": 204}],
+        )
+
+        handler = LokiBatchHandler(
+            FixedLokiEmitterV1("http://localhost.test/push", {}),
+            max_retries=0,
+            spool=spool,
+            when_full="block",
+        )
+        try:
+            handler.handle(_record("lost"))
+            assert handler.flush()
+            handler.handle(_record("sent"))
+            assert handler.flush()
+            assert handler._worker.is_alive()
+        finally:
+            handler.close()
+
+    assert m.call_count == 2
+    assert handler.dropped == 1
+    counters = stats.snapshot()["counters"]
+    assert counters["loki.spool_failures"] == 1
+    assert counters["loki.records_dropped"] == 1
+    assert counters["loki.records_sent"] == 1
+
+
+def test_spool_directory_is_created(tmp_path):
+    spool_path = tmp_path / "spool" / "loki.spool"
+    with requests_mock.Mocker() as m:
+        m.post("http://localhost.test:3100/loki/api/v1/push", status_code=503)
+
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=EventHandlerRegistry(),
+            loki_endpoint="http://localhost.test:3100",
+            spool_path=str(spool_path),
+            max_retries=0,
+        )
+        logger.error("hello")
+        cleanup_control()
+
+    assert spool_path.exists()
+
+
+def test_spool_is_rotated(tmp_path):
+    spool = LokiSpool(str(tmp_path / "loki.spool"), max_size=30, backups=1)
+
+    for i in range(3):
+        spool.append({"streams": [], "i": i})
+
+    assert spool.files() == [spool.path + ".1", spool.path]
+    replayed = []
+    assert spool.replay(replayed.append)
+    assert [p["i"] for p in replayed] == [1, 2]
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import json
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from chaoslib.run import EventHandlerRegistry
+
+from chaosgrafana.controls import metrics
+from chaosgrafana.controls.metrics import (
+    after_activity_control,
+    before_activity_control,
+    cleanup_control,
+    configure_control,
+)
+from chaosgrafana.controls.protobuf import snappy_compress
+
+
+class Receiver(BaseHTTPRequestHandler):
+    """Stands in for a remote-write or OTLP/HTTP receiver"""
+
+    pushes = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        Receiver.pushes.append((self.path, dict(self.headers), body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def receiver():
+    Receiver.pushes = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Receiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    cleanup_control()
+    server.shutdown()
+    server.server_close()
+
+
+def _unsnappy(block: bytes) -> bytes:
+    """Decode the literal-only snappy blocks the extension writes"""
+    length, i = _read_varint(block, 0)
+    data = bytearray()
+    while i < len(block):
+        tag = block[i] >> 2
+        i += 1
+        if tag < 60:
+            size = tag + 1
+        else:
+            width = tag - 59
+            size = int.from_bytes(block[i : i + width], "little") + 1  # noqa
+            i += width
+        data += block[i : i + size]  # noqa: E203
+        i += size
+    assert len(data) == length
+    return bytes(data)
+
+
+def _read_varint(data: bytes, i: int):
+    value, shift = 0, 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, i
+
+
+def _fields(data: bytes):
+    i = 0
+    while i < len(data):
+        key, i = _read_varint(data, i)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, i = _read_varint(data, i)
+        elif wire == 1:
+            value = struct.unpack("<d", data[i : i + 8])[0]  # noqa: E203
+            i += 8
+        else:
+            size, i = _read_varint(data, i)
+            value = data[i : i + size]  # noqa: E203
+            i += size
+        yield field, value
+
+
+def _series(write_request: bytes):
+    series = {}
+    for _, ts in _fields(write_request):
+        labels, value = {}, None
+        for field, item in _fields(ts):
+            if field == 1:
+                pair = dict(_fields(item))
+                labels[pair[1].decode()] = pair[2].decode()
+            else:
+                value = dict(_fields(item))[1]
+        name = labels.pop("__name__")
+        series[(name, tuple(sorted(labels.items())))] = value
+    return series
+
+
+def _run_experiment(registry):
+    registry.start_hypothesis_before({})
+    registry.hypothesis_before_completed({}, {"steady_state_met": True}, {})
+    registry.start_method({})
+    activity = {"name": "kill", "type": "action"}
+    before_activity_control(activity)
+    after_activity_control(activity, {"status": "failed", "duration": 2.0})
+    registry.method_completed({}, [])
+    registry.start_hypothesis_after({})
+    registry.hypothesis_after_completed({}, {"steady_state_met": False}, {})
+    registry.finish({"status": "completed", "duration": 4.2})
+
+
+def test_snappy_literals_round_trip(monkeypatch):
+    monkeypatch.setattr(
+        "chaosgrafana.controls.protobuf.has_snappy", lambda: False
+    )
+    data = bytes(range(256)) * 300
+    block = snappy_compress(data)
+
+    assert _unsnappy(block) == data
+    try:
+        import snappy
+    except ImportError:
+        return
+    assert snappy.uncompress(block) == data
+
+
+def test_remote_write(receiver, monkeypatch):
+    monkeypatch.setattr(
+        "chaosgrafana.controls.protobuf.has_snappy", lambda: False
+    )
+    registry = EventHandlerRegistry()
+    configure_control(
+        experiment={"title": "hello"},
+        event_registry=registry,
+        endpoint=f"{receiver}/api/v1/write",
+        headers={"X-Scope-OrgID": "chaos"},
+        trace_id="abc",
+        push_interval=3600,
+    )
+    _run_experiment(registry)
+
+    path, headers, body = Receiver.pushes[-1]
+    assert path == "/api/v1/write"
+    assert headers["Content-Encoding"] == "snappy"
+    assert headers["X-Scope-OrgID"] == "chaos"
+
+    series = _series(_unsnappy(body))
+    common = {
+        "chaostoolkit_experiment_ref": metrics.experiment_hash(
+            {"title": "hello"}
+        ),
+        "chaostoolkit_run_trace_id": "abc",
+        "job": "chaostoolkit",
+    }
+
+    def get(metric, **labels):
+        return series[(metric, tuple(sorted({**common, **labels}.items())))]
+
+    activity = dict(name="kill", status="failed", type="action")
+    duration = "chaostoolkit_activity_duration_seconds"
+    assert get(f"{duration}_count", **activity) == 1
+    assert get(f"{duration}_sum", **activity) == 2
+    assert get(f"{duration}_bucket", le="1.0", **activity) == 0
+    assert get(f"{duration}_bucket", le="2.5", **activity) == 1
+    assert get(f"{duration}_bucket", le="+Inf", **activity) == 1
+    failures = get(
+        "chaostoolkit_activity_failures_total", name="kill", type="action"
+    )
+    assert failures == 1
+    assert get("chaostoolkit_deviations_total", phase="hypothesis_after") == 1
+    assert get("chaostoolkit_phases_in_flight", phase="method") == 0
+    assert get("chaostoolkit_phase_duration_seconds_count", phase="method") == 1
+    assert get("chaostoolkit_experiments_total", status="completed") == 1
+
+
+def test_otlp(receiver):
+    registry = EventHandlerRegistry()
+    configure_control(
+        experiment={"title": "hello"},
+        event_registry=registry,
+        endpoint=f"{receiver}/v1/metrics",
+        protocol="otlp",
+        push_interval=3600,
+    )
+    _run_experiment(registry)
+
+    path, headers, body = Receiver.pushes[-1]
+    assert path == "/v1/metrics"
+    resource = json.loads(body)["resourceMetrics"][0]
+    attributes = {
+        a["key"]: a["value"]["stringValue"]
+        for a in resource["resource"]["attributes"]
+    }
+    assert attributes["service.name"] == "chaostoolkit"
+    assert "chaostoolkit_run_trace_id" in attributes
+
+    found = {m["name"]: m for m in resource["scopeMetrics"][0]["metrics"]}
+    histogram = found["chaostoolkit_activity_duration_seconds"]["histogram"]
+    point = histogram["dataPoints"][0]
+    assert histogram["aggregationTemporality"] == 2
+    assert point["count"] == "1"
+    assert point["bucketCounts"][point["explicitBounds"].index(2.5)] == "1"
+    deviations = found["chaostoolkit_deviations_total"]["sum"]
+    assert deviations["isMonotonic"] is True
+    assert deviations["dataPoints"][0]["asDouble"] == 1
+
+
+def test_failed_pushes_do_not_fail_the_experiment(receiver):
+    registry = EventHandlerRegistry()
+    configure_control(
+        experiment={"title": "hello"},
+        event_registry=registry,
+        endpoint="http://127.0.0.1:1/api/v1/write",
+        push_interval=3600,
+    )
+    registry.finish({"status": "completed"})
+
+    assert metrics.pusher.flush() is False
+
+
+def test_unknown_protocol():
+    with pytest.raises(ValueError):
+        configure_control(
+            experiment={},
+            event_registry=EventHandlerRegistry(),
+            protocol="statsd",
+        )
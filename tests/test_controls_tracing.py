@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from unittest.mock import MagicMock, patch
+
+import requests_mock
+from chaoslib.run import EventHandlerRegistry
+
+from chaosgrafana.controls.loki import (
+    after_activity_control,
+    before_activity_control,
+    cleanup_control,
+    configure_control,
+)
+from chaosgrafana.controls.tracing import Span, to_trace_id
+from chaosgrafana.k6.actions import run_script
+from chaosgrafana.k6.trace import current_traceparent
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+
+def _spans(m):
+    spans = []
+    for request in m.request_history:
+        if request.url.endswith("/v1/traces"):
+            for resource in request.json()["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    spans.extend(scope["spans"])
+    return {span["name"]: span for span in spans}
+
+
+def test_run_is_exported_as_a_trace(monkeypatch):
+    monkeypatch.delenv("TRACEPARENT", raising=False)
+    with requests_mock.Mocker() as m:
+        m.post("http://loki.test/loki/api/v1/push", status_code=204)
+        m.post("http://tempo.test/v1/traces", status_code=200)
+
+        registry = EventHandlerRegistry()
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=registry,
+            secrets={},
+            loki_endpoint="http://loki.test",
+            trace_id=TRACE_ID,
+            traces_endpoint="http://tempo.test/v1/traces",
+            traces_headers={"X-Scope-OrgID": "chaos"},
+        )
+        assert current_traceparent().startswith(f"00-{TRACE_ID}-")
+
+        registry.start_method({})
+        activity = {"name": "kill-pod", "type": "action"}
+        before_activity_control(activity)
+        during_activity = current_traceparent()
+        after_activity_control(
+            activity,
+            {
+                "status": "failed",
+                "start": None,
+                "end": None,
+                "duration": 1.0,
+                "output": None,
+                "exception": "boom",
+            },
+        )
+        registry.method_completed({}, [])
+        registry.start_hypothesis_after({})
+        registry.hypothesis_after_completed({}, {"steady_state_met": False}, {})
+        registry.finish({"status": "completed", "deviated": True})
+        cleanup_control()
+
+        spans = _spans(m)
+        headers = [r.headers for r in m.request_history if "tempo" in r.url]
+
+    assert "TRACEPARENT" not in os.environ
+    assert current_traceparent() is None
+    assert headers[0]["X-Scope-OrgID"] == "chaos"
+    root, method = spans["hello"], spans["method"]
+    action = spans["kill-pod"]
+    assert {s["traceId"] for s in spans.values()} == {TRACE_ID}
+    assert "parentSpanId" not in root
+    assert method["parentSpanId"] == root["spanId"]
+    assert action["parentSpanId"] == method["spanId"]
+    assert during_activity == f"00-{TRACE_ID}-{action['spanId']}-01"
+    assert action["status"] == {"code": 2, "message": "boom"}
+    assert spans["steady-state-after"]["status"]["code"] == 2
+    assert int(action["endTimeUnixNano"]) >= int(action["startTimeUnixNano"])
+    attributes = {a["key"]: a["value"] for a in root["attributes"]}
+    assert attributes["chaostoolkit.deviated"] == {"boolValue": True}
+
+
+def test_continuous_phase_overlaps_the_method(monkeypatch):
+    monkeypatch.delenv("TRACEPARENT", raising=False)
+    state = {
+        "status": "succeeded",
+        "start": None,
+        "end": None,
+        "duration": 1.0,
+        "output": None,
+    }
+    with requests_mock.Mocker() as m:
+        m.post("http://loki.test/loki/api/v1/push", status_code=204)
+        m.post("http://tempo.test/v1/traces", status_code=200)
+
+        registry = EventHandlerRegistry()
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=registry,
+            secrets={},
+            loki_endpoint="http://loki.test",
+            trace_id=TRACE_ID,
+            traces_endpoint="http://tempo.test/v1/traces",
+        )
+
+        started = threading.Event()
+        method_done = threading.Event()
+        probe = {"name": "check-health", "type": "probe"}
+
+        def continuous_hypothesis():
+            registry.start_continuous_hypothesis(1)
+            started.set()
+            method_done.wait(5)
+            before_activity_control(probe)
+            after_activity_control(probe, state)
+            registry.continuous_hypothesis_completed({}, {})
+
+        hypothesis = threading.Thread(target=continuous_hypothesis)
+        hypothesis.start()
+        started.wait(5)
+
+        registry.start_method({})
+        action = {"name": "kill-pod", "type": "action"}
+        before_activity_control(action)
+        after_activity_control(action, state)
+        background = {"name": "load", "type": "action"}
+        worker = threading.Thread(
+            target=lambda: before_activity_control(background)
+        )
+        worker.start()
+        worker.join()
+        after_activity_control(background, state)
+        registry.method_completed({}, [])
+        method_done.set()
+        hypothesis.join()
+
+        registry.finish({"status": "completed", "deviated": False})
+        cleanup_control()
+
+        spans = _spans(m)
+
+    continuous = spans["continuous-steady-state"]
+    method = spans["method"]
+    assert continuous["parentSpanId"] == spans["hello"]["spanId"]
+    assert spans["check-health"]["parentSpanId"] == continuous["spanId"]
+    assert spans["kill-pod"]["parentSpanId"] == method["spanId"]
+    assert spans["load"]["parentSpanId"] == method["spanId"]
+
+
+@patch("subprocess.Popen")
+def test_k6_runs_get_the_span_of_their_activity(mocked_popen, monkeypatch):
+    monkeypatch.delenv("TRACEPARENT", raising=False)
+    mocked_popen.return_value = MagicMock(returncode=0)
+    state = {
+        "status": "succeeded",
+        "start": None,
+        "end": None,
+        "duration": 1.0,
+        "output": None,
+    }
+    with requests_mock.Mocker() as m:
+        m.post("http://loki.test/loki/api/v1/push", status_code=204)
+        m.post("http://tempo.test/v1/traces", status_code=200)
+
+        registry = EventHandlerRegistry()
+        configure_control(
+            experiment={"title": "hello"},
+            event_registry=registry,
+            secrets={},
+            loki_endpoint="http://loki.test",
+            trace_id=TRACE_ID,
+            traces_endpoint="http://tempo.test/v1/traces",
+        )
+        registry.start_method({})
+
+        def load(name):
+            activity = {"name": name, "type": "action"}
+            before_activity_control(activity)
+            run_script(script_path=f"{name}.js")
+            after_activity_control(activity, state)
+
+        background = threading.Thread(target=load, args=("background",))
+        background.start()
+        background.join()
+        load("foreground")
+
+        registry.method_completed({}, [])
+        registry.finish({"status": "completed", "deviated": False})
+        cleanup_control()
+
+        spans = _spans(m)
+
+    assert "TRACEPARENT" not in os.environ
+    environs = [c.kwargs["env"] for c in mocked_popen.call_args_list]
+    assert [e["TRACEPARENT"] for e in environs] == [
+        f"00-{TRACE_ID}-{spans[name]['spanId']}-01"
+        for name in ("background", "foreground")
+    ]
+
+
+def test_trace_id_is_derived_when_invalid():
+    assert to_trace_id(TRACE_ID) == TRACE_ID
+    derived = to_trace_id("my-run")
+    assert len(derived) == 32 and derived == to_trace_id("my-run")
+    assert Span(derived, "x").traceparent.startswith(f"00-{derived}-")
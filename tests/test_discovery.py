@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import json
+import subprocess
+import sys
+
+from chaosgrafana import build_manifest, discover, load_exported_activities
+
+
+def test_manifest_is_up_to_date(tmp_path):
+    path = tmp_path / "manifest.json"
+    build_manifest(str(path))
+
+    assert load_exported_activities() == json.loads(path.read_text())
+
+
+def test_discover():
+    discovery = discover()
+
+    assert discovery["extension"]["name"] == "chaostoolkit-grafana"
+    names = {(a["type"], a["name"]) for a in discovery["activities"]}
+    assert ("action", "run_script") in names
+    assert ("probe", "http") in names
+
+
+def test_k6_activities_do_not_import_heavy_dependencies():
+    code = (
+        "import json, sys, chaosgrafana.k6.actions, chaosgrafana.k6.probes; "
+        "print(json.dumps(sorted(sys.modules)))"
+    )
+    p = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    modules = json.loads(p.stdout)
+
+    for heavy in ("chaoslib", "logging_loki", "requests"):
+        assert heavy not in modules
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from chaosgrafana.probes import get_extension_stats
+from chaosgrafana.stats import ExtensionStats, stats
+
+
+def test_counters_and_timers():
+    s = ExtensionStats()
+    s.inc("loki.records_sent", 3)
+    s.inc("loki.records_sent")
+    s.observe("loki.push", 0.010)
+    s.observe("loki.push", 0.030)
+
+    snapshot = s.snapshot()
+
+    assert snapshot["counters"] == {"loki.records_sent": 4}
+    push = snapshot["timers"]["loki.push"]
+    assert push["count"] == 2
+    assert push["min"] == pytest.approx(10)
+    assert push["max"] == pytest.approx(30)
+    assert push["avg"] == pytest.approx(20)
+
+
+def test_timer_records_failed_blocks():
+    s = ExtensionStats()
+    with pytest.raises(RuntimeError):
+        with s.timer("k6.spawn"):
+            raise RuntimeError()
+
+    assert s.snapshot()["timers"]["k6.spawn"]["count"] == 1
+
+
+def test_fields_are_flattened():
+    s = ExtensionStats()
+    s.inc("loki.bytes_sent", 512)
+    s.observe("loki.push", 0.002)
+
+    fields = s.fields()
+
+    assert fields["loki_bytes_sent"] == 512
+    assert fields["loki_push_count"] == 1
+    assert fields["loki_push_p95_ms"] == pytest.approx(2, rel=0.02)
+
+
+def test_reset():
+    s = ExtensionStats()
+    s.inc("k6.runs")
+    s.reset()
+
+    assert s.snapshot()["counters"] == {}
+
+
+def test_get_extension_stats_probe():
+    stats.reset()
+    stats.inc("k6.runs")
+
+    assert get_extension_stats()["counters"] == {"k6.runs": 1}